@@ -0,0 +1,29 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Promotion Engine
+
+An embeddable library applying the Promotion rules without Flask or a
+database. Load the Promotions from a columnar snapshot, written by
+``flask promotions-export promotions.columnar``, or from the change feed:
+
+    engine = PromotionEngine.from_snapshot("promotions.columnar")
+    engine.sync("http://promotions:8080")
+    quote = engine.price([(product_id, quantity, unit_price_in_cents)])
+"""
+from promotion_engine.categories import Category, discount
+from promotion_engine.columnar import ColumnarSnapshot
+from promotion_engine.engine import LineQuote, Promotion, PromotionEngine, Quote
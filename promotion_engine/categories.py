@@ -0,0 +1,58 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Promotion Categories
+
+The kinds of Promotion and how much each one takes off a line of a cart.
+"""
+from enum import Enum
+
+
+class Category(Enum):
+    """Enumeration for available Promotion Category"""
+
+    UNKNOWN = 0
+    PERCENTAGE_DISCOUNT_X = 1
+    BUY_X_GET_Y_FREE = 2
+    SPEND_X_SAVE_Y = 3
+
+
+def discount(promotion, quantity, unit_price, amount_scale=100) -> int:
+    """
+    Returns what a Promotion takes off a line, in the unit of the prices
+
+    Args:
+        promotion: anything with the category, discount_x and discount_y of a Promotion
+        quantity (int): the number of items on the line
+        unit_price (int): the price of one item, in minor units (cents)
+        amount_scale (int): the minor units in one unit of the amounts to spend and save
+
+    PERCENTAGE_DISCOUNT_X takes discount_x percent off, rounded down.
+    BUY_X_GET_Y_FREE gives discount_y items free for every discount_x + discount_y
+    items. SPEND_X_SAVE_Y saves discount_y once the line comes to discount_x.
+    The discount never exceeds the line.
+    """
+    category, discount_x, discount_y = promotion.category, promotion.discount_x, promotion.discount_y
+    subtotal = quantity * unit_price
+    if category == Category.PERCENTAGE_DISCOUNT_X:
+        saved = subtotal * discount_x // 100
+    elif category == Category.BUY_X_GET_Y_FREE and discount_y and discount_x + discount_y > 0:
+        saved = quantity // (discount_x + discount_y) * discount_y * unit_price
+    elif category == Category.SPEND_X_SAVE_Y and discount_y and subtotal >= discount_x * amount_scale:
+        saved = discount_y * amount_scale
+    else:
+        saved = 0
+    return max(0, min(saved, subtotal))
@@ -0,0 +1,162 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Columnar Snapshot
+
+A compact binary file of Promotions that processes memory map and read in
+place. Each column is a little-endian array of fixed width values, with
+rows in id order:
+
+    id, product_id, discount_x, discount_y    int64 (discount_y NULL is INT64_MIN)
+    category, validity                        uint8 (category is the Category position)
+    start_date, end_date                      int32 proleptic Gregorian ordinals
+    name, description                         uint32 indexes in the string table (NULL is 0xFFFFFFFF)
+
+The string table stores every distinct string once, as uint32 offsets
+into a UTF-8 blob, and the product index lists the row positions sorted
+by (product_id, id) next to their product_ids. The header gives the row
+and string counts and the offset of every section, aligned to 8 bytes.
+
+Files are replaced with a rename, never rewritten, so readers that still
+map the old file keep reading a consistent one, and every process mapping
+the same file shares its pages.
+"""
+import bisect
+import mmap
+import struct
+from datetime import date
+
+from promotion_engine.categories import Category
+
+MAGIC = b"PROMOCOL"
+FORMAT_VERSION = 1
+NULL_INTEGER = -(2**63)
+NULL_STRING = 0xFFFFFFFF
+CATEGORIES = list(Category)
+
+# The columns in file order, with their array type codes
+COLUMNS = (
+    ("id", "q"),
+    ("product_id", "q"),
+    ("discount_x", "q"),
+    ("discount_y", "q"),
+    ("category", "B"),
+    ("validity", "B"),
+    ("start_date", "i"),
+    ("end_date", "i"),
+    ("name", "I"),
+    ("description", "I"),
+)
+# The sections after the columns: string offsets and bytes, then the product index
+SECTIONS = [name for name, _ in COLUMNS] + ["string_offsets", "strings", "product_keys", "product_rows"]
+HEADER = struct.Struct(f"<8sHHII{len(SECTIONS)}Q")
+ALIGNMENT = 8
+
+
+class ColumnarSnapshot:
+    """
+    Reads Promotions from a memory mapped columnar snapshot
+
+    Columns are memoryviews over the mapping, so looking a Promotion up by
+    id or product only touches the pages it needs, and only the rows that
+    are returned are turned into dictionaries.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._views = []
+        try:
+            self._map_sections()
+        except Exception:
+            self.close()
+            raise
+
+    def _view(self, offset, count, code):
+        view = memoryview(self._mmap)[offset:offset + count * struct.calcsize(code)].cast(code)
+        self._views.append(view)
+        return view
+
+    def _map_sections(self):
+        if len(self._mmap) < HEADER.size:
+            raise ValueError("Not a columnar snapshot")
+        magic, version, _, rows, strings, *offsets = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Not a columnar snapshot of version {FORMAT_VERSION}")
+        sections = dict(zip(SECTIONS, offsets))
+        self.rows = rows
+        self.columns = {name: self._view(sections[name], rows, code) for name, code in COLUMNS}
+        self._string_offsets = self._view(sections["string_offsets"], strings + 1, "I")
+        self._strings = self._view(sections["strings"], self._string_offsets[strings], "B")
+        self._product_keys = self._view(sections["product_keys"], rows, "q")
+        self._product_rows = self._view(sections["product_rows"], rows, "I")
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def close(self):
+        """Releases the mapping"""
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def string(self, index):
+        """Returns a string of the string table, None for NULL_STRING"""
+        if index == NULL_STRING:
+            return None
+        return bytes(self._strings[self._string_offsets[index]:self._string_offsets[index + 1]]).decode("utf8")
+
+    def row(self, position) -> dict:
+        """Returns the row at a position in the same dictionary as Promotion.serialize()"""
+        columns = self.columns
+        discount_y = columns["discount_y"][position]
+        return {
+            "id": columns["id"][position],
+            "name": self.string(columns["name"][position]),
+            "category": CATEGORIES[columns["category"][position]].name,
+            "discount_x": columns["discount_x"][position],
+            "discount_y": None if discount_y == NULL_INTEGER else discount_y,
+            "product_id": columns["product_id"][position],
+            "description": self.string(columns["description"][position]),
+            "validity": bool(columns["validity"][position]),
+            "start_date": date.fromordinal(columns["start_date"][position]).isoformat(),
+            "end_date": date.fromordinal(columns["end_date"][position]).isoformat(),
+        }
+
+    def find(self, promotion_id):
+        """Returns the Promotion with an id, or None"""
+        ids = self.columns["id"]
+        position = bisect.bisect_left(ids, promotion_id)
+        if position < self.rows and ids[position] == promotion_id:
+            return self.row(position)
+        return None
+
+    def for_product(self, product_id) -> list:
+        """Returns the Promotions of a product in id order"""
+        start = bisect.bisect_left(self._product_keys, product_id)
+        end = bisect.bisect_right(self._product_keys, product_id, lo=start)
+        return [self.row(self._product_rows[index]) for index in range(start, end)]
+
+    def __iter__(self):
+        return (self.row(position) for position in range(self.rows))
@@ -0,0 +1,299 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Promotion Engine
+
+Prices carts with the Promotions held in memory, for services that embed
+the rules instead of calling the Promotion service on every request. The
+Promotions are loaded from a columnar snapshot file or from the change
+feed of the service, and kept current by reading the feed again from the
+cursor it returned last.
+
+Only the standard library is used, so importing the engine does not pull
+in Flask or a database driver.
+"""
+import json
+import logging
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass
+from datetime import date
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+
+from promotion_engine import categories
+from promotion_engine.categories import Category
+from promotion_engine.columnar import ColumnarSnapshot
+
+logger = logging.getLogger(__name__)
+
+CHANGES_PATH = "/api/promotions/changes"
+
+
+@dataclass(frozen=True)
+class Promotion:  # pylint: disable=too-many-instance-attributes
+    """A Promotion as the engine applies it"""
+
+    id: int
+    product_id: int
+    category: Category
+    discount_x: int
+    discount_y: Optional[int]
+    start_date: date
+    end_date: date
+    validity: bool = True
+    name: Optional[str] = None
+    description: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Promotion":
+        """Builds a Promotion from the dictionary of Promotion.serialize() or a snapshot row"""
+        return cls(
+            id=int(data["id"]),
+            product_id=data["product_id"],
+            category=Category[data["category"]],
+            discount_x=data["discount_x"],
+            discount_y=data["discount_y"],
+            start_date=date.fromisoformat(data["start_date"]),
+            end_date=date.fromisoformat(data["end_date"]),
+            validity=data["validity"],
+            name=data.get("name"),
+            description=data.get("description"),
+        )
+
+    def is_active(self, today: date) -> bool:
+        """Tells whether the Promotion runs on a day"""
+        return self.validity and self.start_date <= today <= self.end_date
+
+    def discount(self, quantity: int, unit_price: int, amount_scale=100) -> int:
+        """Returns what the Promotion takes off a line (see categories.discount)"""
+        return categories.discount(self, quantity, unit_price, amount_scale)
+
+
+class LineQuote(NamedTuple):
+    """The price of a line of a cart, with the Promotion applied to it if any"""
+
+    product_id: int
+    quantity: int
+    unit_price: int
+    subtotal: int
+    discount: int
+    promotion_id: Optional[int]
+
+    @property
+    def total(self) -> int:
+        """Returns the price of the line after the discount"""
+        return self.subtotal - self.discount
+
+
+class Quote(NamedTuple):
+    """The price of a cart"""
+
+    lines: tuple
+
+    @property
+    def subtotal(self) -> int:
+        """Returns the price of the cart before the discounts"""
+        return sum(line.subtotal for line in self.lines)
+
+    @property
+    def discount(self) -> int:
+        """Returns the sum of the discounts"""
+        return sum(line.discount for line in self.lines)
+
+    @property
+    def total(self) -> int:
+        """Returns the price of the cart after the discounts"""
+        return self.subtotal - self.discount
+
+
+class _Promotions(NamedTuple):
+    """The Promotions by id and the ids by product, never changed once built"""
+
+    by_id: MappingProxyType
+    by_product: MappingProxyType
+
+
+def _freeze(by_id: dict) -> _Promotions:
+    by_product = {}
+    for promotion_id in sorted(by_id):
+        by_product.setdefault(by_id[promotion_id].product_id, []).append(promotion_id)
+    return _Promotions(
+        MappingProxyType(by_id),
+        MappingProxyType({product_id: tuple(ids) for product_id, ids in by_product.items()}),
+    )
+
+
+class PromotionEngine:
+    """
+    Applies the Promotion rules to carts, from Promotions held in memory
+
+    Reads never lock: every load builds new mappings and swaps them in with
+    a single assignment, like the snapshot of the service.
+
+    Args:
+        promotions (iterable): the Promotions to start with
+        clock (callable): returns today's date
+        amount_scale (int): the minor units in one unit of the amounts to spend and save
+    """
+
+    def __init__(self, promotions=(), clock=date.today, amount_scale=100):
+        self.clock = clock
+        self.amount_scale = amount_scale
+        self.cursor = None
+        self._promotions = _freeze({promotion.id: promotion for promotion in promotions})
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_snapshot(cls, path, **kwargs) -> "PromotionEngine":
+        """Loads every Promotion of a columnar snapshot file"""
+        with ColumnarSnapshot(path) as snapshot:
+            engine = cls((Promotion.from_dict(row) for row in snapshot), **kwargs)
+        logger.info("Loaded %d promotions from %s", len(engine), path)
+        return engine
+
+    def __len__(self):
+        return len(self._promotions.by_id)
+
+    def get(self, promotion_id) -> Optional[Promotion]:
+        """Returns the Promotion with an id, active or not, or None"""
+        return self._promotions.by_id.get(promotion_id)
+
+    def active(self, product_id, today=None) -> list:
+        """Returns the Promotions of a product running on a day (today by default), in id order"""
+        today = today or self.clock()
+        promotions = self._promotions
+        candidates = (promotions.by_id[promotion_id] for promotion_id in promotions.by_product.get(product_id, ()))
+        return [promotion for promotion in candidates if promotion.is_active(today)]
+
+    ######################################################################
+    #  C H A N G E   F E E D
+    ######################################################################
+
+    def apply_changes(self, page: dict) -> int:
+        """
+        Applies a page of the change feed and keeps its cursor
+
+        Args:
+            page (dict): the {"changes": [...], "cursor": ...} body of GET /api/promotions/changes
+
+        Returns:
+            int: the number of changes applied
+        """
+        changes = page["changes"]
+        with self._lock:
+            if changes:
+                by_id = dict(self._promotions.by_id)
+                for change in changes:
+                    if change["promotion"] is None:
+                        by_id.pop(int(change["id"]), None)
+                    else:
+                        promotion = Promotion.from_dict(change["promotion"])
+                        by_id[promotion.id] = promotion
+                self._promotions = _freeze(by_id)
+            self.cursor = page["cursor"]
+        return len(changes)
+
+    def sync(self, base_url, limit=None, timeout=10, opener=urllib.request.urlopen) -> int:
+        """
+        Reads the change feed of a Promotion service until it is caught up
+
+        Without a cursor the feed is read from the beginning, which also
+        loads the Promotions an engine made from a snapshot already holds.
+        When the service no longer serves the cursor (410 Gone) every
+        Promotion is read again from the beginning and replaces the old ones.
+
+        Args:
+            base_url (str): the root URL of the Promotion service
+            limit (int): the number of changes asked for per page
+            timeout (float): seconds to wait for each page
+            opener (callable): opens a URL, urllib.request.urlopen by default
+
+        Returns:
+            int: the number of changes applied
+        """
+        applied = 0
+        while True:
+            params = {key: value for key, value in (("since", self.cursor), ("limit", limit)) if value is not None}
+            url = base_url.rstrip("/") + CHANGES_PATH
+            if params:
+                url += "?" + urllib.parse.urlencode(params)
+            try:
+                with opener(url, timeout=timeout) as response:
+                    page = json.load(response)
+            except urllib.error.HTTPError as error:
+                if error.code != 410 or self.cursor is None:
+                    raise
+                logger.warning("The change feed cursor expired, reloading every promotion from %s", base_url)
+                return applied + self._reload(base_url, limit, timeout, opener)
+            count = self.apply_changes(page)
+            applied += count
+            if count == 0:
+                logger.info("Applied %d promotion changes from %s", applied, base_url)
+                return applied
+
+    def _reload(self, base_url, limit, timeout, opener) -> int:
+        """Reads the whole change feed into a new engine and takes its Promotions"""
+        fresh = PromotionEngine(clock=self.clock, amount_scale=self.amount_scale)
+        applied = fresh.sync(base_url, limit=limit, timeout=timeout, opener=opener)
+        with self._lock:
+            self._promotions = fresh._promotions  # pylint: disable=protected-access
+            self.cursor = fresh.cursor
+        return applied
+
+    ######################################################################
+    #  P R I C I N G
+    ######################################################################
+
+    def best(self, product_id, quantity, unit_price, today=None):
+        """
+        Returns (promotion, discount) of the active Promotion saving the most on a line
+
+        Promotions do not stack: a line gets the largest single discount, the
+        lowest id winning ties. The promotion is None when nothing applies.
+        """
+        best, saved = None, 0
+        for promotion in self.active(product_id, today):
+            discount = promotion.discount(quantity, unit_price, self.amount_scale)
+            if discount > saved:
+                best, saved = promotion, discount
+        return best, saved
+
+    def price(self, lines, today=None) -> Quote:
+        """
+        Prices a cart
+
+        Args:
+            lines (iterable): (product_id, quantity, unit_price) of every line, prices in minor units
+            today (date): the day to price on, today by default
+        """
+        today = today or self.clock()
+        quotes = []
+        for product_id, quantity, unit_price in lines:
+            promotion, discount = self.best(product_id, quantity, unit_price, today)
+            quotes.append(
+                LineQuote(
+                    product_id,
+                    quantity,
+                    unit_price,
+                    quantity * unit_price,
+                    discount,
+                    None if promotion is None else promotion.id,
+                )
+            )
+        return Quote(tuple(quotes))
@@ -45,14 +45,20 @@ def create_app():
         # Dependencies require we import the routes AFTER the Flask app is created
         # pylint: disable=wrong-import-position, wrong-import-order, unused-import
         from service import routes, models  # noqa: F401 E402
-        from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        from service.common import error_handlers, cli_commands, partitioning, scheduler  # noqa: F401, E402
+        from service.common import assets, sharding, snapshot  # noqa: E402
 
         try:
             db.create_all()
+            models.upgrade_schema(db.engine)
+            partitioning.init_app(app)
+            sharding.init_app(app)
+            snapshot.init_app(app)
         except Exception as error:  # pylint: disable=broad-except
             app.logger.critical("%s: Cannot continue", error)
             # gunicorn requires exit code 4 to stop spawning workers when they die
             sys.exit(4)
+        assets.init_app(app)
 
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
@@ -63,4 +69,6 @@ def create_app():
 
         app.logger.info("Service initialized!")
 
+        scheduler.start_jobs(app)
+
         return app
@@ -0,0 +1,182 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Static Assets
+
+Serves the files of the admin UI so that browsers keep them: at startup
+every static file is copied under a name holding a hash of its content,
+with gzip and brotli compressed variants, and index.html is rewritten to
+refer to those names. A hashed file never changes, so it is served with an
+immutable Cache-Control, while index.html is revalidated with its ETag on
+every visit and answered with 304 Not Modified until it changes.
+
+The copies are written once to ASSET_DIR and shared by every worker. They
+are sent with send_file, which hands the open file to the server, so
+gunicorn sends it with sendfile() instead of streaming it through Python.
+"""
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+import brotli
+from flask import current_app, request, send_file
+from werkzeug.exceptions import NotFound
+from service.common.files import replacing
+
+logger = logging.getLogger("flask.app")
+
+EXTENSION = "static_assets"
+INDEX = "index.html"
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Files smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE = (".css", ".js", ".html", ".json", ".svg", ".txt")
+# The references of index.html to static files
+STATIC_REFERENCE = re.compile(r'(?P<attribute>(?:href|src)=")static/(?P<path>[^"?#]+)"')
+# (encoding, suffix, compress) of the compressed variants, the preferred first
+ENCODERS = (
+    ("br", ".br", brotli.compress),
+    ("gzip", ".gz", lambda data: gzip.compress(data, 9, mtime=0)),
+)
+
+
+def hashed_name(name, data) -> str:
+    """Returns the name of a file with the hash of its content before its extension"""
+    root, extension = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+
+
+def _store(output, name, data) -> tuple:
+    """Writes a hashed file and its compressed variants, returns the encodings it has"""
+    path = os.path.join(output, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if name.endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_SIZE:
+            for _, suffix, compress in ENCODERS:
+                compressed = compress(data)
+                if len(compressed) < len(data):
+                    with replacing(path + suffix) as file:
+                        file.write(compressed)
+        # the file itself is written last, so its variants are complete once it exists
+        with replacing(path) as file:
+            file.write(data)
+    return tuple(encoding for encoding, suffix, _ in ENCODERS if os.path.exists(path + suffix))
+
+
+def build_assets(static_folder, output) -> dict:
+    """
+    Copies the static files to output under hashed names
+
+    Files already there are left alone, so only the first worker to start
+    after a change compresses anything.
+
+    Returns:
+        dict: the hashed name and encodings of every static file, by name
+    """
+    manifest = {}
+    for root, _, files in os.walk(static_folder):
+        for file_name in sorted(files):
+            name = os.path.relpath(os.path.join(root, file_name), static_folder).replace(os.sep, "/")
+            if name == INDEX:
+                continue
+            with open(os.path.join(root, file_name), "rb") as file:
+                data = file.read()
+            hashed = hashed_name(name, data)
+            manifest[name] = (hashed, _store(output, hashed, data))
+
+    def hashed_reference(match):
+        entry = manifest.get(match["path"])
+        if entry is None:
+            return match[0]
+        return f'{match["attribute"]}assets/{entry[0]}"'
+
+    with open(os.path.join(static_folder, INDEX), encoding="utf8") as file:
+        index = STATIC_REFERENCE.sub(hashed_reference, file.read()).encode("utf8")
+    hashed = hashed_name(INDEX, index)
+    manifest[INDEX] = (hashed, _store(output, hashed, index))
+    return manifest
+
+
+class AssetBundle:
+    """
+    Serves the hashed static files, picking a compressed variant by Accept-Encoding
+
+    Args:
+        static_folder (str): the folder of the static files
+        output (str): the folder the hashed files are written to
+    """
+
+    def __init__(self, static_folder, output):
+        self.output = output
+        self.manifest = build_assets(static_folder, output)
+        self.files = dict(self.manifest.values())
+        logger.info("Serving %d static assets from %s", len(self.files), output)
+
+    def url(self, name) -> str:
+        """Returns the URL of the hashed copy of a static file"""
+        return f"/assets/{self.manifest[name][0]}"
+
+    def send(self, name, cache_control=IMMUTABLE):
+        """Sends a hashed file, compressed when the client accepts one of its encodings"""
+        encodings = self.files.get(name)
+        if encodings is None:
+            raise NotFound()
+        encoding = max(
+            (encoding for encoding in encodings if request.accept_encodings[encoding]),
+            key=lambda encoding: request.accept_encodings[encoding],
+            default=None,
+        )
+        suffixes = {encoding: suffix for encoding, suffix, _ in ENCODERS}
+        path = os.path.join(self.output, name) + suffixes.get(encoding, "")
+        digest = os.path.splitext(name)[0].rsplit(".", 1)[-1]
+        response = send_file(
+            path,
+            mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream",
+            download_name=os.path.basename(name),
+            conditional=True,
+            etag=f"{digest}-{encoding or 'identity'}",
+        )
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = cache_control
+        return response
+
+    def send_index(self):
+        """Sends index.html, which browsers revalidate on every visit"""
+        return self.send(self.manifest[INDEX][0], cache_control="no-cache")
+
+
+def init_app(app):
+    """Builds the hashed static files in ASSET_DIR, unless it is empty"""
+    output = app.config.get("ASSET_DIR")
+    if not output:
+        return None
+    try:
+        bundle = AssetBundle(app.static_folder, output)
+    except OSError as error:
+        logger.warning("Cannot build the static assets in %s: %s", output, error)
+        return None
+    app.extensions[EXTENSION] = bundle
+    return bundle
+
+
+def get_assets():
+    """Returns the static assets of the current application, or None to serve the static folder"""
+    return current_app.extensions.get(EXTENSION)
@@ -0,0 +1,172 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Bulk Export
+
+Streams Promotions out of the database as NDJSON, CSV or Parquet. Rows are
+fetched through a server-side cursor in chunks and written as they arrive,
+so exporting the whole table never holds more than one chunk in memory.
+pyarrow is only imported by a Parquet export. The columnar snapshot format
+is built in memory, as compact arrays, before it is written.
+"""
+import csv
+import json
+import logging
+
+from sqlalchemy import select
+from service.models import db, Promotion
+from service.common.columnar import write_columnar
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("ndjson", "csv", "parquet", "columnar")
+BINARY_FORMATS = ("parquet", "columnar")
+DEFAULT_CHUNK_SIZE = 10000
+
+# Columns written to the export, in the same shape as Promotion.serialize()
+COLUMNS = (
+    "id",
+    "name",
+    "category",
+    "discount_x",
+    "discount_y",
+    "product_id",
+    "description",
+    "validity",
+    "start_date",
+    "end_date",
+)
+
+
+def detect_format(filename: str) -> str:
+    """Guesses the export format from a file name"""
+    for fmt in ("csv", "parquet", "columnar"):
+        if filename.lower().endswith("." + fmt):
+            return fmt
+    return "ndjson"
+
+
+def stream_rows(chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    """
+    Yields lists of at most chunk_size Promotion rows
+
+    Args:
+        chunk_size (int): the number of rows fetched from the cursor at a time
+        filters: any of the filters accepted by Promotion.filter_criteria
+    """
+    table = Promotion.__table__
+    statement = (
+        select(*(table.c[column] for column in COLUMNS))
+        .where(*Promotion.filter_criteria(**filters))
+        .order_by(table.c.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    result = db.session.execute(statement)
+    for partition in result.mappings().partitions():
+        yield partition
+
+
+def _serialize(row) -> dict:
+    """Converts a result row into the same dictionary as Promotion.serialize()"""
+    data = dict(row)
+    data["category"] = row["category"].name
+    data["start_date"] = row["start_date"].isoformat()
+    data["end_date"] = row["end_date"].isoformat()
+    return data
+
+
+######################################################################
+#  W R I T E R S
+######################################################################
+def write_ndjson(output, chunks):
+    """Writes each Promotion as one line of JSON"""
+    for chunk in chunks:
+        output.write("".join(json.dumps(_serialize(row)) + "\n" for row in chunk))
+
+
+def write_csv(output, chunks):
+    """Writes Promotions as CSV with a header row"""
+    writer = csv.DictWriter(output, fieldnames=COLUMNS)
+    writer.writeheader()
+    for chunk in chunks:
+        writer.writerows(_serialize(row) for row in chunk)
+
+
+def write_parquet(output, chunks):
+    """Writes Promotions as Parquet with one row group per chunk"""
+    # pyarrow is slow to import, so the service only loads it for an export
+    # pylint: disable=import-outside-toplevel
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema(
+        [
+            ("id", pyarrow.int64()),
+            ("name", pyarrow.string()),
+            ("category", pyarrow.dictionary(pyarrow.int8(), pyarrow.string())),
+            ("discount_x", pyarrow.int32()),
+            ("discount_y", pyarrow.int32()),
+            ("product_id", pyarrow.int64()),
+            ("description", pyarrow.string()),
+            ("validity", pyarrow.bool_()),
+            ("start_date", pyarrow.date32()),
+            ("end_date", pyarrow.date32()),
+        ]
+    )
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        for chunk in chunks:
+            columns = {column: [row[column] for row in chunk] for column in COLUMNS}
+            columns["category"] = [category.name for category in columns["category"]]
+            writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+
+
+WRITERS = {
+    "ndjson": write_ndjson,
+    "csv": write_csv,
+    "parquet": write_parquet,
+    "columnar": write_columnar,
+}
+
+
+def export_promotions(output, fmt="ndjson", chunk_size=DEFAULT_CHUNK_SIZE, progress=None, **filters):
+    """
+    Exports Promotions to a file
+
+    Args:
+        output: a text file object (a binary one for the BINARY_FORMATS)
+        fmt (str): one of the FORMATS
+        chunk_size (int): the number of rows fetched and written at a time
+        progress (callable): called with the running row count after every chunk
+        filters: any of the filters accepted by Promotion.filter_criteria
+
+    Returns:
+        int: the number of Promotions exported
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    count = 0
+
+    def counted(chunks):
+        nonlocal count
+        for chunk in chunks:
+            yield chunk
+            count += len(chunk)
+            if progress:
+                progress(count)
+
+    WRITERS[fmt](output, counted(stream_rows(chunk_size, **filters)))
+    logger.info("Exported %d promotions as %s", count, fmt)
+    return count
@@ -0,0 +1,320 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Bulk Import
+
+Streams Promotions from CSV or NDJSON files into the database. Rows are
+read lazily, validated in batches with the same rules as the REST API
+(Promotion.deserialize) and loaded with PostgreSQL COPY, falling back to
+multi-row INSERTs on other databases. Only one batch is held in memory
+at a time so arbitrarily large files can be imported.
+"""
+import csv
+import json
+import logging
+from datetime import date
+from itertools import islice
+
+from sqlalchemy import bindparam, func, insert, select, update
+from service.common import sharding
+from service.models import db, Promotion, Category, DataValidationError, promotions_changed
+
+logger = logging.getLogger("flask.app")
+
+FORMATS = ("csv", "ndjson")
+# Only unique columns can be upsert keys, so that one row never updates several Promotions
+UPSERT_KEYS = ("id",)
+DEFAULT_BATCH_SIZE = 10000
+
+# Columns written for each imported row, in COPY order
+COLUMNS = (
+    "name",
+    "category",
+    "discount_x",
+    "discount_y",
+    "product_id",
+    "description",
+    "validity",
+    "start_date",
+    "end_date",
+    "scheduled",
+)
+AUDIT_COLUMNS = ("created_at", "last_updated")
+INT_FIELDS = ("id", "discount_x", "discount_y", "product_id")
+
+
+class ImportStats:  # pylint: disable=too-few-public-methods
+    """Running totals reported while an import is in progress"""
+
+    def __init__(self):
+        self.read = 0
+        self.loaded = 0
+        self.rejected = 0
+        self.batches = 0
+
+    def __repr__(self):
+        return (
+            f"<ImportStats read={self.read} loaded={self.loaded} "
+            f"rejected={self.rejected} batches={self.batches}>"
+        )
+
+
+######################################################################
+#  R E A D E R S
+######################################################################
+def detect_format(filename: str) -> str:
+    """Guesses the import format from a file name"""
+    if filename.lower().endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def read_csv(stream):
+    """Yields (line, data, error) tuples from a CSV stream with a header row"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        try:
+            yield reader.line_num, _coerce_csv_row(row), None
+        except ValueError as error:
+            yield reader.line_num, row, str(error)
+
+
+def read_ndjson(stream):
+    """Yields (line, data, error) tuples from a newline delimited JSON stream"""
+    for line_num, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line), None
+        except ValueError as error:
+            yield line_num, line.rstrip("\n"), f"Invalid JSON: {error}"
+
+
+def _coerce_csv_row(row: dict) -> dict:
+    """Converts CSV strings into the types expected by Promotion.deserialize"""
+    data = {key: value for key, value in row.items() if key and value != ""}
+    for field in INT_FIELDS:
+        if field in data:
+            data[field] = int(data[field])
+    if "discount_y" in row and row["discount_y"] == "":
+        data["discount_y"] = None
+    if "validity" in data:
+        data["validity"] = data["validity"].strip().lower() in ("true", "1", "yes")
+    return data
+
+
+######################################################################
+#  V A L I D A T I O N
+######################################################################
+def validate(data, upsert_key=None) -> dict:
+    """
+    Validates a single row with the Promotion model rules
+
+    Returns:
+        dict: the column values to load
+
+    Raises:
+        DataValidationError: if the row is not a valid Promotion
+    """
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid Promotion: row is not an object")
+    promotion = Promotion()
+    promotion.start_date = date.today()
+    promotion.deserialize(data)
+    values = {
+        "name": promotion.name,
+        "category": promotion.category or Category.UNKNOWN,
+        "discount_x": promotion.discount_x or 0,
+        "discount_y": promotion.discount_y,
+        "product_id": promotion.product_id,
+        "description": promotion.description,
+        "validity": bool(promotion.validity),
+        "start_date": promotion.start_date,
+        "end_date": promotion.end_date,
+        "scheduled": promotion.awaits_start(),
+    }
+    if upsert_key == "id":
+        if not isinstance(data.get("id"), int):
+            raise DataValidationError("Invalid Promotion: missing id for upsert")
+        values["id"] = data["id"]
+    return values
+
+
+######################################################################
+#  L O A D E R S
+######################################################################
+def _copy_rows(cursor, table: str, columns, rows, now):
+    """Streams rows into a table with COPY FROM STDIN"""
+    names = ", ".join(columns + AUDIT_COLUMNS)
+    with cursor.copy(f"COPY {table} ({names}) FROM STDIN") as copy:
+        for row in rows:
+            values = tuple(row[column] for column in columns)
+            copy.write_row(_copy_values(values) + (now, now))
+
+
+def _copy_values(values: tuple) -> tuple:
+    """Converts Python values into something COPY understands"""
+    return tuple(value.name if isinstance(value, Category) else value for value in values)
+
+
+def _load_copy(rows, upsert_key=None):
+    """Loads a batch through PostgreSQL COPY"""
+    table = Promotion.__tablename__
+    connection = db.session.connection()
+    now = connection.execute(select(func.localtimestamp())).scalar()
+    columns = COLUMNS + (("id",) if upsert_key == "id" else ())
+    with connection.connection.driver_connection.cursor() as cursor:
+        if not upsert_key:
+            _copy_rows(cursor, table, columns, rows, now)
+            return
+        cursor.execute(
+            f"CREATE TEMP TABLE {table}_import "
+            f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        _copy_rows(cursor, f"{table}_import", columns, rows, now)
+        assignments = ", ".join(f"{column} = s.{column}" for column in COLUMNS + ("last_updated",))
+        assignments += ", version = p.version + 1"
+        cursor.execute(
+            f"UPDATE {table} p SET {assignments} "
+            f"FROM {table}_import s WHERE p.{upsert_key} = s.{upsert_key}"
+        )
+        names = ", ".join(columns + AUDIT_COLUMNS)
+        cursor.execute(
+            f"INSERT INTO {table} ({names}) SELECT {names} FROM {table}_import s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {table} p WHERE p.{upsert_key} = s.{upsert_key})"
+        )
+    if upsert_key == "id":
+        _advance_sequence()
+
+
+def _load_insert(rows, upsert_key=None):
+    """Loads a batch with multi-row INSERTs (and UPDATEs when upserting)"""
+    table = Promotion.__table__
+    if upsert_key:
+        key = table.c[upsert_key]
+        keys = [row[upsert_key] for row in rows]
+        existing = set(db.session.execute(select(key).where(key.in_(keys))).scalars())
+        updates = [dict(row, _key=row[upsert_key]) for row in rows if row[upsert_key] in existing]
+        rows = [row for row in rows if row[upsert_key] not in existing]
+        if updates:
+            values = {column: bindparam(column) for column in COLUMNS}
+            values["version"] = table.c.version + 1
+            statement = update(table).where(key == bindparam("_key")).values(values)
+            db.session.execute(statement.execution_options(synchronize_session=False), updates)
+    if rows:
+        db.session.execute(insert(table), rows)
+        if upsert_key == "id":
+            _advance_sequence()
+
+
+def _advance_sequence():
+    """Moves the id sequence past the ids loaded explicitly (PostgreSQL only)"""
+    if db.session.connection().dialect.name != "postgresql":
+        return
+    table = Promotion.__tablename__
+    db.session.execute(
+        db.text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))")
+    )
+
+
+def _dedupe(rows, upsert_key):
+    """Keeps the last occurrence of each key so a batch upserts each key once"""
+    if not upsert_key:
+        return rows
+    return list({row[upsert_key]: row for row in rows}.values())
+
+
+######################################################################
+#  I M P O R T
+######################################################################
+def _validate_batch(batch, upsert_key, stats, rejects):
+    """Validates a batch of records and writes the failures to the reject file"""
+    rows = []
+    for line_num, data, error in batch:
+        if error is None:
+            try:
+                rows.append(validate(data, upsert_key))
+                continue
+            except DataValidationError as validation_error:
+                error = str(validation_error)
+        stats.rejected += 1
+        if rejects is not None:
+            rejects.write(json.dumps({"line": line_num, "error": error, "row": data}, default=str) + "\n")
+    return _dedupe(rows, upsert_key)
+
+
+def _load_batch(loader, rows, upsert_key):
+    """Loads a batch of valid rows in its own transaction"""
+    try:
+        loader(rows, upsert_key)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.error("Error loading a batch of %d promotions", len(rows))
+        raise
+    promotions_changed.send(Promotion, op="import", ids=None)
+
+
+def import_promotions(  # pylint: disable=too-many-arguments
+    stream,
+    fmt="ndjson",
+    batch_size=DEFAULT_BATCH_SIZE,
+    rejects=None,
+    upsert_key=None,
+    progress=None,
+    use_copy=None,
+):
+    """
+    Imports Promotions from a CSV or NDJSON stream
+
+    Args:
+        stream: a text file object to read from
+        fmt (str): either "csv" or "ndjson"
+        batch_size (int): the number of rows validated and loaded per transaction
+        rejects: an optional text file object that receives rejected rows as NDJSON
+        upsert_key (str): update existing Promotions matching this column instead of inserting
+        progress (callable): called with the ImportStats after every batch
+        use_copy (bool): force COPY on or off (defaults to on for PostgreSQL)
+
+    Returns:
+        ImportStats: the final totals
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported import format: {fmt}")
+    if upsert_key is not None and upsert_key not in UPSERT_KEYS:
+        raise ValueError(f"Unsupported upsert key: {upsert_key}")
+    if sharding.get_router() is not None:
+        raise ValueError("Promotions cannot be imported while they are sharded over SHARD_DATABASE_URIS")
+    if use_copy is None:
+        use_copy = db.engine.dialect.name == "postgresql"
+    loader = _load_copy if use_copy else _load_insert
+    records = read_csv(stream) if fmt == "csv" else read_ndjson(stream)
+    stats = ImportStats()
+
+    batch = list(islice(records, batch_size))
+    while batch:
+        rows = _validate_batch(batch, upsert_key, stats, rejects)
+        if rows:
+            _load_batch(loader, rows, upsert_key)
+        stats.read += len(batch)
+        stats.loaded += len(rows)
+        stats.batches += 1
+        if progress:
+            progress(stats)
+        batch = list(islice(records, batch_size))
+
+    logger.info("Imported promotions: %s", stats)
+    return stats
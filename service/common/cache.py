@@ -0,0 +1,375 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Result Cache
+
+Keeps computed results with an ETag until a Promotion changes. Every write
+bumps a generation counter through the promotions_changed signal, and
+entries of an older generation are never returned. The time to live bounds
+how stale an entry can get when another host writes to the same database.
+
+The entries and counters live in a backend: LocalBackend keeps them in
+this process, SharedMemoryBackend keeps them in files under /dev/shm so
+that every worker on the host shares the entries and sees the writes of
+the others.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from service.models import promotions_changed
+
+logger = logging.getLogger("flask.app")
+
+# The counters file holds the generation followed by (hits, misses) per cache
+COUNTER = struct.Struct("<q")
+MAX_CACHES = 16
+
+
+def _key_digest(name, key) -> str:
+    text = json.dumps([name, key], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+
+class LocalBackend:
+    """Keeps the cache entries and counters in this process"""
+
+    def __init__(self):
+        self._generation = 0
+        self._entries = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        promotions_changed.connect(self.bump)
+
+    def generation(self) -> int:
+        """Returns the generation of the cached values"""
+        return self._generation
+
+    def bump(self, *_args, **_kwargs):
+        """Makes every entry stale (connected to promotions_changed)"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def load(self, name, key):
+        """Returns the (generation, expires, etag, value) entry of key, or None"""
+        return self._entries.get((name, _key_digest(name, key)))
+
+    def store(self, name, key, entry):
+        """Keeps an entry unless its generation is already over"""
+        with self._lock:
+            if entry[0] == self._generation:
+                self._entries[name, _key_digest(name, key)] = entry
+
+    def register(self, name):
+        """Starts the counters of a cache"""
+        self._counts.setdefault(name, (0, 0))
+
+    def count(self, name, hit):
+        """Counts a hit or a miss of a cache"""
+        with self._lock:
+            hits, misses = self._counts.get(name, (0, 0))
+            self._counts[name] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def counts(self, name) -> tuple:
+        """Returns the (hits, misses) of a cache"""
+        return self._counts.get(name, (0, 0))
+
+    def size(self) -> int:
+        """Returns the number of entries"""
+        return len(self._entries)
+
+
+class SharedMemoryBackend:
+    """
+    Shares the cache entries and counters between the processes of a host
+
+    The counters are memory mapped from a file that is locked while they
+    change. Each entry is a JSON file named after its generation and key,
+    written to a temporary file and renamed so that readers never see half
+    of it; entries of older generations are removed by the next store.
+    """
+
+    def __init__(self, directory, max_entries=1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._names = []
+        os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(os.path.join(directory, "counters"), os.O_RDWR | os.O_CREAT, 0o600)
+        size = COUNTER.size * (1 + 2 * MAX_CACHES)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._counters = mmap.mmap(self._fd, size)
+        # flock() does not exclude the threads sharing the file descriptor
+        self._lock = threading.Lock()
+        promotions_changed.connect(self.bump)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read(self, slot) -> int:
+        return COUNTER.unpack_from(self._counters, slot * COUNTER.size)[0]
+
+    def _add(self, slot):
+        with self._locked():
+            COUNTER.pack_into(self._counters, slot * COUNTER.size, self._read(slot) + 1)
+
+    def _path(self, generation, name, key) -> str:
+        return os.path.join(self.directory, f"{generation}-{_key_digest(name, key)}.json")
+
+    def generation(self) -> int:
+        """Returns the generation of the cached values"""
+        return self._read(0)
+
+    def bump(self, *_args, **_kwargs):
+        """Makes every entry stale, in every process (connected to promotions_changed)"""
+        self._add(0)
+
+    def load(self, name, key):
+        """Returns the (generation, expires, etag, value) entry of key, or None"""
+        try:
+            with open(self._path(self.generation(), name, key), "rb") as file:
+                return tuple(json.load(file))
+        except (OSError, ValueError):
+            return None
+
+    def store(self, name, key, entry):
+        """Keeps an entry unless its generation is already over"""
+        path = self._path(entry[0], name, key)
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "w", encoding="utf8") as file:
+            json.dump(entry, file)
+        os.replace(temporary, path)
+        self._prune()
+
+    def _prune(self):
+        """Removes the entries of older generations and the oldest ones beyond max_entries"""
+        prefix = f"{self.generation()}-"
+        current = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                if entry.name.startswith(prefix):
+                    current.append(entry)
+                else:
+                    self._remove(entry.path)
+        if len(current) > self.max_entries:
+            current.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in current[: len(current) - self.max_entries]:
+                self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another process removed it first
+
+    def register(self, name):
+        """Gives a cache its counters, which every process must register in the same order"""
+        if name not in self._names:
+            if len(self._names) == MAX_CACHES:
+                raise ValueError(f"A shared backend holds at most {MAX_CACHES} caches")
+            self._names.append(name)
+
+    def count(self, name, hit):
+        """Counts a hit or a miss of a cache"""
+        slot = 1 + 2 * self._names.index(name)
+        self._add(slot if hit else slot + 1)
+
+    def counts(self, name) -> tuple:
+        """Returns the (hits, misses) of a cache"""
+        slot = 1 + 2 * self._names.index(name)
+        return self._read(slot), self._read(slot + 1)
+
+    def size(self) -> int:
+        """Returns the number of entries"""
+        prefix = f"{self.generation()}-"
+        return sum(1 for name in os.listdir(self.directory) if name.startswith(prefix) and name.endswith(".json"))
+
+
+class _Flight:  # pylint: disable=too-few-public-methods
+    """A call in progress and the callers waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical reads running at the same time in this process
+
+    The first caller of a key runs the read and the callers arriving while
+    it runs wait for its result instead of querying the database again.
+    Reads only join calls started since the last write, so a caller never
+    gets a result older than its own writes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.collapsed = 0
+        self._generation = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        promotions_changed.connect(self.bump)
+
+    def bump(self, *_args, **_kwargs):
+        """Starts new calls for the reads after a write (connected to promotions_changed)"""
+        with self._lock:
+            self._generation += 1
+
+    def do(self, key, func):
+        """Returns func(), sharing its result with the concurrent callers of the same hashable key"""
+        with self._lock:
+            key = (self._generation, key)
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.collapsed += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = func()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value
+
+
+def create_backend(config):
+    """
+    Returns the backend configured by RESPONSE_CACHE_DIR
+
+    Entries are shared under a directory of their own for each database,
+    and kept in this process when no directory is set or it cannot be used.
+    """
+    directory = config.get("RESPONSE_CACHE_DIR")
+    if not directory:
+        return LocalBackend()
+    database = hashlib.sha1(str(config["SQLALCHEMY_DATABASE_URI"]).encode("utf8")).hexdigest()[:12]
+    try:
+        return SharedMemoryBackend(os.path.join(directory, database), config.get("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+    except OSError as error:
+        logger.warning("Cannot share the response cache in %s: %s", directory, error)
+        return LocalBackend()
+
+
+class ResultCache:
+    """A thread-safe cache of JSON results made stale by writes to Promotions"""
+
+    def __init__(self, ttl=300, clock=time.time, backend=None, name="results"):
+        self.ttl = ttl
+        self.clock = clock
+        self.name = name
+        self.backend = backend or LocalBackend()
+        self.backend.register(name)
+        self.flight = SingleFlight(name)
+
+    def get(self, key, compute):
+        """
+        Returns the cached (etag, value) of key, computing it when missing
+
+        Args:
+            key: a JSON serializable value identifying the result
+            compute (callable): builds the value when it is not cached
+        """
+        generation = self.backend.generation()
+        entry = self.backend.load(self.name, key)
+        if entry and entry[0] == generation and entry[1] > self.clock():
+            self.backend.count(self.name, hit=True)
+            return entry[2], entry[3]
+        self.backend.count(self.name, hit=False)
+        return self.flight.do((generation, _key_digest(self.name, key)), lambda: self._compute(generation, key, compute))
+
+    def _compute(self, generation, key, compute):
+        value = compute()
+        etag = hashlib.sha1(json.dumps(value, sort_keys=True).encode("utf8")).hexdigest()
+        # a write during compute() may have made the value stale already
+        if self.backend.generation() == generation:
+            self.backend.store(self.name, key, (generation, self.clock() + self.ttl, etag, value))
+        return etag, value
+
+    def clear(self):
+        """Makes every entry of the backend stale"""
+        self.backend.bump()
+
+    def stats(self) -> dict:
+        """Returns the hits, misses and hit ratio of this cache"""
+        hits, misses = self.backend.counts(self.name)
+        return {"hits": hits, "misses": misses, "hit_ratio": hits / (hits + misses) if hits + misses else 0.0}
+
+
+def metrics_text(caches, flights=()) -> str:
+    """Renders the counters of caches sharing a backend and of other reads in the Prometheus text format"""
+    lines = [
+        "# HELP promotion_cache_requests_total Lookups of the response caches by result",
+        "# TYPE promotion_cache_requests_total counter",
+    ]
+    ratios = [
+        "# HELP promotion_cache_hit_ratio Share of the lookups answered from the cache",
+        "# TYPE promotion_cache_hit_ratio gauge",
+    ]
+    for cache in caches:
+        stats = cache.stats()
+        lines.append(f'promotion_cache_requests_total{{cache="{cache.name}",result="hit"}} {stats["hits"]}')
+        lines.append(f'promotion_cache_requests_total{{cache="{cache.name}",result="miss"}} {stats["misses"]}')
+        ratios.append(f'promotion_cache_hit_ratio{{cache="{cache.name}"}} {stats["hit_ratio"]:.4f}')
+    backend = caches[0].backend
+    lines += ratios + [
+        "# HELP promotion_cache_generation Writes to Promotions seen by the response caches",
+        "# TYPE promotion_cache_generation counter",
+        f"promotion_cache_generation {backend.generation()}",
+        "# HELP promotion_cache_entries Entries of the current generation",
+        "# TYPE promotion_cache_entries gauge",
+        f"promotion_cache_entries {backend.size()}",
+        "# HELP promotion_reads_total Reads run against the database by this process",
+        "# TYPE promotion_reads_total counter",
+    ]
+    flights = [cache.flight for cache in caches] + list(flights)
+    lines += [f'promotion_reads_total{{read="{flight.name}"}} {flight.calls}' for flight in flights]
+    lines += [
+        "# HELP promotion_reads_collapsed_total Reads that waited for the same read in progress instead",
+        "# TYPE promotion_reads_collapsed_total counter",
+    ]
+    lines += [f'promotion_reads_collapsed_total{{read="{flight.name}"}} {flight.collapsed}' for flight in flights]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,241 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Database Circuit Breaker
+
+Stops sending reads to the database once they keep failing or running
+slow, and answers them with the last result that was read successfully
+instead, marked with its age. After a pause a single trial read is let
+through; the reads that were answered stale are then read again in the
+background, so they are fresh before the next request asks for them.
+"""
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+# Errors that mean the database cannot be reached, not that a query is wrong
+DATABASE_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+# The least seconds between two background reads of a value
+REVALIDATE_BACKOFF = 0.1
+
+
+class CircuitOpenError(Exception):
+    """Used when the database is unavailable and no earlier result can be served"""
+
+    def __init__(self, retry_after):
+        super().__init__("The database is unavailable, try again later")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Counts the database failures and stops calls while they go on
+
+    Args:
+        failure_threshold (int): consecutive failures that open the circuit
+        reset_timeout (float): seconds the circuit stays open before a trial call
+        slow_call_seconds (float): calls taking longer count as failures (0 to disable)
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, slow_call_seconds=0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_call_seconds = slow_call_seconds
+        self.clock = clock
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """Returns closed, open or half-open"""
+        if self._opened_at is None:
+            return CLOSED
+        return HALF_OPEN if self.clock() >= self._opened_at + self.reset_timeout else OPEN
+
+    def retry_in(self) -> float:
+        """Returns the seconds until a call can be let through"""
+        with self._lock:
+            state = self.state
+            if state == OPEN:
+                return self._opened_at + self.reset_timeout - self.clock()
+            if state == HALF_OPEN and self._trial:
+                return min(1.0, self.reset_timeout)
+            return 0
+
+    def allow(self) -> bool:
+        """Tells whether a call can go to the database, taking the trial call when half-open"""
+        with self._lock:
+            state = self.state
+            if state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return state == CLOSED
+
+    def success(self):
+        """Closes the circuit after a call that worked"""
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Database is back, closing the circuit")
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        """Counts a failed call, opening the circuit after too many or a failed trial"""
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self._opened_at is None and self.failures >= self.failure_threshold):
+                logger.warning("Database failed %d times, opening the circuit", self.failures)
+                self._opened_at = self.clock()
+            self._trial = False
+
+    def call(self, func):
+        """
+        Calls func unless the circuit is open
+
+        Raises:
+            CircuitOpenError: when the circuit is open
+            DATABASE_ERRORS: when func cannot reach the database
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.retry_in())
+        started = self.clock()
+        try:
+            result = func()
+        except DATABASE_ERRORS:
+            db.session.rollback()
+            self.failure()
+            raise
+        if self.slow_call_seconds and self.clock() - started > self.slow_call_seconds:
+            self.failure()
+        else:
+            self.success()
+        return result
+
+    def guard(self, func):
+        """Decorates a function reading the database to call it through the breaker"""
+
+        @functools.wraps(func)
+        def guarded(*args, **kwargs):
+            return self.call(lambda: func(*args, **kwargs))
+
+        return guarded
+
+
+class StaleFallback:
+    """
+    Serves the last good result of a read while the database is unavailable
+
+    Args:
+        breaker (CircuitBreaker): guards the database calls made by the reads
+        context (callable): returns the context manager the background reads run in
+        max_entries (int): the most results kept, the least recently read are dropped
+    """
+
+    def __init__(self, breaker, context, max_entries=1024, clock=time.monotonic):
+        self.breaker = breaker
+        self.context = context
+        self.max_entries = max_entries
+        self.clock = clock
+        self.served = 0
+        self._entries = OrderedDict()
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def read(self, key, func):
+        """
+        Returns (value, age) of a read, where age is None when the value is fresh
+
+        Args:
+            key: a hashable identifying the read
+            func (callable): reads the value, calling the database through the breaker
+        """
+        try:
+            value = func()
+        except (CircuitOpenError, *DATABASE_ERRORS):
+            with self._lock:
+                stale = self._entries.get(key)
+                if stale is None:
+                    raise
+                self._pending[key] = func
+                self.served += 1
+                self._start_revalidation()
+            stored_at, value = stale
+            return value, int(self.clock() - stored_at)
+        self._remember(key, value)
+        return value, None
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            self._pending.pop(key, None)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _start_revalidation(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._revalidate, name="revalidate", daemon=True)
+            self._thread.start()
+
+    def _revalidate(self):
+        """Reads again the values served stale, once the breaker lets calls through"""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                key, func = next(iter(self._pending.items()))
+            time.sleep(max(self.breaker.retry_in(), REVALIDATE_BACKOFF))
+            try:
+                with self.context():
+                    value = func()
+            except (CircuitOpenError, *DATABASE_ERRORS):
+                continue
+            self._remember(key, value)
+            logger.info("Revalidated %s", key)
+
+    def metrics_text(self) -> str:
+        """Renders the breaker state and stale reads in the Prometheus text format"""
+        return (
+            "# HELP promotion_database_circuit_open Whether reads are kept away from the database\n"
+            "# TYPE promotion_database_circuit_open gauge\n"
+            f"promotion_database_circuit_open {int(self.breaker.state != CLOSED)}\n"
+            "# HELP promotion_stale_reads_total Reads answered with an earlier result while the database was unavailable\n"
+            "# TYPE promotion_stale_reads_total counter\n"
+            f"promotion_stale_reads_total {self.served}\n"
+        )
+
+
+def stale_headers(age) -> dict:
+    """Returns the headers marking a response served from an earlier read"""
+    if age is None:
+        return {}
+    return {"Age": str(age), "Warning": '110 - "Response is Stale"'}
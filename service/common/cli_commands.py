@@ -16,8 +16,11 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import datetime
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.models import db, Category
+from service.common import bulk_export, bulk_import, files, partitioning, scheduler, sharding
 
 
 ######################################################################
@@ -34,3 +37,183 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to bulk load promotions from a file
+# Usage:
+#   flask promotions-import promotions.csv --rejects rejects.ndjson
+######################################################################
+@app.cli.command("promotions-import")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(bulk_import.FORMATS), help="Defaults to the file extension")
+@click.option("--batch-size", default=bulk_import.DEFAULT_BATCH_SIZE, show_default=True, type=click.IntRange(1))
+@click.option("--rejects", type=click.File("w", encoding="utf-8"), help="Write rejected rows to this NDJSON file")
+@click.option("--upsert-key", type=click.Choice(bulk_import.UPSERT_KEYS), help="Update promotions matching this column")
+def promotions_import(file, fmt, batch_size, rejects, upsert_key):
+    """
+    Streams promotions from a CSV or NDJSON file into the database
+    """
+    fmt = fmt or bulk_import.detect_format(file.name)
+
+    def report(stats):
+        click.echo(f"batch {stats.batches}: {stats.read} read, {stats.loaded} loaded, {stats.rejected} rejected")
+
+    try:
+        stats = bulk_import.import_promotions(
+            file, fmt, batch_size=batch_size, rejects=rejects, upsert_key=upsert_key, progress=report
+        )
+    except ValueError as error:
+        raise click.ClickException(str(error)) from error
+    click.echo(f"Imported {stats.loaded} promotions ({stats.rejected} rejected)")
+
+
+######################################################################
+# Command to stream promotions out to a file
+# Usage:
+#   flask promotions-export promotions.parquet --category SPEND_X_SAVE_Y
+######################################################################
+@app.cli.command("promotions-export")
+@click.argument("file", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(bulk_export.FORMATS), help="Defaults to the file extension")
+@click.option("--chunk-size", default=bulk_export.DEFAULT_CHUNK_SIZE, show_default=True, type=click.IntRange(1))
+@click.option("--name", help="Export Promotions by name")
+# pylint: disable=protected-access, no-member
+@click.option("--category", type=click.Choice(Category._member_names_, case_sensitive=False))
+@click.option("--validity", type=click.BOOL, help="Export Promotions by validity")
+@click.option("--product-id", type=int, help="Export Promotions by product id")
+@click.option("--start-date", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions by start date")
+@click.option("--end-date", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions by end date")
+@click.option("--active-on", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions running on this date")
+@click.option("--starts-after", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions starting after this date")
+@click.option("--ends-before", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions ending before this date")
+@click.option("--active-from", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions running on or after this date")
+@click.option("--active-to", type=click.DateTime(["%Y-%m-%d"]), help="Export Promotions running on or before this date")
+def promotions_export(file, fmt, chunk_size, **filters):
+    """
+    Streams promotions to an NDJSON, CSV, Parquet or columnar snapshot file
+
+    Columnar snapshots replace the file in one rename, so that processes
+    mapping it keep a consistent copy.
+    """
+    fmt = fmt or bulk_export.detect_format(file)
+    if filters["category"]:
+        filters["category"] = Category[filters["category"].upper()]
+    for key, value in filters.items():
+        if isinstance(value, datetime):
+            filters[key] = value.date()
+
+    binary = fmt in bulk_export.BINARY_FORMATS
+    if fmt == "columnar" and file != "-":
+        opened = files.replacing(file)
+    else:
+        opened = click.open_file(file, "wb" if binary else "w", encoding=None if binary else "utf-8")
+    with opened as output:
+        count = bulk_export.export_promotions(
+            output,
+            fmt,
+            chunk_size=chunk_size,
+            progress=lambda count: click.echo(f"{count} exported", err=True),
+            **filters,
+        )
+    click.echo(f"Exported {count} promotions", err=True)
+
+
+######################################################################
+# Command to invalidate promotions that have ended
+# Usage:
+#   flask promotions-expire --batch-size 5000
+######################################################################
+@app.cli.command("promotions-expire")
+@click.option("--batch-size", default=1000, show_default=True, type=click.IntRange(1))
+@click.option("--today", type=click.DateTime(["%Y-%m-%d"]), help="Treat this date as today")
+@click.option("--verbose", is_flag=True, help="List the id of every invalidated promotion")
+def promotions_expire(batch_size, today, verbose):
+    """
+    Invalidates every valid promotion whose end date has passed
+    """
+
+    def report(ids):
+        click.echo(f"invalidated {len(ids)} promotions")
+        if verbose:
+            click.echo(" ".join(str(promotion_id) for promotion_id in ids))
+
+    total = scheduler.sweep_expired(batch_size, today=today.date() if today else None, report=report)
+    click.echo(f"Invalidated {total} expired promotions")
+
+
+######################################################################
+# Command to validate scheduled promotions that have started
+# Usage:
+#   flask promotions-activate
+######################################################################
+@app.cli.command("promotions-activate")
+@click.option("--batch-size", default=1000, show_default=True, type=click.IntRange(1))
+@click.option("--today", type=click.DateTime(["%Y-%m-%d"]), help="Treat this date as today")
+def promotions_activate(batch_size, today):
+    """
+    Validates every scheduled promotion whose start date has come
+    """
+    total = scheduler.activate_started(batch_size, today=today.date() if today else None)
+    click.echo(f"Activated {total} scheduled promotions")
+
+
+######################################################################
+# Command to partition the promotion table by end_date
+# Usage:
+#   flask promotions-partition --months-ahead 6
+######################################################################
+@app.cli.command("promotions-partition")
+@click.option("--months-ahead", default=partitioning.DEFAULT_MONTHS_AHEAD, show_default=True, type=click.IntRange(0))
+def promotions_partition(months_ahead):
+    """
+    Partitions the promotion table by month of end date and creates the missing partitions
+    """
+    created = partitioning.ensure_partitions(months_ahead=months_ahead)
+    for name in created:
+        click.echo(f"created {name}")
+    click.echo(f"Created {len(created)} partitions")
+
+
+######################################################################
+# Command to archive promotions that ended long ago
+# Usage:
+#   flask promotions-archive --before 2024-01-01
+######################################################################
+@app.cli.command("promotions-archive")
+@click.option("--before", type=click.DateTime(["%Y-%m-%d"]), required=True, help="Archive promotions ending before this date")
+@click.option("--batch-size", default=1000, show_default=True, type=click.IntRange(1))
+@click.option("--detach", is_flag=True, help="Detach whole partitions instead of moving their rows to the archive")
+def promotions_archive(before, batch_size, detach):
+    """
+    Moves promotions that ended before a date to the archive table and drops the emptied partitions
+    """
+    before = before.date()
+    if not detach:
+        total = scheduler.archive_expired(batch_size, before=before, report=lambda ids: click.echo(f"archived {len(ids)}"))
+        click.echo(f"Archived {total} expired promotions")
+    if db.engine.dialect.name == "postgresql":
+        for name in partitioning.drop_partitions(partitioning.month_start(before), detach=detach):
+            click.echo(f"removed partition {name}")
+
+
+######################################################################
+# Command to move promotions to the shard owning their product
+# Usage:
+#   flask shards-rebalance
+######################################################################
+@app.cli.command("shards-rebalance")
+@click.option("--batch-size", default=1000, show_default=True, type=click.IntRange(1))
+def shards_rebalance(batch_size):
+    """
+    Moves every promotion to the shard that owns its product, after adding a shard
+    """
+    router = sharding.get_router()
+    if router is None:
+        raise click.ClickException("Sharding is not configured, set SHARD_DATABASE_URIS")
+
+    def report(source, target, count):
+        click.echo(f"moved {count} promotions from {source} to {target}")
+
+    total = router.rebalance(batch_size, report=report)
+    click.echo(f"Moved {total} promotions")
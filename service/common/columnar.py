@@ -0,0 +1,103 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Columnar Snapshot Writer
+
+Writes the columnar snapshots that promotion_engine.columnar reads, where
+the file format is described.
+"""
+import array
+import sys
+
+from promotion_engine.columnar import (  # noqa: F401 (ColumnarSnapshot is re-exported)
+    ALIGNMENT,
+    CATEGORIES,
+    COLUMNS,
+    FORMAT_VERSION,
+    HEADER,
+    MAGIC,
+    NULL_INTEGER,
+    NULL_STRING,
+    ColumnarSnapshot,
+)
+
+
+class _Strings:
+    """Interns strings into offsets and a UTF-8 blob"""
+
+    def __init__(self):
+        self.indexes = {}
+        self.offsets = array.array("I", [0])
+        self.blob = bytearray()
+
+    def index(self, value) -> int:
+        if value is None:
+            return NULL_STRING
+        index = self.indexes.get(value)
+        if index is None:
+            index = self.indexes[value] = len(self.offsets) - 1
+            self.blob += value.encode("utf8")
+            self.offsets.append(len(self.blob))
+        return index
+
+
+def _integer(value) -> int:
+    return NULL_INTEGER if value is None else value
+
+
+def write_columnar(output, chunks):
+    """
+    Writes Promotions as a columnar snapshot
+
+    Args:
+        output: a binary file object
+        chunks: lists of Promotion rows (mappings) in id order
+    """
+    if sys.byteorder != "little":  # pragma: no cover
+        raise RuntimeError("Columnar snapshots are written on little-endian hosts only")
+    columns = {name: array.array(code) for name, code in COLUMNS}
+    strings = _Strings()
+    for chunk in chunks:
+        for row in chunk:
+            for name in ("id", "product_id", "discount_x", "discount_y"):
+                columns[name].append(_integer(row[name]))
+            columns["category"].append(CATEGORIES.index(row["category"]))
+            columns["validity"].append(row["validity"])
+            columns["start_date"].append(row["start_date"].toordinal())
+            columns["end_date"].append(row["end_date"].toordinal())
+            columns["name"].append(strings.index(row["name"]))
+            columns["description"].append(strings.index(row["description"]))
+
+    products = columns["product_id"]
+    positions = sorted(range(len(products)), key=lambda position: products[position])
+    sections = [columns[name] for name, _ in COLUMNS] + [
+        strings.offsets,
+        bytes(strings.blob),
+        array.array("q", (products[position] for position in positions)),
+        array.array("I", positions),
+    ]
+    offsets, offset = [], HEADER.size
+    for section in sections:
+        offset += -offset % ALIGNMENT
+        offsets.append(offset)
+        offset += len(section) * getattr(section, "itemsize", 1)
+    output.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(products), len(strings.offsets) - 1, *offsets))
+    written = HEADER.size
+    for start, section in zip(offsets, sections):
+        output.write(bytes(start - written))
+        data = section if isinstance(section, bytes) else section.tobytes()
+        output.write(data)
+        written = start + len(data)
@@ -22,7 +22,8 @@ Handles all of the HTTP Error Codes returning JSON messages
 
 from flask import current_app as app  # Import Flask application
 from service.routes import api
-from service.models import DataValidationError
+from service.models import DataValidationError, ConcurrentUpdateError
+from service.common.circuit_breaker import CircuitOpenError
 from . import status
 
 
@@ -39,3 +40,31 @@ def request_validation_error(error):
         "error": "Bad Request",
         "message": message,
     }, status.HTTP_400_BAD_REQUEST
+
+
+@api.errorhandler(ConcurrentUpdateError)
+def precondition_failed(error):
+    """Handles writes that lost the race against another writer"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        "status_code": status.HTTP_412_PRECONDITION_FAILED,
+        "error": "Precondition Failed",
+        "message": message,
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+
+@api.errorhandler(CircuitOpenError)
+def service_unavailable(error):
+    """Handles reads while the database is unavailable and nothing is cached"""
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        {
+            "status_code": status.HTTP_503_SERVICE_UNAVAILABLE,
+            "error": "Service Unavailable",
+            "message": message,
+        },
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(max(1, round(error.retry_after)))},
+    )
@@ -0,0 +1,161 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Change Events
+
+Fans committed changes to Promotions out to Server-Sent Events subscribers.
+On PostgreSQL one LISTEN connection per process receives the notifications
+sent by the triggers on the promotion table, so changes made by any worker
+or replica are seen. Other databases publish the promotions_changed signal
+of this process instead.
+
+Every subscriber is just a bounded queue, so an idle listener costs a queue
+and a waiting greenlet when gunicorn runs the gevent worker.
+"""
+import json
+import logging
+import queue
+import threading
+
+import psycopg
+from service.models import db, promotions_changed, CHANGES_CHANNEL
+
+logger = logging.getLogger("flask.app")
+
+DEFAULT_QUEUE_SIZE = 100
+RESET = {"op": "reset", "ids": None}
+
+
+class EventBroker:
+    """Delivers change events to every subscribed queue"""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.listener = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self) -> queue.Queue:
+        """Returns a new queue that receives every event from now on"""
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stops delivering events to a queue"""
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event: dict):
+        """Puts an event on every queue
+
+        A subscriber that fell queue_size events behind loses its backlog
+        and gets a single reset event instead, telling it to resync.
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait(event)
+            except queue.Full:
+                with subscription.mutex:
+                    subscription.queue.clear()
+                subscription.put_nowait(RESET)
+
+    def publish_signal(self, _sender, op=None, ids=None, **_):
+        """Publishes a promotions_changed signal (used without PostgreSQL)"""
+        self.publish({"op": op, "ids": ids} if ids else RESET)
+
+    def listen(self, app):
+        """Starts receiving the changes of the application database, once"""
+        with self._lock:
+            if self.listener is not None:
+                return
+            if db.engine.dialect.name == "postgresql":
+                url = db.engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+                self.listener = PostgresListener(url, self, app.config.get("EVENTS_HEARTBEAT_SECONDS", 15))
+                self.listener.start()
+                # so that changes committed after the first subscription are not missed
+                self.listener.listening.wait(self.listener.timeout)
+            else:
+                promotions_changed.connect(self.publish_signal)
+                self.listener = self.publish_signal
+
+
+class PostgresListener(threading.Thread):
+    """Publishes the notifications of the changes channel to a broker"""
+
+    def __init__(self, url, broker, timeout=15.0):
+        super().__init__(name="promotion-listener", daemon=True)
+        self.url = url
+        self.broker = broker
+        self.timeout = timeout
+        self.listening = threading.Event()
+        self._stopped = threading.Event()
+
+    def run(self):
+        connected = False
+        while not self._stopped.is_set():
+            try:
+                with psycopg.connect(self.url, autocommit=True) as connection:
+                    connection.execute(f"LISTEN {CHANGES_CHANNEL}")
+                    if connected:
+                        # changes made while reconnecting were missed
+                        self.broker.publish(RESET)
+                    connected = True
+                    self.listening.set()
+                    self.receive(connection)
+            except psycopg.Error:
+                logger.exception("Lost the connection listening for promotion changes")
+                self._stopped.wait(self.timeout)
+
+    def receive(self, connection):
+        """Publishes notifications until the listener is stopped"""
+        while not self._stopped.is_set():
+            for notification in connection.notifies(timeout=self.timeout):
+                self.broker.publish(json.loads(notification.payload))
+
+    def stop(self):
+        """Asks the listener to stop within timeout seconds"""
+        self._stopped.set()
+
+
+def event_stream(broker, subscription, heartbeat=15):
+    """
+    Yields a subscription as a text/event-stream
+
+    A comment is sent every heartbeat seconds without events so that
+    proxies keep the connection open and dead clients are noticed.
+    """
+    try:
+        yield f"retry: {int(heartbeat * 1000)}\n\n"
+        while True:
+            try:
+                event = subscription.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {event['op']}\ndata: {json.dumps(event)}\n\n"
+    finally:
+        broker.unsubscribe(subscription)
+
+
+# The broker of this process
+broker = EventBroker()
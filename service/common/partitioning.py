@@ -0,0 +1,212 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Promotion Partitions
+
+Range partitions the promotion table by end_date on PostgreSQL, one
+partition per month, so that queries on current Promotions skip the months
+that are over and old months can be archived or detached whole.
+
+The existing table becomes the DEFAULT partition of the new partitioned
+table, which makes the conversion instant. Its rows are then moved into
+monthly partitions, and the default partition only catches end dates
+beyond the months created ahead until the next maintenance run.
+"""
+import logging
+from datetime import date
+
+from service.models import db, Promotion, create_change_triggers, create_search_indexes, promotions_changed
+
+logger = logging.getLogger("flask.app")
+
+TABLE = Promotion.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+DEFAULT_MONTHS_AHEAD = 3
+
+
+def month_start(day: date, months=0) -> date:
+    """Returns the first day of the month months after the month of day"""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    """Returns the name of the partition holding the Promotions ending in a month"""
+    return f"{TABLE}_y{month.year}m{month.month:02d}"
+
+
+def _execute(connection, sql, **params):
+    return connection.execute(db.text(sql), params)
+
+
+def is_partitioned(connection) -> bool:
+    """Tells whether the promotion table is partitioned"""
+    return (
+        _execute(
+            connection, "SELECT 1 FROM pg_partitioned_table WHERE partrelid = CAST(:table AS regclass)", table=TABLE
+        ).scalar()
+        is not None
+    )
+
+
+def partitions(connection) -> list:
+    """Returns (name, bound) of every partition, where bound is its FOR VALUES clause"""
+    return _execute(
+        connection,
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname",
+        table=TABLE,
+    ).all()
+
+
+def _lock(connection):
+    """Waits for the other processes changing the partitions, until the transaction ends"""
+    _execute(connection, "SELECT pg_advisory_xact_lock(hashtext(:name))", name=f"{TABLE}_partitions")
+
+
+def _convert(connection):
+    """Turns the promotion table into the default partition of a partitioned table"""
+    logger.info("Partitioning the %s table by end_date", TABLE)
+    sequence = _execute(connection, "SELECT pg_get_serial_sequence(:table, 'id')", table=TABLE).scalar()
+    _execute(connection, f"ALTER TABLE {TABLE} RENAME TO {DEFAULT_PARTITION}")
+    # the partitioned table takes over the names of the indexes and triggers
+    indexes = _execute(
+        connection,
+        "SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexname <> :primary_key",
+        table=DEFAULT_PARTITION,
+        primary_key=f"{TABLE}_pkey",
+    ).scalars()
+    for index in indexes:
+        _execute(connection, f"ALTER INDEX {index} RENAME TO {index}_default")
+    for operation in ("insert", "update", "delete"):
+        _execute(connection, f"DROP TRIGGER IF EXISTS {TABLE}_{operation}_notify ON {DEFAULT_PARTITION}")
+    _execute(connection, f"ALTER TABLE {DEFAULT_PARTITION} DROP CONSTRAINT {TABLE}_pkey")
+
+    # unique constraints of a partitioned table must include the partition key
+    _execute(connection, f"CREATE TABLE {TABLE} (LIKE {DEFAULT_PARTITION} INCLUDING DEFAULTS) PARTITION BY RANGE (end_date)")
+    _execute(connection, f"ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, end_date)")
+    _execute(connection, f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id")
+    _execute(connection, f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT")
+    table = Promotion.__table__
+    for index in table.indexes:
+        index.create(connection)
+    create_search_indexes(table, connection)
+    create_change_triggers(table, connection)
+
+
+def create_partition(connection, month: date) -> str:
+    """
+    Creates the partition of a month, moving its rows out of the default partition
+
+    The partition is filled before it is attached, so its indexes are
+    built once over the moved rows.
+    """
+    name = partition_name(month)
+    lower, upper = month.isoformat(), month_start(month, 1).isoformat()
+    _execute(connection, f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)")
+    moved = _execute(
+        connection,
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE end_date >= :lower AND end_date < :upper RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved",
+        lower=lower,
+        upper=upper,
+    ).rowcount
+    _execute(connection, f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{lower}') TO ('{upper}')")
+    logger.info("Created partition %s with %d promotions", name, moved)
+    return name
+
+
+def ensure_partitions(today=None, months_ahead=DEFAULT_MONTHS_AHEAD) -> list:
+    """
+    Partitions the promotion table if needed and creates the missing partitions
+
+    Partitions are created for this month, the months_ahead next ones and
+    every month that has Promotions left in the default partition.
+
+    Returns:
+        list: the names of the partitions that were created
+    """
+    if db.engine.dialect.name != "postgresql":
+        logger.warning("Promotion partitioning needs PostgreSQL")
+        return []
+    today = today or date.today()
+    created = []
+    with db.engine.begin() as connection:
+        # workers and replicas starting together must not create the same partitions
+        _lock(connection)
+        if not is_partitioned(connection):
+            _convert(connection)
+        existing = {name for name, _ in partitions(connection)}
+        stragglers = _execute(
+            connection, f"SELECT DISTINCT CAST(date_trunc('month', end_date) AS date) FROM {DEFAULT_PARTITION}"
+        ).scalars()
+        months = {month_start(today, months) for months in range(months_ahead + 1)} | set(stragglers)
+        for month in sorted(months):
+            if partition_name(month) not in existing:
+                created.append(create_partition(connection, month))
+    return created
+
+
+def drop_partitions(before: date, detach=False) -> list:
+    """
+    Removes the monthly partitions that ended on or before a date
+
+    Partitions emptied by the archive are dropped. With detach, the ones
+    still holding Promotions are detached and kept as standalone tables
+    named <partition>_detached, leaving a tombstone for each of their
+    Promotions; otherwise they stay.
+
+    Returns:
+        list: the names of the partitions that were removed
+    """
+    removed = []
+    detached = False
+    with db.engine.begin() as connection:
+        _lock(connection)
+        for name, bound in partitions(connection):
+            if name == DEFAULT_PARTITION:
+                continue
+            upper = date.fromisoformat(bound.rsplit("'", 2)[-2])
+            if upper > before:
+                continue
+            empty = _execute(connection, f"SELECT NOT EXISTS (SELECT 1 FROM {name})").scalar()
+            if not (empty or detach):
+                continue
+            if not empty:
+                _execute(
+                    connection,
+                    f"INSERT INTO promotion_tombstone (id, deleted_at) SELECT id, now() FROM {name} "
+                    "ON CONFLICT (id) DO UPDATE SET deleted_at = excluded.deleted_at",
+                )
+            _execute(connection, f"ALTER TABLE {TABLE} DETACH PARTITION {name}")
+            if empty:
+                _execute(connection, f"DROP TABLE {name}")
+            else:
+                # frees the name for Promotions that end in that month again
+                _execute(connection, f"ALTER TABLE {name} RENAME TO {name}_detached")
+            logger.info("%s partition %s", "Dropped" if empty else "Detached", name)
+            removed.append(name)
+            detached = detached or not empty
+    if detached:
+        promotions_changed.send(Promotion, op="delete", ids=None)
+    return removed
+
+
+def init_app(app):
+    """Partitions the promotion table when PROMOTION_PARTITIONING is set"""
+    if not app.config.get("PROMOTION_PARTITIONING"):
+        return []
+    return ensure_partitions(months_ahead=app.config.get("PARTITION_MONTHS_AHEAD", DEFAULT_MONTHS_AHEAD))
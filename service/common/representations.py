@@ -0,0 +1,81 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+MessagePack Representation
+
+Lets API clients exchange MessagePack instead of JSON, which is smaller and
+cheaper to encode and decode for service-to-service calls. Responses are
+encoded as MessagePack when the Accept header prefers application/msgpack,
+with the same fields as the JSON ones, and request bodies are decoded from
+MessagePack when they are sent with that Content-Type.
+"""
+from functools import wraps
+
+import msgpack
+from flask import Request, make_response
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+BODY_TYPES = (JSON_TYPE, MSGPACK_TYPE)
+
+
+def output_msgpack(data, code, headers=None):
+    """Makes a Flask response with a MessagePack encoded body"""
+    response = make_response(msgpack.packb(data, default=str), code)
+    response.headers.extend(headers or {})
+    return response
+
+
+def varying(output):
+    """Marks the responses of a representation as depending on the Accept header"""
+
+    @wraps(output)
+    def represent(data, code, headers=None):
+        response = output(data, code, headers)
+        response.vary.add("Accept")
+        return response
+
+    return represent
+
+
+class MessagePackRequest(Request):
+    """A request that also decodes MessagePack bodies from get_json()"""
+
+    _cached_msgpack = None
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype != MSGPACK_TYPE:
+            return super().get_json(force=force, silent=silent, cache=cache)
+        if self._cached_msgpack is not None:
+            return self._cached_msgpack
+        try:
+            data = msgpack.unpackb(self.get_data(cache=cache))
+        except (ValueError, msgpack.UnpackException) as error:
+            if silent:
+                return None
+            return self.on_json_loading_failed(error)
+        if cache:
+            self._cached_msgpack = data
+        return data
+
+
+def init_app(app, api):
+    """Adds the MessagePack representation to an API"""
+    representations = api.representations
+    for mediatype, output in list(representations.items()):
+        representations[mediatype] = varying(output)
+    representations[MSGPACK_TYPE] = varying(output_msgpack)
+    app.request_class = MessagePackRequest
@@ -0,0 +1,288 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Background Jobs
+
+Housekeeping jobs that keep Promotion validity in step with its dates:
+promotions are invalidated once they end and validated when they start.
+The tombstones the change feed no longer serves are pruned.
+When sharded, they work on every shard in parallel.
+Each job can be run once from the Flask CLI or from a daemon thread
+started by create_app().
+"""
+import functools
+import heapq
+import logging
+import threading
+from datetime import datetime, time, timedelta
+
+from service.common import sharding
+from service.models import db, Promotion, PromotionTombstone, promotions_changed
+
+logger = logging.getLogger("flask.app")
+
+
+def _on_every_shard(func, *args) -> list:
+    """Returns the results of func on every shard, or on the database when not sharded"""
+    router = sharding.get_router()
+    if router is None:
+        return [func(*args)]
+    return list(router.scatter(func, *args).values())
+
+
+def _run_batches(func, batch_size, today, report, message):
+    """Calls a batch function on every shard until it has nothing left to do"""
+    return sum(_on_every_shard(_drain, func, batch_size, today, report, message))
+
+
+def _drain(func, batch_size, today, report, message):
+    total = 0
+    while True:
+        ids = func(today, limit=batch_size)
+        if not ids:
+            break
+        total += len(ids)
+        logger.info(message, len(ids), ids)
+        if report:
+            report(ids)
+    return total
+
+
+def sweep_expired(batch_size=1000, today=None, report=None):
+    """
+    Invalidates every valid Promotion whose end_date has passed
+
+    Works in batches of set-based UPDATEs, each in its own short
+    transaction, until nothing is left to expire.
+
+    Args:
+        batch_size (int): the number of Promotions invalidated per transaction
+        today (date): the current date (defaults to date.today())
+        report (callable): called with the list of ids of every batch
+
+    Returns:
+        int: the number of Promotions invalidated
+    """
+    return _run_batches(
+        Promotion.invalidate_expired, batch_size, today, report, "Invalidated %d expired promotions: %s"
+    )
+
+
+def activate_started(batch_size=1000, today=None, report=None):
+    """
+    Validates every scheduled Promotion whose start_date has come
+
+    Takes the same arguments and returns the same total as sweep_expired()
+    """
+    return _run_batches(
+        Promotion.activate_started, batch_size, today, report, "Activated %d scheduled promotions: %s"
+    )
+
+
+def archive_expired(batch_size=1000, before=None, report=None):
+    """
+    Moves every Promotion that ended before a date to the archive
+
+    Takes the same arguments and returns the same total as sweep_expired(),
+    with before (defaults to date.today()) as the cutoff
+    """
+    return _run_batches(Promotion.archive_expired, batch_size, before, report, "Archived %d expired promotions: %s")
+
+
+def prune_tombstones(before, batch_size=1000, report=None):
+    """
+    Deletes the tombstones of the Promotions deleted before a time
+
+    Change feed cursors older than CHANGE_FEED_RETENTION_DAYS are refused,
+    so no reader needs the tombstones recorded before them. Takes the same
+    arguments and returns the same total as sweep_expired(), with before
+    (a datetime) as the cutoff
+    """
+    return _run_batches(PromotionTombstone.prune, batch_size, before, report, "Pruned %d promotion tombstones: %s")
+
+
+class PeriodicJob(threading.Thread):
+    """Runs a function inside the application context every interval seconds"""
+
+    def __init__(self, app, name, interval, func):
+        super().__init__(name=name, daemon=True)
+        self.app = app
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """Runs the job a single time, logging instead of raising errors"""
+        with self.app.app_context():
+            try:
+                return self.func()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Background job %s failed", self.name)
+                return None
+            finally:
+                db.session.remove()
+
+    def stop(self):
+        """Asks the job to stop after the current run"""
+        self._stopped.set()
+
+
+class ActivationScheduler(threading.Thread):
+    """
+    Validates Promotions as soon as their start_date begins
+
+    Upcoming activations are held in a min-heap of (due, id) loaded from
+    the database, so the thread sleeps until the next boundary instead of
+    polling. The heap is reloaded every reload_interval seconds, which also
+    catches up on anything missed while the service was down, and the
+    Promotions written through promotions_changed are scheduled at once.
+    """
+
+    # pylint: disable=too-many-arguments, too-many-instance-attributes
+    def __init__(self, app, reload_interval=300, horizon_days=2, batch_size=1000, clock=datetime.now):
+        super().__init__(name="activation-scheduler", daemon=True)
+        self.app = app
+        self.reload_interval = reload_interval
+        self.horizon = timedelta(days=horizon_days)
+        self.batch_size = batch_size
+        self.clock = clock
+        self._heap = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._next_reload = None
+        promotions_changed.connect(self.changed)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, promotion_id, start_date):
+        """Adds an activation at the beginning of start_date"""
+        with self._lock:
+            heapq.heappush(self._heap, (datetime.combine(start_date, time.min), promotion_id))
+        self._wakeup.set()
+
+    def changed(self, sender=None, op=None, ids=None, **_kwargs):
+        """Schedules written Promotions that start later (connected to promotions_changed)"""
+        if isinstance(sender, Promotion):
+            today = self.clock().date()
+            if op != "delete" and sender.scheduled and today < sender.start_date <= today + self.horizon:
+                self.schedule(sender.id, sender.start_date)
+        elif ids is None:
+            # an import or a bulk delete changed any number of Promotions
+            self._next_reload = None
+            self._wakeup.set()
+
+    def reload(self):
+        """Replaces the heap with the activations within the horizon"""
+        now = self.clock()
+        shards = _on_every_shard(Promotion.upcoming_activations, now.date(), now.date() + self.horizon)
+        heap = [
+            (datetime.combine(start_date, time.min), promotion_id) for rows in shards for promotion_id, start_date in rows
+        ]
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+        self._next_reload = now + timedelta(seconds=self.reload_interval)
+        logger.info("Loaded %d upcoming promotion activations", len(heap))
+
+    def pop_due(self, now) -> list:
+        """Removes and returns the ids of every activation due by now"""
+        ids = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                ids.append(heapq.heappop(self._heap)[1])
+        return ids
+
+    def seconds_until_next(self, now) -> float:
+        """Returns how long to sleep until the next activation or reload"""
+        wake = self._next_reload or now
+        with self._lock:
+            if self._heap:
+                wake = min(wake, self._heap[0][0])
+        return max((wake - now).total_seconds(), 0)
+
+    def tick(self) -> int:
+        """Reloads when due and fires every activation whose time has come"""
+        with self.app.app_context():
+            now = self.clock()
+            try:
+                reloading = self._next_reload is None or now >= self._next_reload
+                if reloading:
+                    self.reload()
+                due = self.pop_due(now)
+                if not (due or reloading):
+                    return 0
+                return activate_started(self.batch_size, today=now.date())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Promotion activation failed")
+                # retry with a full reload, which also catches up on missed activations
+                self._next_reload = now + timedelta(seconds=self.reload_interval)
+                return 0
+            finally:
+                db.session.remove()
+
+    def run(self):
+        while not self._stopped:
+            self.tick()
+            self._wakeup.wait(self.seconds_until_next(self.clock()))
+            self._wakeup.clear()
+
+    def stop(self):
+        """Asks the scheduler to stop"""
+        self._stopped = True
+        self._wakeup.set()
+
+
+def start_jobs(app) -> list:
+    """Starts the background jobs enabled in the configuration"""
+    jobs = []
+    interval = app.config.get("EXPIRY_SWEEP_INTERVAL", 0)
+    if interval > 0:
+        batch_size = app.config.get("EXPIRY_SWEEP_BATCH_SIZE", 1000)
+        jobs.append(PeriodicJob(app, "expiry-sweeper", interval, lambda: sweep_expired(batch_size)))
+    interval = app.config.get("PARTITION_MAINTENANCE_INTERVAL", 0)
+    if interval > 0 and app.config.get("PROMOTION_PARTITIONING", False):
+        # pylint: disable=import-outside-toplevel
+        from service.common import partitioning
+
+        months_ahead = app.config.get("PARTITION_MONTHS_AHEAD", partitioning.DEFAULT_MONTHS_AHEAD)
+        maintain = functools.partial(partitioning.ensure_partitions, months_ahead=months_ahead)
+        jobs.append(PeriodicJob(app, "partition-maintenance", interval, maintain))
+    interval = app.config.get("TOMBSTONE_PRUNE_INTERVAL", 0)
+    retention = timedelta(days=app.config.get("CHANGE_FEED_RETENTION_DAYS", 0))
+    if interval > 0 and retention:
+        jobs.append(PeriodicJob(app, "tombstone-pruner", interval, lambda: prune_tombstones(datetime.now() - retention)))
+    store = app.extensions.get("promotion_snapshot")
+    if store is not None:
+        interval = app.config["SNAPSHOT_REFRESH_INTERVAL"]
+        jobs.append(PeriodicJob(app, "snapshot-refresh", interval, store.refresh))
+    if app.config.get("ACTIVATION_SCHEDULER_ENABLED", False):
+        jobs.append(
+            ActivationScheduler(
+                app,
+                reload_interval=app.config.get("ACTIVATION_RELOAD_INTERVAL", 300),
+                horizon_days=app.config.get("ACTIVATION_HORIZON_DAYS", 2),
+            )
+        )
+    for job in jobs:
+        logger.info("Starting background job %s", job.name)
+        job.start()
+    return jobs
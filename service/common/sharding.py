@@ -0,0 +1,263 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Product Sharding
+
+Spreads Promotions over several databases by product_id. Each product is
+owned by one shard, chosen by rendezvous hashing over the shard names, so
+adding a shard only moves the products it now wins. The router selects a
+shard for the current context and every Promotion method then runs on it
+unchanged; queries that span products run on every shard in parallel
+and their sorted results are merged.
+
+Shards are named by their position in SHARD_DATABASE_URIS, so new shards
+must be appended. Listing the application database among them lets the
+rebalance move existing Promotions out of it.
+"""
+import hashlib
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import groupby
+
+from flask import current_app
+from sqlalchemy import create_engine, delete, insert, select
+from service.models import db, Promotion, current_shard, upgrade_schema
+
+logger = logging.getLogger("flask.app")
+
+EXTENSION = "promotion_shards"
+# The most shards there can ever be: each shard hands out the ids of its own
+# residue modulo ID_STRIDE, so ids stay unique when Promotions move
+ID_STRIDE = 64
+
+
+def _weight(name, product_id) -> int:
+    digest = hashlib.blake2b(f"{name}/{product_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _exists(promotion_id) -> bool:
+    return Promotion.find(promotion_id) is not None
+
+
+def sort_key(values) -> tuple:
+    """Orders a row of sort values like PostgreSQL does, with NULLs last"""
+    return tuple((value is None, value) for value in values)
+
+
+class ShardRouter:
+    """Routes Promotions to the database that owns their product"""
+
+    def __init__(self, app, uris):
+        if not uris or len(uris) > ID_STRIDE:
+            raise ValueError(f"Sharding needs between 1 and {ID_STRIDE} database URIs")
+        self.app = app
+        options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+        self.engines = {f"shard-{index}": create_engine(uri, **options) for index, uri in enumerate(uris)}
+        self.executor = ThreadPoolExecutor(max_workers=len(self.engines), thread_name_prefix="shard")
+
+    @property
+    def names(self) -> list:
+        """The names of the shards, in configuration order"""
+        return list(self.engines)
+
+    def owner(self, product_id) -> str:
+        """Returns the name of the shard that owns a product"""
+        return max(self.engines, key=lambda name: _weight(name, product_id))
+
+    @contextmanager
+    def using(self, name):
+        """Sends every statement of the session to one shard
+
+        The session is closed on the way in and out so that no object or
+        transaction crosses shards; committed objects stay readable.
+        """
+        db.session.remove()
+        token = current_shard.set(self.engines[name])
+        try:
+            yield self.engines[name]
+        finally:
+            db.session.remove()
+            current_shard.reset(token)
+
+    def _run_on(self, name, func, args):
+        with self.app.app_context(), self.using(name):
+            return func(*args)
+
+    def scatter(self, func, *args) -> dict:
+        """Calls func on every shard in parallel and returns the results by shard name"""
+        futures = {name: self.executor.submit(self._run_on, name, func, args) for name in self.engines}
+        return {name: future.result() for name, future in futures.items()}
+
+    def gather(self, build, key, limit=None) -> list:
+        """
+        Runs a query on every shard and merges the results
+
+        Args:
+            build (callable): returns the query, sorted by key, in the shard session
+            key (callable): the sort key of a result, which must identify it
+            limit (int): the most results needed, fetched from every shard
+
+        Returns:
+            list: the results in key order, without the duplicates a
+            rebalance leaves behind for a moment
+        """
+
+        def fetch():
+            query = build()
+            return (query if limit is None else query.limit(limit)).all()
+
+        merged = heapq.merge(*self.scatter(fetch).values(), key=key)
+        results = [next(duplicates) for _, duplicates in groupby(merged, key=key)]
+        return results if limit is None else results[:limit]
+
+    def home(self, promotion_id):
+        """Returns the name of the shard that handed out a Promotion id, or None"""
+        index = (promotion_id - 1) % ID_STRIDE
+        return self.names[index] if index < len(self.engines) else None
+
+    def locate(self, promotion_id):
+        """
+        Returns the name of the shard holding a Promotion, or None
+
+        A Promotion is looked for on the shard that handed out its id first,
+        and on every shard only when it is not there: when it moved with
+        its product, was created before sharding, or does not exist.
+        """
+        home = self.home(promotion_id)
+        if home is not None and self._run_on(home, _exists, (promotion_id,)):
+            return home
+        found = self.scatter(_exists, promotion_id)
+        return next((name for name, exists in found.items() if exists), None)
+
+    ######################################################################
+    #  M A I N T E N A N C E
+    ######################################################################
+
+    def prepare(self):
+        """Creates the tables of every shard and gives each one its own ids"""
+        for index, (name, engine) in enumerate(self.engines.items()):
+            db.metadata.create_all(engine)
+            upgrade_schema(engine)
+            if engine.dialect.name != "postgresql":
+                logger.warning("Promotion ids of shard %s are not unique across shards", name)
+                continue
+            with engine.begin() as connection:
+                sequence = connection.execute(db.text("SELECT pg_get_serial_sequence('promotion', 'id')")).scalar()
+                increment = connection.execute(
+                    db.text("SELECT seqincrement FROM pg_sequence WHERE seqrelid = CAST(:sequence AS regclass)"),
+                    {"sequence": sequence},
+                ).scalar()
+                if increment == ID_STRIDE:
+                    continue
+                start = connection.execute(db.text("SELECT coalesce(max(id), 0) + 1 FROM promotion")).scalar()
+                start += (index + 1 - start) % ID_STRIDE
+                connection.execute(db.text(f"ALTER SEQUENCE {sequence} INCREMENT BY {ID_STRIDE}"))
+                connection.execute(db.text("SELECT setval(:sequence, :start, false)"), {"sequence": sequence, "start": start})
+                logger.info("Shard %s hands out promotion ids from %d by %d", name, start, ID_STRIDE)
+
+    def move(self, source, target, criterion, batch_size=1000) -> int:
+        """
+        Moves the Promotions matching criterion from one shard to another
+
+        Each batch is committed on the target before it is deleted from the
+        source, so an interrupted move leaves copies that the next move or
+        rebalance replaces, and never loses a Promotion.
+
+        Returns:
+            int: the number of Promotions moved
+        """
+        table = Promotion.__table__
+        moved = 0
+        while True:
+            with self.using(source):
+                rows = db.session.execute(
+                    select(table).where(criterion).order_by(table.c.id).limit(batch_size)
+                ).mappings().all()
+            if not rows:
+                return moved
+            ids = [row["id"] for row in rows]
+            with self.using(target):
+                db.session.execute(delete(table).where(table.c.id.in_(ids)))
+                db.session.execute(insert(table), [dict(row) for row in rows])
+                db.session.commit()
+            with self.using(source):
+                db.session.execute(delete(table).where(table.c.id.in_(ids)))
+                db.session.commit()
+            moved += len(rows)
+            logger.info("Moved %d promotions from %s to %s", len(rows), source, target)
+
+    def relocate(self, promotion_id, name):
+        """Moves a Promotion to the owner of its product if it is not there"""
+        with self.using(name):
+            product_id = db.session.execute(select(Promotion.product_id).where(Promotion.id == promotion_id)).scalar()
+        if product_id is not None and self.owner(product_id) != name:
+            self.move(name, self.owner(product_id), Promotion.id == promotion_id)
+
+    def rebalance(self, batch_size=1000, report=None) -> int:
+        """
+        Moves every Promotion to the shard that owns its product
+
+        Args:
+            batch_size (int): the number of Promotions moved per transaction
+            report (callable): called with (source, target, count) after every move
+
+        Returns:
+            int: the number of Promotions moved
+        """
+        total = 0
+        for source in self.engines:
+            with self.using(source):
+                product_ids = db.session.execute(select(Promotion.product_id).distinct()).scalars().all()
+            misplaced = {}
+            for product_id in product_ids:
+                misplaced.setdefault(self.owner(product_id), []).append(product_id)
+            misplaced.pop(source, None)
+            for target, products in misplaced.items():
+                for start in range(0, len(products), batch_size):
+                    criterion = Promotion.product_id.in_(products[start:start + batch_size])
+                    count = self.move(source, target, criterion, batch_size)
+                    total += count
+                    if report:
+                        report(source, target, count)
+        return total
+
+
+def init_app(app):
+    """Shards Promotions over SHARD_DATABASE_URIS when it is configured"""
+    uris = app.config.get("SHARD_DATABASE_URIS")
+    if not uris:
+        return None
+    router = ShardRouter(app, uris)
+    router.prepare()
+    app.extensions[EXTENSION] = router
+    logger.info("Sharding promotions over %d databases", len(uris))
+    return router
+
+
+def get_router():
+    """Returns the router of the current application, or None without sharding"""
+    return current_app.extensions.get(EXTENSION)
+
+
+def on_owner(product_id):
+    """Runs a block on the shard owning a product (on the database without sharding)"""
+    router = get_router()
+    if router is None or product_id is None:
+        return nullcontext()
+    return router.using(router.owner(product_id))
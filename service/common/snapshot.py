@@ -0,0 +1,236 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Active Promotion Snapshot
+
+Holds every Promotion running today in memory, by id and by product, so
+that pricing reads never wait for the database or for a lock. A snapshot
+is never changed: a refresh builds the next one from a copy and swaps it
+in with a single assignment, and readers keep whichever one they started
+with.
+
+A refresh first polls the latest last_updated and deleted_at, and only
+reads the rows changed since the previous refresh, through the same
+settled cursor as the change feed. Writes made by this worker evict their
+Promotions from the snapshot at once, so they are read from the database
+until the refresh that loads them.
+"""
+import logging
+import threading
+from contextlib import nullcontext
+from datetime import date, timedelta
+from types import MappingProxyType
+from typing import NamedTuple
+
+from flask import current_app
+from sqlalchemy import func, select
+from service.common import sharding
+from service.models import db, Promotion, PromotionTombstone, promotions_changed
+
+logger = logging.getLogger("flask.app")
+
+EXTENSION = "promotion_snapshot"
+
+
+class Snapshot(NamedTuple):
+    """The Promotions running on a day, as (serialized, version) by id and ids by product"""
+
+    today: date
+    cursors: dict
+    by_id: MappingProxyType
+    by_product: MappingProxyType
+
+
+def _freeze(today, cursors, by_id) -> Snapshot:
+    by_product = {}
+    for promotion_id in sorted(by_id):
+        by_product.setdefault(by_id[promotion_id][0]["product_id"], []).append(promotion_id)
+    return Snapshot(
+        today,
+        MappingProxyType(dict(cursors)),
+        MappingProxyType(by_id),
+        MappingProxyType({product_id: tuple(ids) for product_id, ids in by_product.items()}),
+    )
+
+
+def _is_active(promotion, today) -> bool:
+    return promotion.validity and promotion.start_date <= today <= promotion.end_date
+
+
+def _shards():
+    """Yields (name, context) for every shard, or the database when not sharded"""
+    router = sharding.get_router()
+    if router is None:
+        yield None, nullcontext()
+        return
+    for name in router.names:
+        yield name, router.using(name)
+
+
+class PromotionSnapshot:
+    """
+    Serves the active Promotions from an immutable snapshot refreshed in place
+
+    Args:
+        settle (int): seconds a change must have committed for before it is loaded
+        batch_size (int): the number of changes read per query
+        clock (callable): returns today's date
+    """
+
+    def __init__(self, settle=0, batch_size=1000, clock=date.today):
+        self.settle = settle
+        self.batch_size = batch_size
+        self.clock = clock
+        self.refreshes = 0
+        self._snapshot = None
+        self._evicted = []
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        promotions_changed.connect(self.evict)
+
+    @property
+    def loaded(self) -> bool:
+        """Tells whether there is a snapshot to read from"""
+        return self._snapshot is not None
+
+    def get(self, promotion_id):
+        """Returns the (serialized, version) of an active Promotion, or None to read it from the database"""
+        snapshot = self._snapshot
+        return None if snapshot is None else snapshot.by_id.get(promotion_id)
+
+    def for_product(self, product_id=None):
+        """Returns the serialized active Promotions of a product (of every product without one), or None"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        if product_id is None:
+            ids = sorted(snapshot.by_id)
+        else:
+            ids = snapshot.by_product.get(product_id, ())
+        return [snapshot.by_id[promotion_id][0] for promotion_id in ids]
+
+    def evict(self, _sender=None, ids=None, **_kwargs):
+        """Drops written Promotions from the snapshot (connected to promotions_changed)"""
+        with self._lock:
+            snapshot = self._snapshot
+            self._evicted.append(ids)
+            if snapshot is None:
+                return
+            if ids is None:
+                self._snapshot = None
+                return
+            if any(promotion_id in snapshot.by_id for promotion_id in ids):
+                by_id = {key: value for key, value in snapshot.by_id.items() if key not in ids}
+                self._snapshot = _freeze(snapshot.today, snapshot.cursors, by_id)
+
+    ######################################################################
+    #  R E F R E S H
+    ######################################################################
+
+    def refresh(self) -> bool:
+        """
+        Loads the changes since the last refresh into a new snapshot
+
+        Everything is loaded again when there is no snapshot yet or the day
+        changed, since Promotions start and end at midnight without a write.
+
+        Returns:
+            bool: True when a new snapshot was swapped in
+        """
+        with self._refreshing:
+            with self._lock:
+                base = self._snapshot
+                evictions = len(self._evicted)
+            try:
+                return self._refresh(base, evictions)
+            finally:
+                with self._lock:
+                    # the next refresh only needs the writes made while it runs
+                    self._evicted = self._evicted[evictions:]
+
+    def _refresh(self, base, evictions) -> bool:
+        today = self.clock()
+        if base is None or base.today != today:
+            by_id, cursors = self._load_all(today)
+        else:
+            by_id, cursors = self._load_changes(base, today)
+            if by_id is None:
+                return False
+        with self._lock:
+            # writes during the refresh may not be in what was just read
+            for ids in self._evicted[evictions:]:
+                if ids is None:
+                    self._snapshot = None
+                    return False
+                for promotion_id in ids:
+                    by_id.pop(promotion_id, None)
+            self._snapshot = _freeze(today, cursors, by_id)
+        self.refreshes += 1
+        logger.info("Promotion snapshot holds %d active promotions", len(by_id))
+        return True
+
+    def _load_all(self, today):
+        by_id, cursors = {}, {}
+        for name, context in _shards():
+            with context:
+                horizon = db.session.execute(select(func.localtimestamp() - timedelta(seconds=self.settle))).scalar()
+                active = Promotion.query.filter(
+                    Promotion.validity, Promotion.start_date <= today, Promotion.end_date >= today
+                )
+                by_id.update((promotion.id, (promotion.serialize(), promotion.version)) for promotion in active)
+                cursors[name] = (horizon, 0)
+                db.session.commit()
+        return by_id, cursors
+
+    def _load_changes(self, base, today):
+        """Returns the (by_id, cursors) with the changes since base, or (None, None) without any"""
+        by_id, cursors = None, dict(base.cursors)
+        for name, context in _shards():
+            with context:
+                latest = db.session.execute(
+                    select(func.max(Promotion.last_updated), select(func.max(PromotionTombstone.deleted_at)).scalar_subquery())
+                ).one()
+                if all(timestamp is None or timestamp < cursors[name][0] for timestamp in latest):
+                    db.session.commit()
+                    continue
+                by_id = dict(base.by_id) if by_id is None else by_id
+                while True:
+                    changes = Promotion.changes_since(cursors[name], limit=self.batch_size, settle=self.settle)
+                    for timestamp, promotion_id, promotion in changes:
+                        if promotion is not None and _is_active(promotion, today):
+                            by_id[promotion_id] = (promotion.serialize(), promotion.version)
+                        else:
+                            by_id.pop(promotion_id, None)
+                        cursors[name] = (timestamp, promotion_id)
+                    if len(changes) < self.batch_size:
+                        break
+                db.session.commit()
+        return by_id, cursors
+
+
+def init_app(app):
+    """Loads the snapshot of active Promotions when SNAPSHOT_REFRESH_INTERVAL is set"""
+    if app.config.get("SNAPSHOT_REFRESH_INTERVAL", 0) <= 0:
+        return None
+    store = PromotionSnapshot(settle=app.config.get("CHANGE_FEED_SETTLE_SECONDS", 0))
+    store.refresh()
+    app.extensions[EXTENSION] = store
+    return store
+
+
+def get_snapshot():
+    """Returns the snapshot store of the current application, or None when it is off"""
+    return current_app.extensions.get(EXTENSION)
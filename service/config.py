@@ -3,6 +3,7 @@ Global Configuration for Application
 """
 import os
 import logging
+import tempfile
 
 # Get configuration from environment
 DATABASE_URI = os.getenv(
@@ -15,6 +16,52 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# Comma separated database URIs to shard Promotions across by product_id
+# (new shards must be appended, leave empty to keep everything in DATABASE_URI)
+SHARD_DATABASE_URIS = [uri for uri in os.getenv("SHARD_DATABASE_URIS", "").split(",") if uri]
+
+# Range partitions the promotion table by month of end_date (PostgreSQL only),
+# keeping PARTITION_MONTHS_AHEAD months of partitions ready
+PROMOTION_PARTITIONING = os.getenv("PROMOTION_PARTITIONING", "false").lower() == "true"
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
+
+# Background jobs (an interval of 0 disables the job)
+EXPIRY_SWEEP_INTERVAL = int(os.getenv("EXPIRY_SWEEP_INTERVAL", "0"))
+EXPIRY_SWEEP_BATCH_SIZE = int(os.getenv("EXPIRY_SWEEP_BATCH_SIZE", "1000"))
+ACTIVATION_SCHEDULER_ENABLED = os.getenv("ACTIVATION_SCHEDULER_ENABLED", "false").lower() == "true"
+ACTIVATION_RELOAD_INTERVAL = int(os.getenv("ACTIVATION_RELOAD_INTERVAL", "300"))
+ACTIVATION_HORIZON_DAYS = int(os.getenv("ACTIVATION_HORIZON_DAYS", "2"))
+PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "0"))
+TOMBSTONE_PRUNE_INTERVAL = int(os.getenv("TOMBSTONE_PRUNE_INTERVAL", "0"))
+
+# Seconds the cached promotion stats and lists are kept when no write is seen
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "300"))
+LIST_CACHE_TTL = int(os.getenv("LIST_CACHE_TTL", "30"))
+# Directory (in shared memory) where the workers share cached responses, empty to keep them per worker
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "/dev/shm/promotion-cache" if os.path.isdir("/dev/shm") else "")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+
+# Failed (or slower than DATABASE_BREAKER_SLOW_SECONDS, 0 for no limit) database reads
+# in a row that stop reads for DATABASE_BREAKER_RESET_SECONDS, serving their last result
+DATABASE_BREAKER_FAILURES = int(os.getenv("DATABASE_BREAKER_FAILURES", "5"))
+DATABASE_BREAKER_RESET_SECONDS = float(os.getenv("DATABASE_BREAKER_RESET_SECONDS", "30"))
+DATABASE_BREAKER_SLOW_SECONDS = float(os.getenv("DATABASE_BREAKER_SLOW_SECONDS", "0"))
+STALE_READS_MAX_ENTRIES = int(os.getenv("STALE_READS_MAX_ENTRIES", "1024"))
+
+# Seconds between refreshes of the in-memory snapshot of active promotions (0 to read them from the database)
+SNAPSHOT_REFRESH_INTERVAL = int(os.getenv("SNAPSHOT_REFRESH_INTERVAL", "0"))
+
+# Seconds a change must have been committed for before the change feed returns it
+CHANGE_FEED_SETTLE_SECONDS = int(os.getenv("CHANGE_FEED_SETTLE_SECONDS", "2"))
+# Days the change feed keeps deletes for, older cursors must start again (0 to keep them forever)
+CHANGE_FEED_RETENTION_DAYS = int(os.getenv("CHANGE_FEED_RETENTION_DAYS", "30"))
+
+# Seconds between keep-alive comments on idle Server-Sent Events streams
+EVENTS_HEARTBEAT_SECONDS = int(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+
+# Directory where the workers share the hashed and precompressed static files (empty to serve service/static as it is)
+ASSET_DIR = os.getenv("ASSET_DIR", os.path.join(tempfile.gettempdir(), "promotion-assets"))
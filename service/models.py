@@ -14,29 +14,110 @@ start_date (string) - the start date of the sale
 end_date (string) - the end date of the sale
 """
 
-from datetime import date
-from enum import Enum
+import re
+from datetime import date, timedelta
 
 import logging
+from contextvars import ContextVar
+from blinker import Namespace
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import case, delete, event, insert, inspect, literal_column, select, update
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm.exc import StaleDataError
+from promotion_engine.categories import Category
 
 logger = logging.getLogger("flask.app")
 
+# The engine of the shard the current context works on (see service.common.sharding)
+current_shard = ContextVar("current_shard", default=None)
+
+
+class ShardSession(Session):  # pylint: disable=too-many-ancestors
+    """A session that sends every statement to the current shard, when there is one"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = current_shard.get()
+        if bind is None and engine is not None:
+            return engine
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Committed objects keep their values: writes already fetch what the database
+# generated, and a session lives for one request or background job only
+db = SQLAlchemy(session_options={"expire_on_commit": False, "class_": ShardSession})
+
+# Sent after every committed change to Promotions so that caches can be invalidated,
+# with the kind of change as op and the ids of the Promotions (None when unknown)
+signals = Namespace()
+promotions_changed = signals.signal("promotions-changed")
+
+# PostgreSQL NOTIFY channel of committed changes (see create_change_triggers)
+CHANGES_CHANNEL = "promotion_changes"
+# Above this many rows a statement notifies a "reset" instead of every id
+MAX_NOTIFY_IDS = 500
 
 
 class DataValidationError(Exception):
     """Custom Exception with data validation fails"""
 
 
-class Category(Enum):
-    """Enumeration for available Promotion Category"""
+class ConcurrentUpdateError(Exception):
+    """Custom Exception when a Promotion was changed since it was read"""
 
-    UNKNOWN = 0
-    PERCENTAGE_DISCOUNT_X = 1
-    BUY_X_GET_Y_FREE = 2
-    SPEND_X_SAVE_Y = 3
+
+def search_document(name, description):
+    """Returns the full-text search vector of a Promotion (PostgreSQL only)
+
+    Constants are rendered inline so that queries match the expression index.
+    """
+    text = db.func.coalesce(name, literal_column("''")).op("||")(literal_column("' '")).op("||")(description)
+    return db.func.to_tsvector(literal_column("'english'"), text)
+
+
+def date_range(lower, upper):
+    """Returns the closed daterange [lower, upper] (PostgreSQL only)
+
+    Used for the validity period of a Promotion so that range queries match
+    the GiST expression index. A None bound leaves that side unbounded.
+    """
+    lower = db.null() if lower is None else lower
+    upper = db.null() if upper is None else upper
+    return db.func.daterange(lower, upper, literal_column("'[]'"))
+
+
+def _integer(value):
+    """Accepts a JSON integer but not a boolean"""
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(type(value))
+    return value
+
+
+def _string(value):
+    if not isinstance(value, str):
+        raise TypeError(type(value))
+    return value
+
+
+def _boolean(value):
+    if not isinstance(value, bool):
+        raise TypeError(type(value))
+    return value
+
+
+# The fields a merge patch may change, with their converter and whether null is allowed
+PATCH_FIELDS = {
+    "name": (_string, True),
+    "category": (lambda value: Category[_string(value).upper()], False),
+    "discount_x": (_integer, False),
+    "discount_y": (_integer, True),
+    "product_id": (_integer, False),
+    "description": (_string, False),
+    "validity": (_boolean, False),
+    "start_date": (lambda value: date.fromisoformat(_string(value)), False),
+    "end_date": (lambda value: date.fromisoformat(_string(value)), False),
+}
 
 
 class Promotion(db.Model):
@@ -59,12 +140,54 @@ class Promotion(db.Model):
     validity = db.Column(db.Boolean(), nullable=False, default=False)
     start_date = db.Column(db.Date(), nullable=False, default=date.today())
     end_date = db.Column(db.Date(), nullable=False, default=date.today())
+    # Incremented by every change, for optimistic concurrency control
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Whether the scheduler validates the Promotion when its start_date comes
+    scheduled = db.Column(db.Boolean(), nullable=False, default=False, server_default=db.false())
     # Database auditing fields
     created_at = db.Column(db.DateTime, default=db.func.now(), nullable=False)
     last_updated = db.Column(
         db.DateTime, default=db.func.now(), onupdate=db.func.now(), nullable=False
     )
 
+    __table_args__ = (
+        # Keeps the expiry sweep to the valid promotions only
+        db.Index(
+            "ix_promotion_valid_end_date",
+            end_date,
+            postgresql_where=validity,
+            sqlite_where=validity,
+        ),
+        # Finds the upcoming activations of invalid promotions
+        db.Index(
+            "ix_promotion_pending_start_date",
+            start_date,
+            postgresql_where=~validity,
+            sqlite_where=~validity,
+        ),
+        # Full-text search over name and description
+        db.Index(
+            "ix_promotion_search",
+            search_document(name, description),
+            postgresql_using="gin",
+        ).ddl_if(dialect="postgresql"),
+        # Date range queries over the validity period
+        db.Index(
+            "ix_promotion_period",
+            date_range(start_date, end_date),
+            postgresql_using="gist",
+        ).ddl_if(dialect="postgresql"),
+        db.Index("ix_promotion_dates", start_date, end_date).ddl_if(dialect="sqlite"),
+        # Change feed cursor
+        db.Index("ix_promotion_last_updated", last_updated, id),
+        # Prefix search on name (PostgreSQL builds its own in create_search_indexes)
+        db.Index("ix_promotion_name_prefix", db.func.lower(name)).ddl_if(dialect="sqlite"),
+    )
+
+    # UPDATE and DELETE match the version read, so concurrent writes are detected,
+    # and INSERT and UPDATE return the generated timestamps instead of expiring them
+    __mapper_args__ = {"version_id_col": version, "eager_defaults": True}
+
     def __repr__(self):
         return f"<Promotion {self.name} id=[{self.id}]>"
 
@@ -74,6 +197,7 @@ class Promotion(db.Model):
         """
         logger.info("Creating %s", self.name)
         self.id = None  # pylint: disable=invalid-name
+        self.scheduled = self.awaits_start()
         try:
             db.session.add(self)
             db.session.commit()
@@ -81,6 +205,7 @@ class Promotion(db.Model):
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
+        promotions_changed.send(self, op="create", ids=[self.id])
 
     def update(self):
         """
@@ -89,23 +214,80 @@ class Promotion(db.Model):
         if self.id is None:
             raise DataValidationError("Promotion must have an ID before updating")
         logger.info("Saving %s", self.name)
+        promotion_id = self.id
+        self.scheduled = self._rescheduled()
         try:
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.error("Concurrent update of record: %s", promotion_id)
+            raise ConcurrentUpdateError(f"Promotion {promotion_id} was changed by another request") from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        promotions_changed.send(self, op="update", ids=[self.id])
 
     def delete(self):
-        """Removes a Promotion from the data store"""
+        """Removes a Promotion from the data store, leaving a tombstone"""
         logger.info("Deleting %s", self.name)
+        promotion_id = self.id
         try:
             db.session.delete(self)
+            db.session.merge(PromotionTombstone(id=self.id, deleted_at=db.func.now()))
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.error("Concurrent delete of record: %s", promotion_id)
+            raise ConcurrentUpdateError(f"Promotion {promotion_id} was changed by another request") from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        promotions_changed.send(self, op="delete", ids=[self.id])
+
+    def awaits_start(self) -> bool:
+        """Tells whether a new Promotion is to be validated when its start_date comes"""
+        return not self.validity and self.start_date >= date.today()
+
+    def _rescheduled(self) -> bool:
+        """Applies the rule of scheduled_after() to the changes made to this Promotion"""
+        state = inspect(self).attrs
+        was_valid, started_on = (
+            (state[name].history.deleted or state[name].history.unchanged or [getattr(self, name)])[0]
+            for name in ("validity", "start_date")
+        )
+        if self.validity:
+            return False
+        if was_valid:
+            return self.start_date > date.today()
+        if self.start_date != started_on:
+            return self.start_date >= date.today()
+        return self.scheduled
+
+    @classmethod
+    def scheduled_after(cls, validity=None, start_date=None, today=None):
+        """Returns the SQL value of scheduled for an UPDATE
+
+        A Promotion made valid has nothing left to wait for. One made invalid
+        while valid was stopped by hand, so it waits only for a later
+        start_date. An invalid Promotion waits again when its start_date
+        changes, and any other change keeps what it was waiting for.
+
+        Args:
+            validity (bool): the new validity (defaults to the current one)
+            start_date (date): the new start_date (defaults to the current one)
+            today (date): the current date (defaults to date.today())
+        """
+        today = today or date.today()
+        validity = cls.validity if validity is None else db.literal(validity)
+        start_date = cls.start_date if start_date is None else db.literal(start_date)
+        return case(
+            (validity, False),
+            (cls.validity, start_date > today),
+            (start_date != cls.start_date, start_date >= today),
+            else_=cls.scheduled,
+        )
 
     def serialize(self):
         """Serializes a Promotion into a dictionary"""
@@ -184,16 +366,18 @@ class Promotion(db.Model):
 
             if "end_date" in data:
                 if isinstance(data["end_date"], str):
-                    end_date = date.fromisoformat(data["end_date"])
-                    if end_date >= self.start_date:
-                        self.end_date = end_date
-                    else:
-                        raise DataValidationError("Invalid end date before start date")
+                    self.end_date = date.fromisoformat(data["end_date"])
                 else:
                     raise DataValidationError(
                         "Invalid type for string [end_date]: "
                         + str(type(data["end_date"]))
                     )
+
+            # a new Promotion without an end date runs until today, or for its first day when it starts later
+            self.start_date = self.start_date or date.today()
+            self.end_date = self.end_date or max(self.start_date, date.today())
+            if self.end_date < self.start_date:
+                raise DataValidationError("Invalid end date before start date")
         except AttributeError as error:
             raise DataValidationError("Invalid attribute: " + error.args[0]) from error
         except KeyError as error:
@@ -219,6 +403,226 @@ class Promotion(db.Model):
         logger.info("Processing all Promotions")
         return cls.query.all()
 
+    @classmethod
+    def invalidate_expired(cls, today=None, limit=1000):
+        """Invalidates one batch of valid Promotions whose end_date has passed
+
+        Rows already locked by another sweeper are skipped, so several
+        replicas can run this at the same time.
+
+        Args:
+            today (date): the current date (defaults to date.today())
+            limit (int): the maximum number of Promotions to invalidate
+
+        Returns:
+            list: the ids of the Promotions that were invalidated
+        """
+        today = today or date.today()
+        expired = (
+            select(cls.id)
+            .where(cls.validity, cls.end_date < today)
+            .order_by(cls.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        return cls._set_validity_where(expired, False)
+
+    @classmethod
+    def archive_expired(cls, today=None, limit=1000):
+        """Moves one batch of Promotions that ended before today to the archive
+
+        Every archived Promotion leaves a tombstone, so change feed readers
+        drop it like a deleted one.
+
+        Args:
+            today (date): archive the Promotions with an earlier end_date (defaults to date.today())
+            limit (int): the maximum number of Promotions to archive
+
+        Returns:
+            list: the ids of the Promotions that were archived
+        """
+        today = today or date.today()
+        table = cls.__table__
+        try:
+            ids = db.session.execute(
+                select(cls.id)
+                .where(cls.end_date < today)
+                .order_by(cls.end_date, cls.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            if ids:
+                columns = [column for column in table.columns if column.name in PromotionArchive.__table__.c]
+                rows = select(*columns).where(table.c.id.in_(ids))
+                db.session.execute(insert(PromotionArchive.__table__).from_select([column.name for column in columns], rows))
+                db.session.execute(insert(PromotionTombstone.__table__), [{"id": promotion_id} for promotion_id in ids])
+                db.session.execute(delete(table).where(table.c.id.in_(ids)))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error archiving promotions")
+            raise DataValidationError(e) from e
+        if ids:
+            promotions_changed.send(cls, op="delete", ids=ids)
+        return ids
+
+    @classmethod
+    def upcoming_activations(cls, today=None, until=None, limit=10000):
+        """Returns (id, start_date) of scheduled Promotions that start after today
+
+        Args:
+            today (date): the current date (defaults to date.today())
+            until (date): the last start_date to include (defaults to no limit)
+            limit (int): the maximum number of rows to return
+        """
+        today = today or date.today()
+        statement = select(cls.id, cls.start_date).where(
+            ~cls.validity, cls.scheduled, cls.start_date > today, cls.end_date >= cls.start_date
+        )
+        if until is not None:
+            statement = statement.where(cls.start_date <= until)
+        statement = statement.order_by(cls.start_date, cls.id).limit(limit)
+        return db.session.execute(statement).all()
+
+    @classmethod
+    def activate_started(cls, today=None, limit=1000):
+        """Validates one batch of scheduled Promotions whose start_date has come
+
+        Only the Promotions written to wait for their start_date are
+        validated, so promotions that were invalidated by hand are left
+        alone (see scheduled_after()). The conditional UPDATE skips locked
+        rows, so each activation is applied by exactly one of several
+        concurrent schedulers.
+
+        Args:
+            today (date): the current date (defaults to date.today())
+            limit (int): the maximum number of Promotions to validate
+
+        Returns:
+            list: the ids of the Promotions that were validated
+        """
+        today = today or date.today()
+        started = (
+            select(cls.id)
+            .where(
+                ~cls.validity,
+                cls.scheduled,
+                cls.start_date <= today,
+                cls.end_date >= today,
+            )
+            .order_by(cls.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        return cls._set_validity_where(started, True)
+
+    @classmethod
+    def update_where(cls, promotion_id, values, *criteria, versions=None, op="update"):
+        """Changes one Promotion in a single conditional UPDATE ... RETURNING
+
+        Args:
+            promotion_id (int): the id of the Promotion to change
+            values (dict): the new column values
+            criteria: extra conditions the Promotion must meet to be changed
+            versions (list): the versions the Promotion may have (defaults to any)
+            op (str): the kind of change sent with promotions_changed
+
+        Returns:
+            Promotion: the changed Promotion, or None when no row matched
+        """
+        if "scheduled" not in values and values.keys() & {"validity", "start_date"}:
+            values = dict(values, scheduled=cls.scheduled_after(values.get("validity"), values.get("start_date")))
+        statement = (
+            update(cls)
+            .where(cls.id == promotion_id, *criteria)
+            .values(version=cls.version + 1, **values)
+            .returning(cls)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )
+        if versions is not None:
+            statement = statement.where(cls.version.in_(versions))
+        try:
+            promotion = db.session.execute(statement).scalar_one_or_none()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error updating promotion %s", promotion_id)
+            raise DataValidationError(e) from e
+        if promotion is not None:
+            promotions_changed.send(promotion, op=op, ids=[promotion.id])
+        return promotion
+
+    @classmethod
+    def patch_values(cls, patch):
+        """Validates a JSON merge patch and returns the column values it changes
+
+        Only the fields present in the patch are checked; null removes an
+        optional value and is rejected for the required ones.
+
+        Args:
+            patch (dict): the merge patch, as in RFC 7396
+
+        Returns:
+            dict: the new column values, for update_where()
+        """
+        if not isinstance(patch, dict) or not patch:
+            raise DataValidationError("Invalid patch: body of request must be a non-empty JSON object")
+        unknown = sorted(set(patch) - set(PATCH_FIELDS))
+        if unknown:
+            raise DataValidationError(f"Invalid patch: cannot change {', '.join(unknown)}")
+        values = {}
+        for field, value in patch.items():
+            convert, nullable = PATCH_FIELDS[field]
+            if value is None and nullable:
+                values[field] = None
+                continue
+            try:
+                values[field] = convert(value)
+            except (KeyError, TypeError, ValueError) as error:
+                raise DataValidationError(f"Invalid value for [{field}]: {value!r}") from error
+        if values.keys() >= {"start_date", "end_date"} and values["end_date"] < values["start_date"]:
+            raise DataValidationError("Invalid end date before start date")
+        return values
+
+    @classmethod
+    def period_criteria(cls, values) -> list:
+        """Returns the conditions that keep a patched period in order
+
+        A patch that changes only one of the dates is checked against the
+        other date in the UPDATE itself, so no row needs to be read first.
+        """
+        if "end_date" in values and "start_date" not in values:
+            return [cls.start_date <= values["end_date"]]
+        if "start_date" in values and "end_date" not in values:
+            return [cls.end_date >= values["start_date"]]
+        return []
+
+    @classmethod
+    def _set_validity_where(cls, selection, validity):
+        """Sets validity on the rows picked by selection and returns their ids
+
+        The selection is a CTE so that it runs exactly once; as an IN
+        subquery the planner may rescan it and go past its LIMIT.
+        """
+        picked = selection.cte("picked")
+        statement = (
+            update(cls)
+            .where(cls.id == picked.c.id)
+            .values(validity=validity, scheduled=False, version=cls.version + 1)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )
+        try:
+            ids = db.session.execute(statement).scalars().all()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error changing validity of promotions")
+            raise DataValidationError(e) from e
+        if ids:
+            promotions_changed.send(cls, op="validity", ids=ids)
+        return ids
+
     @classmethod
     def remove_all(cls):
         """Removes all documents from the database (use for testing)"""
@@ -231,6 +635,228 @@ class Promotion(db.Model):
         logger.info("Processing lookup for id %s ...", by_id)
         return cls.query.session.get(cls, by_id)
 
+    @classmethod
+    def filter_criteria(  # pylint: disable=too-many-arguments
+        cls,
+        name=None,
+        category=None,
+        validity=None,
+        product_id=None,
+        start_date=None,
+        end_date=None,
+        **ranges,
+    ):
+        """Returns the SQL criteria matching every filter that is not None
+
+        Args:
+            name (string): the name of the Promotions you want to match
+            category (Category): the category of the Promotions you want to match
+            validity (boolean): the validity of the Promotions you want to match
+            product_id (int): the product_id of the Promotions you want to match
+            start_date (date): the start_date of the Promotions you want to match
+            end_date (date): the end_date of the Promotions you want to match
+            ranges: any of the keyword arguments accepted by date_range_criteria
+        """
+        filters = {
+            cls.name: name,
+            cls.category: category,
+            cls.validity: validity,
+            cls.product_id: product_id,
+            cls.start_date: start_date,
+            cls.end_date: end_date,
+        }
+        criteria = [column == value for column, value in filters.items() if value is not None]
+        if any(value is not None for value in ranges.values()):
+            criteria += cls.date_range_criteria(db.engine.dialect.name, **ranges)
+        return criteria
+
+    @classmethod
+    def date_range_criteria(  # pylint: disable=too-many-arguments
+        cls,
+        dialect,
+        active_on=None,
+        starts_after=None,
+        ends_before=None,
+        active_from=None,
+        active_to=None,
+    ):
+        """Returns the SQL criteria of the date range filters that are not None
+
+        On PostgreSQL every filter is written against the daterange of the
+        validity period so that it is served by the GiST index. Other
+        databases compare the dates directly.
+
+        Args:
+            dialect (string): the name of the database dialect
+            active_on (date): match Promotions running on that day
+            starts_after (date): match Promotions starting after that day
+            ends_before (date): match Promotions ending before that day
+            active_from (date): match Promotions running on or after that day
+            active_to (date): match Promotions running on or before that day
+        """
+        if active_from and active_to and active_from > active_to:
+            raise DataValidationError("Invalid date range: active_from is after active_to")
+        criteria = []
+        if dialect == "postgresql":
+            period = date_range(cls.start_date, cls.end_date)
+            if active_on is not None:
+                criteria.append(period.op("@>")(db.cast(active_on, db.Date)))
+            if starts_after is not None:
+                criteria.append(period.op(">>")(date_range(None, db.cast(starts_after, db.Date))))
+            if ends_before is not None:
+                criteria.append(period.op("<<")(date_range(db.cast(ends_before, db.Date), None)))
+            if active_from is not None or active_to is not None:
+                window = date_range(
+                    None if active_from is None else db.cast(active_from, db.Date),
+                    None if active_to is None else db.cast(active_to, db.Date),
+                )
+                criteria.append(period.op("&&")(window))
+            return criteria
+        bounds = (
+            (cls.start_date <= active_on, cls.end_date >= active_on) if active_on is not None else (),
+            (cls.start_date > starts_after,) if starts_after is not None else (),
+            (cls.end_date < ends_before,) if ends_before is not None else (),
+            (cls.end_date >= active_from,) if active_from is not None else (),
+            (cls.start_date <= active_to,) if active_to is not None else (),
+        )
+        return [criterion for group in bounds for criterion in group]
+
+    @classmethod
+    def find_by_filters(cls, **filters):
+        """Returns all Promotions matching every given filter
+
+        Args:
+            filters: any of the keyword arguments accepted by filter_criteria
+        """
+        logger.info("Processing filter query for %s ...", filters)
+        return cls.query.filter(*cls.filter_criteria(**filters))
+
+    @classmethod
+    def changes_since(cls, since=None, limit=100, settle=0):
+        """Returns the Promotions created, updated or deleted after a cursor
+
+        Changes are ordered by (last_updated, id) for Promotions and by
+        (deleted_at, id) for tombstones, and each side is read from its own
+        index before the two are merged. Timestamps are taken when the
+        writing transaction starts, so changes younger than settle seconds
+        are held back until transactions still in flight have committed.
+
+        Args:
+            since (tuple): the (timestamp, id) of the last change already seen
+            limit (int): the maximum number of changes to return
+            settle (int): the number of seconds a change must have committed for
+
+        Returns:
+            list: (timestamp, id, promotion) tuples, where promotion is None for deletes
+        """
+        logger.info("Processing changes since %s ...", since)
+        changed = select(cls).order_by(cls.last_updated, cls.id).limit(limit)
+        deleted = select(PromotionTombstone).order_by(PromotionTombstone.deleted_at, PromotionTombstone.id).limit(limit)
+        if since is not None:
+            changed = changed.where(db.tuple_(cls.last_updated, cls.id) > db.tuple_(*since))
+            deleted = deleted.where(db.tuple_(PromotionTombstone.deleted_at, PromotionTombstone.id) > db.tuple_(*since))
+        if settle:
+            horizon = db.func.localtimestamp() - timedelta(seconds=settle)
+            changed = changed.where(cls.last_updated < horizon)
+            deleted = deleted.where(PromotionTombstone.deleted_at < horizon)
+        changes = [(promotion.last_updated, promotion.id, promotion) for promotion in db.session.scalars(changed)]
+        changes += [(tombstone.deleted_at, tombstone.id, None) for tombstone in db.session.scalars(deleted)]
+        changes.sort(key=lambda change: change[:2])
+        return changes[:limit]
+
+    @classmethod
+    def stats(cls):
+        """Counts Promotions by category, validity and month of start_date
+
+        Returns:
+            list: (category, validity, month, count) rows, where month is "YYYY-MM"
+        """
+        if db.engine.dialect.name == "postgresql":
+            month = db.func.to_char(cls.start_date, "YYYY-MM")
+        else:
+            month = db.func.strftime("%Y-%m", cls.start_date)
+        month = month.label("month")
+        statement = (
+            select(cls.category, cls.validity, month, db.func.count())
+            .group_by(cls.category, cls.validity, month)
+            .order_by(cls.category, cls.validity, month)
+        )
+        logger.info("Processing promotion stats")
+        return db.session.execute(statement).all()
+
+    @classmethod
+    def estimate_count(cls, query):
+        """Returns the planner's estimate of the number of rows of a query
+
+        An unfiltered query is answered from the table statistics in
+        pg_class, anything else from the row estimate of its EXPLAIN plan,
+        so neither reads the table. Returns None on other databases, or
+        when PostgreSQL has no statistics yet.
+
+        Args:
+            query: a Promotion query without LIMIT or OFFSET
+        """
+        if db.engine.dialect.name != "postgresql":
+            return None
+        if query.whereclause is None:
+            reltuples = db.session.execute(
+                db.text("SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+                {"table": cls.__tablename__},
+            ).scalar()
+            if reltuples is not None and reltuples >= 0:
+                return int(reltuples)
+        statement = query.order_by(None).statement
+        sql = statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        plan = db.session.connection().exec_driver_sql(f"EXPLAIN (FORMAT JSON) {sql}").scalar()
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @classmethod
+    def search(cls, text, with_ranking=False, **filters):
+        """Returns Promotions whose name or description match text, best first
+
+        On PostgreSQL every word is matched against the full-text index over
+        name and description (the last word as a prefix, for typeahead), and
+        names starting with text are ranked first. Other databases fall back
+        to an indexed prefix match on the name only.
+
+        Args:
+            text (string): the words to search for
+            with_ranking (bool): return (Promotion, *ranking) rows, to merge searches
+            filters: any of the keyword arguments accepted by filter_criteria
+        """
+        logger.info("Processing search for %s ...", text)
+        criterion, ranking = cls.search_clauses(text, db.engine.dialect.name)
+        if with_ranking:
+            query = db.session.query(cls, *(key.label(f"rank_{index}") for index, key in enumerate(ranking)))
+        else:
+            query = cls.query
+        return query.filter(criterion, *cls.filter_criteria(**filters)).order_by(*ranking)
+
+    @classmethod
+    def search_clauses(cls, text, dialect):
+        """Returns the (criterion, order_by) of a search for the given dialect
+
+        The order_by expressions are all ascending so that they can be selected too.
+        """
+        prefix = text.strip().lower()
+        name = db.func.lower(cls.name)
+        if dialect != "postgresql":
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else "\uffff"
+            return db.and_(name >= prefix, name < upper), (name, cls.id)
+        escaped = re.sub(r"([\\%_])", r"\\\1", prefix)
+        name_match = name.like(escaped + "%")
+        words = re.findall(r"\w+", prefix)
+        if not words:
+            return name_match, (cls.name, cls.id)
+        query = db.func.to_tsquery(literal_column("'english'"), " & ".join(words) + ":*")
+        document = search_document(cls.name, cls.description)
+        ranking = (
+            case((name_match, 0), else_=1),
+            -db.func.ts_rank_cd(document, query),
+            cls.id,
+        )
+        return db.or_(document.op("@@")(query), name_match), ranking
+
     @classmethod
     def find_by_name(cls, name):
         """Returns all Promotions with the given name
@@ -300,3 +926,186 @@ class Promotion(db.Model):
             raise TypeError("Invalid product_id, must be of type int")
         logger.info("Processing product-id query for %d ...", product_id)
         return cls.query.filter(cls.product_id == product_id)
+
+
+class PromotionTombstone(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    Class that records the deletion of a Promotion for the change feed
+    """
+
+    __tablename__ = "promotion_tombstone"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    deleted_at = db.Column(db.DateTime, default=db.func.now(), nullable=False)
+
+    __table_args__ = (db.Index("ix_promotion_tombstone_deleted_at", deleted_at, id),)
+
+    def __repr__(self):
+        return f"<PromotionTombstone id=[{self.id}] deleted_at={self.deleted_at}>"
+
+    @classmethod
+    def prune(cls, before, limit=1000):
+        """Deletes one batch of the tombstones recorded before a cutoff
+
+        Args:
+            before (datetime): delete the tombstones with an earlier deleted_at
+            limit (int): the maximum number of tombstones to delete
+
+        Returns:
+            list: the ids of the Promotions whose tombstones were deleted
+        """
+        try:
+            ids = db.session.execute(
+                select(cls.id)
+                .where(cls.deleted_at < before)
+                .order_by(cls.deleted_at, cls.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            if ids:
+                db.session.execute(delete(cls.__table__).where(cls.id.in_(ids)))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error pruning promotion tombstones")
+            raise DataValidationError(e) from e
+        return ids
+
+
+class PromotionArchive(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    Class that keeps the Promotions that ended long ago out of the promotion table
+
+    The archive has no index besides its primary key, so it stays compact
+    and costs nothing to the queries on current Promotions.
+    """
+
+    __tablename__ = "promotion_archive"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(63))
+    category = db.Column(db.Enum(Category), nullable=False)
+    discount_x = db.Column(db.Integer(), nullable=False)
+    discount_y = db.Column(db.Integer(), nullable=True)
+    product_id = db.Column(db.Integer(), nullable=False)
+    description = db.Column(db.String(256), nullable=False)
+    validity = db.Column(db.Boolean(), nullable=False)
+    start_date = db.Column(db.Date(), nullable=False)
+    end_date = db.Column(db.Date(), nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    last_updated = db.Column(db.DateTime, nullable=False)
+    archived_at = db.Column(db.DateTime, default=db.func.now(), server_default=db.func.now(), nullable=False)
+
+    def __repr__(self):
+        return f"<PromotionArchive {self.name} id=[{self.id}]>"
+
+
+@event.listens_for(Promotion.__table__, "after_create")
+def create_search_indexes(target, connection, **_):
+    """Creates the name prefix index on PostgreSQL
+
+    A trigram index is used when the pg_trgm extension can be installed,
+    otherwise a btree with text_pattern_ops still serves prefix searches.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    try:
+        with connection.begin_nested():
+            connection.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        method = "gin (lower(name) gin_trgm_ops)"
+    except DBAPIError:
+        logger.warning("pg_trgm is not available, using a btree index for name searches")
+        method = "btree (lower(name) text_pattern_ops)"
+    connection.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS ix_promotion_name_prefix ON {target.name} USING {method}")
+
+
+@event.listens_for(Promotion.__table__, "after_create")
+def create_change_triggers(target, connection, **_):
+    """Makes PostgreSQL NOTIFY every committed change to Promotions
+
+    Statement level triggers send one notification per statement on the
+    CHANGES_CHANNEL, with the op and ids of the rows that changed, so bulk
+    statements do not flood the notification queue. Notifications are only
+    delivered when the transaction commits.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+    connection.exec_driver_sql(
+        f"""
+        CREATE OR REPLACE FUNCTION notify_promotion_changes(op text, ids integer[]) RETURNS void AS $$
+        BEGIN
+            IF cardinality(ids) > {MAX_NOTIFY_IDS} THEN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object('op', 'reset', 'ids', NULL)::text);
+            ELSIF cardinality(ids) > 0 THEN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object('op', op, 'ids', ids)::text);
+            END IF;
+        END $$ LANGUAGE plpgsql
+        """
+    )
+    connection.exec_driver_sql(
+        f"""
+        CREATE OR REPLACE FUNCTION {target.name}_changed() RETURNS trigger AS $$
+        DECLARE
+            changed integer[];
+            validated integer[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM notify_promotion_changes('create', ARRAY(SELECT id FROM new_rows));
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM notify_promotion_changes('delete', ARRAY(SELECT id FROM old_rows));
+            ELSE
+                SELECT coalesce(array_agg(n.id) FILTER (WHERE o.validity IS NOT DISTINCT FROM n.validity), '{{}}'),
+                       coalesce(array_agg(n.id) FILTER (WHERE o.validity IS DISTINCT FROM n.validity), '{{}}')
+                  INTO changed, validated
+                  FROM old_rows o JOIN new_rows n ON n.id = o.id;
+                PERFORM notify_promotion_changes('update', changed);
+                PERFORM notify_promotion_changes('validity', validated);
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql
+        """
+    )
+    transitions = {
+        "INSERT": "NEW TABLE AS new_rows",
+        "UPDATE": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+        "DELETE": "OLD TABLE AS old_rows",
+    }
+    for operation, tables in transitions.items():
+        connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {target.name}_{operation.lower()}_notify ON {target.name}")
+        connection.exec_driver_sql(
+            f"CREATE TRIGGER {target.name}_{operation.lower()}_notify AFTER {operation} ON {target.name} "
+            f"REFERENCING {tables} FOR EACH STATEMENT EXECUTE FUNCTION {target.name}_changed()"
+        )
+
+
+def upgrade_schema(engine):
+    """Brings a promotion table created by an earlier release up to date
+
+    db.create_all() never changes a table that exists, so the columns,
+    indexes and triggers added since are installed here. Every step is
+    idempotent, and concurrent upgrades wait for each other. Other
+    databases than PostgreSQL only get the tables of db.create_all().
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    table = Promotion.__table__
+    with engine.begin() as connection:
+        connection.execute(db.text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": f"{table.name}_schema"})
+        connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1")
+        scheduling = "scheduled" not in {column["name"] for column in inspect(connection).get_columns(table.name)}
+        connection.exec_driver_sql(
+            f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS scheduled boolean NOT NULL DEFAULT false"
+        )
+        if scheduling:
+            # what earlier releases activated: invalid Promotions not changed since they started
+            connection.execute(
+                update(table)
+                .where(~table.c.validity, table.c.end_date >= db.func.current_date())
+                .where(table.c.last_updated < table.c.start_date)
+                .values(scheduled=True)
+            )
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+        create_search_indexes(table, connection)
+        create_change_triggers(table, connection)
@@ -22,13 +22,17 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Promotion
 """
 
+import base64
+import json
 from functools import wraps
-from datetime import datetime, date
+from datetime import date, datetime, timedelta
 from flask import current_app as app  # Import Flask application
-from flask import request
+from flask import request, Response
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from service.models import Promotion, Category
-from service.common import status  # HTTP Status Codes
+from service.common import assets, events, representations, sharding, snapshot, status  # HTTP Status Codes
+from service.common.cache import ResultCache, SingleFlight, create_backend, metrics_text
+from service.common.circuit_breaker import DATABASE_ERRORS, CircuitBreaker, CircuitOpenError, StaleFallback, stale_headers
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -43,6 +47,7 @@ api = Api(
     doc="/apidocs",  # default also could use doc='/apidocs/'
     prefix="/api",
 )
+representations.init_app(app, api)
 
 
 ######################################################################
@@ -52,7 +57,19 @@ api = Api(
 def index():
     """Base URL for our service"""
     app.logger.info("Request for Home Page.")
-    return app.send_static_file("index.html")
+    bundle = assets.get_assets()
+    if bundle is None:
+        return app.send_static_file("index.html")
+    return bundle.send_index()
+
+
+@app.route("/assets/<path:filename>")
+def static_asset(filename):
+    """Serves a static file by its hashed name, for browsers to keep"""
+    bundle = assets.get_assets()
+    if bundle is None:
+        return app.send_static_file(filename)
+    return bundle.send(filename)
 
 
 ######################################################################
@@ -65,6 +82,16 @@ def health():
     return ({"status": "OK"}, status.HTTP_200_OK)
 
 
+######################################################################
+# Metrics
+######################################################################
+@app.route("/metrics")
+def metrics():
+    """Cache metrics in the Prometheus text format"""
+    text = metrics_text([list_cache, stats_cache], [promotion_reads]) + stale_reads.metrics_text()
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
 create_model = api.model(
     "Promotion",
     {
@@ -119,7 +146,32 @@ extend_model = api.model(
     },
 )
 
+
+def iso_date(value):
+    """Parses a YYYY-MM-DD query string argument"""
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"{value} is not a valid date (YYYY-MM-DD)") from error
+
+
+def search_text(value):
+    """Parses a search query string argument, a blank one is no search"""
+    return value.strip() or None
+
+
 # query string arguments
+DATE_RANGE_ARGS = {
+    "active_on": "List Promotions running on this date",
+    "starts_after": "List Promotions starting after this date",
+    "ends_before": "List Promotions ending before this date",
+    "active_from": "List Promotions running on or after this date",
+    "active_to": "List Promotions running on or before this date",
+}
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 1000
+EXACT_COUNT_THRESHOLD = 10000
+MERGE_PATCH_TYPE = "application/merge-patch+json"
 promotion_args = reqparse.RequestParser()
 promotion_args.add_argument(
     "name", type=str, location="args", required=False, help="List Promotions by name"
@@ -147,31 +199,66 @@ promotion_args.add_argument(
 )
 promotion_args.add_argument(
     "start_date",
-    type=str,
+    type=iso_date,
     location="args",
     required=False,
     help="List Promotions by start date",
 )
 promotion_args.add_argument(
     "end_date",
-    type=str,
+    type=iso_date,
     location="args",
     required=False,
     help="List Promotions by end date",
 )
+for argument, description in DATE_RANGE_ARGS.items():
+    promotion_args.add_argument(
+        argument, type=iso_date, location="args", required=False, help=description
+    )
+promotion_args.add_argument(
+    "q",
+    type=search_text,
+    location="args",
+    required=False,
+    help="Search Promotions by name and description, best matches first",
+)
+promotion_args.add_argument(
+    "page",
+    type=inputs.positive,
+    location="args",
+    required=False,
+    help="The page of results to return (starting at 1)",
+)
+promotion_args.add_argument(
+    "count",
+    type=str,
+    choices=("exact", "estimated", "auto"),
+    location="args",
+    required=False,
+    help="Return the total number of matches in X-Total-Count: exact, estimated, "
+    f"or auto (exact up to {EXACT_COUNT_THRESHOLD} rows, estimated above)",
+)
+promotion_args.add_argument(
+    "per_page",
+    type=inputs.int_range(1, MAX_PER_PAGE),
+    location="args",
+    required=False,
+    help=f"The number of results per page (default {DEFAULT_PER_PAGE})",
+)
 
 
 ######################################################################
 # Content-Type Decorator
 ######################################################################
-def expect_content_type(expected_type="application/json"):
+def expect_content_type(*expected_types):
     """Decorator to check for expected content-type"""
+    expected_types = expected_types or representations.BODY_TYPES
 
     def decorator(func):
         @wraps(func)
         def decorated(*args, **kwargs):
-            if request.content_type != expected_type:
-                abort(415, f"Content-Type must be {expected_type}")
+            if request.content_type not in expected_types:
+                abort(415, f"Content-Type must be {' or '.join(expected_types)}")
             return func(*args, **kwargs)
 
         return decorated
@@ -179,34 +266,96 @@ def expect_content_type(expected_type="application/json"):
     return decorator
 
 
+######################################################################
+# Sharding Decorator
+######################################################################
+def on_promotion_shard(func):
+    """Runs a resource method on the shard holding the Promotion, when sharded
+
+    A PUT or PATCH that changes the product_id then moves the Promotion to
+    the shard owning its new product. The shard is looked up through the
+    database circuit breaker, so an unreachable shard answers 503.
+    """
+
+    @wraps(func)
+    def decorated(*args, promotion_id, **kwargs):
+        router = sharding.get_router()
+        if router is None or (request.method == "GET" and snapshot_entry(promotion_id)):
+            return func(*args, promotion_id=promotion_id, **kwargs)
+        try:
+            shard = database.call(lambda: router.locate(promotion_id))
+        except DATABASE_ERRORS as error:
+            raise CircuitOpenError(database.retry_in()) from error
+        if shard is None:
+            # deleting a Promotion that does not exist is not an error
+            if request.method == "DELETE" and isinstance(func.__self__, PromotionResource):
+                return "", status.HTTP_204_NO_CONTENT
+            abort(status.HTTP_404_NOT_FOUND, f"Promotion with id '{promotion_id}' was not found.")
+        with router.using(shard):
+            result = func(*args, promotion_id=promotion_id, **kwargs)
+        if request.method in ("PUT", "PATCH"):
+            router.relocate(promotion_id, shard)
+        return result
+
+    return decorated
+
+
+######################################################################
+# Reads fall back on their last result while the database is unavailable
+######################################################################
+database = CircuitBreaker(
+    failure_threshold=app.config.get("DATABASE_BREAKER_FAILURES", 5),
+    reset_timeout=app.config.get("DATABASE_BREAKER_RESET_SECONDS", 30),
+    slow_call_seconds=app.config.get("DATABASE_BREAKER_SLOW_SECONDS", 0),
+)
+stale_reads = StaleFallback(
+    database,
+    app._get_current_object().app_context,  # pylint: disable=protected-access
+    max_entries=app.config.get("STALE_READS_MAX_ENTRIES", 1024),
+)
+
+
 ######################################################################
 #  PATH: /promotions/{id}
 ######################################################################
-@api.route("/promotions/<promotion_id>")
+promotion_reads = SingleFlight("find")
+
+
+@api.route("/promotions/<int:promotion_id>")
 @api.param("promotion_id", "The Promotion identifier")
 class PromotionResource(Resource):
     """
     PromotionResource class
     """
 
+    method_decorators = [on_promotion_shard]
+
     # ------------------------------------------------------------------
     # RETRIEVE A PROMOTION
     # ------------------------------------------------------------------
     @api.doc("get_promotions")
     @api.response(404, "Promotion not found")
+    @api.header("ETag", "The version of the Promotion, for If-Match")
     @api.marshal_with(promotion_model)
     def get(self, promotion_id):
         """
         Retrieve and single promotion
         """
         app.logger.info("Request to Retrieve a promotion with id [%s]", promotion_id)
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
+        entry = snapshot_entry(promotion_id)
+        if entry:
+            data, version = entry
+            return data, status.HTTP_200_OK, {"ETag": f'"{version}"'}
+        found, age = stale_reads.read(
+            ("find", promotion_id), lambda: promotion_reads.do(promotion_id, lambda: read_promotion(promotion_id))
+        )
+        if not found:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id '{promotion_id}' was not found.",
             )
-        return promotion.serialize(), status.HTTP_200_OK
+        data, headers = found
+        return data, status.HTTP_200_OK, {**headers, **stale_headers(age)}
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PROMOTION
@@ -214,7 +363,8 @@ class PromotionResource(Resource):
     @api.doc("update_promotions")
     @api.response(404, "Promotion not found")
     @api.response(400, "The posted Promotion data was not valid")
-    @api.response(415, "Content-Type must be application/json")
+    @api.response(412, "The Promotion was changed since If-Match")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
     @api.expect(promotion_model)
     @expect_content_type()
     @api.marshal_with(promotion_model)
@@ -229,18 +379,50 @@ class PromotionResource(Resource):
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id '{promotion_id}' was not found.",
             )
+        check_if_match(promotion)
         app.logger.debug("Payload = %s", api.payload)
         data = api.payload
         promotion.deserialize(data)
         promotion.id = promotion_id
         promotion.update()
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, etag_headers(promotion)
+
+    # ------------------------------------------------------------------
+    # PATCH AN EXISTING PROMOTION
+    # ------------------------------------------------------------------
+    @api.doc(
+        "patch_promotions",
+        description="Changes only the fields in the body, as a JSON merge patch (RFC 7396)",
+    )
+    @api.response(404, "Promotion not found")
+    @api.response(400, "The patch was not valid")
+    @api.response(412, "The Promotion was changed since If-Match")
+    @api.response(415, "Content-Type must be application/merge-patch+json")
+    @api.expect(create_model)
+    @expect_content_type(MERGE_PATCH_TYPE, "application/json")
+    @api.marshal_with(promotion_model)
+    def patch(self, promotion_id):
+        """
+        Patch a Promotion
+        """
+        app.logger.info("Request to Patch a promotion with id [%s]", promotion_id)
+        app.logger.debug("Payload = %s", api.payload)
+        values = Promotion.patch_values(api.payload)
+        promotion = update_or_abort(
+            promotion_id,
+            values,
+            *Promotion.period_criteria(values),
+            message="Invalid end date before start date",
+            op="validity" if values.keys() == {"validity"} else "update",
+        )
+        return promotion.serialize(), status.HTTP_200_OK, etag_headers(promotion)
 
     # ------------------------------------------------------------------
     # DELETE A Promotion
     # ------------------------------------------------------------------
     @api.doc("delete_promotions")
     @api.response(204, "Promotion deleted")
+    @api.response(412, "The Promotion was changed since If-Match")
     def delete(self, promotion_id):
         """
         Delete a Promotion
@@ -248,6 +430,7 @@ class PromotionResource(Resource):
         app.logger.info("Request to Delete a promotion with id [%s]", promotion_id)
         promotion = Promotion.find(promotion_id)
         if promotion:
+            check_if_match(promotion)
             promotion.delete()
             app.logger.info("Promotion with id [%s] was deleted", promotion_id)
         return "", status.HTTP_204_NO_CONTENT
@@ -256,6 +439,11 @@ class PromotionResource(Resource):
 ######################################################################
 #  PATH: /promotions
 ######################################################################
+response_cache = create_backend(app.config)
+list_cache = ResultCache(ttl=app.config.get("LIST_CACHE_TTL", 30), backend=response_cache, name="list")
+stats_cache = ResultCache(ttl=app.config.get("STATS_CACHE_TTL", 300), backend=response_cache, name="stats")
+
+
 @api.route("/promotions", strict_slashes=False)
 class PromotionCollection(Resource):
     """Handles all interactions with collection of Promotions"""
@@ -265,37 +453,22 @@ class PromotionCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_promotions")
     @api.expect(promotion_args, validate=True)
+    @api.response(304, "The Promotions have not changed")
     @api.marshal_list_with(promotion_model)
     def get(self):
         """Returns all of the Promotions"""
         app.logger.info("Request to list Promotions...")
-        promotions = []
         args = promotion_args.parse_args()
-        if args["name"]:
-            app.logger.info("find by name: %s", args["name"])
-            promotions = Promotion.find_by_name(args["name"])
-        elif args["validity"] is not None:
-            app.logger.info("find by validity: %s", args["validity"])
-            promotions = Promotion.find_by_validity(args["validity"])
-        elif args["category"]:
-            app.logger.info("find by category: %s", args["category"])
-            promotions = Promotion.find_by_category(Category[args["category"].upper()])
-        elif args["start_date"]:
-            app.logger.info("find by start_date: %s", args["start_date"])
-            start_date = datetime.fromisoformat(args["start_date"])
-            promotions = Promotion.find_by_start_date(start_date)
-        elif args["end_date"]:
-            app.logger.info("find by end_date: %s", args["end_date"])
-            end_date = datetime.fromisoformat(args["end_date"])
-            promotions = Promotion.find_by_end_date(end_date)
-        elif args["product_id"]:
-            app.logger.info("find by product_id: %d", args["product_id"])
-            promotions = Promotion.find_by_product_id(int(args["product_id"]))
-        else:
-            promotions = Promotion.all()
-
-        results = [promotion.serialize() for promotion in promotions]
-        return results, status.HTTP_200_OK
+        filters = filters_from_args(args)
+        key = {name: value for name, value in {**args, **filters}.items() if value is not None}
+        (etag, listing), age = stale_reads.read(
+            ("list", json.dumps(key, sort_keys=True, default=str)),
+            lambda: list_cache.get(key, lambda: list_promotions(args, filters)),
+        )
+        headers = {**listing["headers"], "ETag": f'"{etag}"', **stale_headers(age)}
+        if etag in request.if_none_match:
+            return [], status.HTTP_304_NOT_MODIFIED, headers
+        return listing["results"], status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PROMOTION
@@ -304,7 +477,7 @@ class PromotionCollection(Resource):
     @expect_content_type()
     @api.expect(create_model)
     @api.response(400, "The posted data was not valid")
-    @api.response(415, "Content-Type must be application/json")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
     @api.marshal_with(promotion_model)
     def post(self):
         """Creates a Promotion"""
@@ -312,7 +485,8 @@ class PromotionCollection(Resource):
         promotion = Promotion()
         app.logger.debug("Payload = %s", api.payload)
         promotion.deserialize(api.payload)
-        promotion.create()
+        with sharding.on_owner(promotion.product_id):
+            promotion.create()
         app.logger.info("Promotion with new id [%s] created!", promotion.id)
         location_url = api.url_for(
             PromotionResource, promotion_id=promotion.id, _external=True
@@ -320,84 +494,214 @@ class PromotionCollection(Resource):
         return (
             promotion.serialize(),
             status.HTTP_201_CREATED,
-            {"location": location_url},
+            {"location": location_url, **etag_headers(promotion)},
+        )
+
+
+######################################################################
+#  PATH: /promotions/changes
+######################################################################
+def change_cursor(value):
+    """Parses an opaque change feed cursor into (timestamp, id)"""
+    try:
+        timestamp, promotion_id = base64.urlsafe_b64decode(value.encode("ascii")).decode("ascii").split(",")
+        return datetime.fromisoformat(timestamp), int(promotion_id)
+    except (TypeError, ValueError) as error:
+        raise ValueError(f"{value} is not a valid change cursor") from error
+
+
+def encode_cursor(timestamp, promotion_id) -> str:
+    """Builds the opaque change feed cursor of a change"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()},{promotion_id}".encode("ascii")).decode("ascii")
+
+
+change_args = reqparse.RequestParser()
+change_args.add_argument(
+    "since",
+    type=change_cursor,
+    location="args",
+    required=False,
+    help="The cursor returned by the previous call (omit to start from the beginning)",
+)
+change_args.add_argument(
+    "limit",
+    type=inputs.int_range(1, MAX_PER_PAGE),
+    location="args",
+    required=False,
+    help=f"The maximum number of changes to return (default {DEFAULT_PER_PAGE})",
+)
+
+
+@api.route("/promotions/changes")
+class PromotionChanges(Resource):
+    """Incremental feed of the changes to Promotions"""
+
+    @api.doc("list_promotion_changes")
+    @api.expect(change_args, validate=True)
+    @api.response(410, "The cursor is older than CHANGE_FEED_RETENTION_DAYS")
+    def get(self):
+        """Returns the Promotions created, updated or deleted after a cursor"""
+        args = change_args.parse_args()
+        app.logger.info("Request for Promotion changes since %s", args["since"])
+        retention = app.config.get("CHANGE_FEED_RETENTION_DAYS", 0)
+        if args["since"] and retention and args["since"][0] < datetime.now() - timedelta(days=retention):
+            # the tombstones of older deletes may have been pruned
+            abort(status.HTTP_410_GONE, "The cursor has expired, read the changes again without since")
+        changes = Promotion.changes_since(
+            args["since"],
+            limit=args["limit"] or DEFAULT_PER_PAGE,
+            settle=app.config.get("CHANGE_FEED_SETTLE_SECONDS", 0),
         )
+        results = []
+        for timestamp, promotion_id, promotion in changes:
+            if promotion is None:
+                operation = "deleted"
+            else:
+                operation = "created" if promotion.created_at == promotion.last_updated else "updated"
+            results.append(
+                {
+                    "id": promotion_id,
+                    "op": operation,
+                    "changed_at": timestamp.isoformat(),
+                    "promotion": promotion.serialize() if promotion else None,
+                }
+            )
+        if changes:
+            cursor = encode_cursor(*changes[-1][:2])
+        else:
+            cursor = request.args.get("since")
+        return {"changes": results, "cursor": cursor}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/events
+######################################################################
+@api.route("/promotions/events")
+class PromotionEvents(Resource):
+    """Server-Sent Events stream of the changes to Promotions"""
+
+    @api.doc("promotion_events", produces=["text/event-stream"])
+    def get(self):
+        """Streams create, update, delete and validity events as they commit"""
+        app.logger.info("Request for a Promotion event stream")
+        events.broker.listen(app)
+        subscription = events.broker.subscribe()
+        heartbeat = app.config.get("EVENTS_HEARTBEAT_SECONDS", 15)
+        return Response(
+            events.event_stream(events.broker, subscription, heartbeat),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
+######################################################################
+#  PATH: /promotions/stats
+######################################################################
+
+
+@api.route("/promotions/stats")
+class PromotionStats(Resource):
+    """Aggregate counts of Promotions for dashboards"""
+
+    @api.doc("promotion_stats")
+    @api.response(304, "The stats have not changed")
+    def get(self):
+        """Counts Promotions by category, validity and start month"""
+        app.logger.info("Request for Promotion stats")
+        (etag, stats), age = stale_reads.read(("stats",), lambda: stats_cache.get("stats", promotion_stats))
+        headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache", **stale_headers(age)}
+        if etag in request.if_none_match:
+            return "", status.HTTP_304_NOT_MODIFIED, headers
+        return stats, status.HTTP_200_OK, headers
+
+
+######################################################################
+#  PATH: /promotions/active
+######################################################################
+active_args = reqparse.RequestParser()
+active_args.add_argument("product_id", type=int, location="args", required=False, help="List the Promotions of a product")
+
+
+@api.route("/promotions/active")
+class ActivePromotions(Resource):
+    """The Promotions running today, for pricing"""
+
+    @api.doc("active_promotions")
+    @api.expect(active_args, validate=True)
+    @api.marshal_list_with(promotion_model)
+    def get(self):
+        """Returns the valid Promotions running today, from memory when the snapshot is on"""
+        product_id = active_args.parse_args()["product_id"]
+        app.logger.info("Request for the active Promotions of product %s", product_id)
+        store = snapshot.get_snapshot()
+        results = None if store is None else store.for_product(product_id)
+        if results is None:
+            results = active_promotions(product_id)
+        return results, status.HTTP_200_OK
 
 
 ######################################################################
 #  PATH: /promotions/{id}/valid
 ######################################################################
-@api.route("/promotions/<promotion_id>/valid")
+@api.route("/promotions/<int:promotion_id>/valid")
 @api.param("promotion_id", "The promotion identifier")
 class ValidateResource(Resource):
     """Action to make promotion valid/invalid"""
 
+    method_decorators = [on_promotion_shard]
+
     @api.doc("validate_promotions")
     @api.response(404, "Promotion not found")
+    @api.response(412, "The Promotion was changed since If-Match")
     def put(self, promotion_id):
         """Make a Promotion valid"""
         app.logger.info("Request to make Promotion valid")
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Promotion with id '{promotion_id}' was not found.",
-            )
-        promotion.validity = True
-        promotion.update()
+        promotion = update_or_abort(promotion_id, {"validity": True}, op="validity")
         app.logger.info("Promotion with id [%s] has been make valid", promotion.id)
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, etag_headers(promotion)
 
     @api.doc("invalidate_promotions")
     @api.response(404, "Promotion not found")
+    @api.response(412, "The Promotion was changed since If-Match")
     def delete(self, promotion_id):
         """Make a Promotion invalid"""
         app.logger.info("Request ot make Promotion invalid")
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Promotion with id '{promotion_id}' was not found.",
-            )
-        promotion.validity = False
-        promotion.update()
+        promotion = update_or_abort(promotion_id, {"validity": False, "scheduled": False}, op="validity")
         app.logger.info("Promotion with id [%s] has been make invalid", promotion.id)
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, etag_headers(promotion)
 
 
 ######################################################################
 #  PATH: /promotions/{id}/extend
 ######################################################################
-@api.route("/promotions/<promotion_id>/extend")
+@api.route("/promotions/<int:promotion_id>/extend")
 @api.param("promotion_id", "The promotion identifier")
 class ExtendResource(Resource):
     """Action to change the end_date of a Promotion"""
 
+    method_decorators = [on_promotion_shard]
+
     @api.doc("extend_promotions")
     @api.response(400, "The posted data was not valid")
     @api.response(404, "Promotion not found")
-    @api.response(415, "Content-Type must be application/json")
+    @api.response(412, "The Promotion was changed since If-Match")
+    @api.response(415, "Content-Type must be application/json or application/msgpack")
     @api.expect(extend_model, validate=True)
     @expect_content_type()
     @api.marshal_with(promotion_model)
     def put(self, promotion_id):
         """Change the end_date of a Promotion"""
         app.logger.info("Request to change the end_date of promotion")
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"promotion with id '{promotion_id}' was not found.",
-            )
         app.logger.debug("Payload = %s", api.payload)
         data = api.payload
         end_date = date.fromisoformat(data.get("end_date"))
-
-        if end_date < promotion.start_date:
-            abort(status.HTTP_400_BAD_REQUEST, "New end date is before start date")
-        promotion.end_date = end_date
-        promotion.update()
-        return promotion.serialize(), status.HTTP_200_OK
+        promotion = update_or_abort(
+            promotion_id,
+            {"end_date": end_date},
+            Promotion.start_date <= end_date,
+            message="New end date is before start date",
+        )
+        return promotion.serialize(), status.HTTP_200_OK, etag_headers(promotion)
 
 
 ######################################################################
@@ -405,6 +709,182 @@ class ExtendResource(Resource):
 ######################################################################
 
 
+def filters_from_args(args) -> dict:
+    """Converts the list query string arguments into Promotion filters"""
+    filters = {
+        "name": args["name"] or None,
+        "validity": args["validity"],
+        "product_id": args["product_id"],
+    }
+    if args["category"]:
+        filters["category"] = Category[args["category"].upper()]
+    for key in ("start_date", "end_date", *DATE_RANGE_ARGS):
+        filters[key] = args[key]
+    return filters
+
+
+@database.guard
+def promotion_stats() -> dict:
+    """Rolls the grouped Promotion counts up into totals per dimension"""
+    router = sharding.get_router()
+    rows = Promotion.stats() if router is None else sum(router.scatter(Promotion.stats).values(), [])
+    groups = {}
+    for category, validity, month, count in rows:
+        groups[category.name, validity, month] = groups.get((category.name, validity, month), 0) + count
+    stats = {"total": 0, "by_category": {}, "by_validity": {}, "by_month": {}, "groups": []}
+    for (category, validity, month), count in sorted(groups.items()):
+        stats["total"] += count
+        state = "valid" if validity else "invalid"
+        for dimension, value in (("by_category", category), ("by_validity", state), ("by_month", month)):
+            stats[dimension][value] = stats[dimension].get(value, 0) + count
+        stats["groups"].append({"category": category, "validity": validity, "month": month, "count": count})
+    return stats
+
+
+def snapshot_entry(promotion_id):
+    """Returns the (serialized, version) of a Promotion from the snapshot, or None"""
+    store = snapshot.get_snapshot()
+    return None if store is None else store.get(promotion_id)
+
+
+def active_promotions(product_id=None) -> list:
+    """Reads the valid Promotions running today from the database, for one product or all of them"""
+
+    def query():
+        promotions = Promotion.find_by_filters(product_id=product_id, validity=True, active_on=date.today())
+        return [promotion.serialize() for promotion in promotions.order_by(Promotion.id)]
+
+    router = sharding.get_router()
+    if router is None or product_id is not None:
+        with sharding.on_owner(product_id):
+            return query()
+    return sorted(sum(router.scatter(query).values(), []), key=lambda promotion: promotion["id"])
+
+
+@database.guard
+def read_promotion(promotion_id):
+    """Returns the serialized Promotion and its ETag headers, or None when it is not found"""
+    promotion = Promotion.find(promotion_id)
+    if promotion is None:
+        return None
+    return promotion.serialize(), etag_headers(promotion)
+
+
+@database.guard
+def list_promotions(args, filters) -> dict:
+    """Lists the Promotions matching the query string as results and headers"""
+    router = sharding.get_router()
+    if router is not None and filters["product_id"] is None:
+        results, headers = gather_promotions(router, args, filters)
+        return {"results": results, "headers": headers}
+    with sharding.on_owner(filters["product_id"]):
+        promotions = list_query(args, filters)
+        headers = total_count_headers(promotions, args["count"])
+        results = [promotion.serialize() for promotion in paginate(promotions, args)]
+    return {"results": results, "headers": headers}
+
+
+def list_query(args, filters, with_ranking=False):
+    """Returns the sorted query of the Promotions to list"""
+    if args["q"]:
+        app.logger.info("search for %s with filters: %s", args["q"], filters)
+        return Promotion.search(args["q"], with_ranking=with_ranking, **filters)
+    app.logger.info("find by filters: %s", filters)
+    return Promotion.find_by_filters(**filters).order_by(Promotion.id)
+
+
+def gather_promotions(router, args, filters):
+    """
+    Lists the Promotions of every shard as (results, headers)
+
+    Every shard returns its first page * per_page matches and the merged
+    results are cut down to the page, so deep pages cost more than near ones.
+    """
+    if args["page"] is None and args["per_page"] is None:
+        offset, limit = 0, None
+    else:
+        per_page = args["per_page"] or DEFAULT_PER_PAGE
+        offset, limit = ((args["page"] or 1) - 1) * per_page, per_page
+    fetch = None if limit is None else offset + limit
+    if args["q"]:
+        rows = router.gather(
+            lambda: list_query(args, filters, with_ranking=True), key=lambda row: sharding.sort_key(row[1:]), limit=fetch
+        )
+        promotions = [row[0] for row in rows]
+    else:
+        promotions = router.gather(lambda: list_query(args, filters), key=lambda promotion: promotion.id, limit=fetch)
+    promotions = promotions[offset:] if limit is None else promotions[offset:offset + limit]
+    headers = {}
+    if args["count"]:
+        counts = router.scatter(lambda: total_count_headers(list_query(args, filters), args["count"])).values()
+        headers["X-Total-Count"] = str(sum(int(count["X-Total-Count"]) for count in counts))
+        if any("X-Total-Count-Estimated" in count for count in counts):
+            headers["X-Total-Count-Estimated"] = "true"
+    return [promotion.serialize() for promotion in promotions], headers
+
+
+def paginate(query, args):
+    """Limits a query to the requested page, if any"""
+    if args["page"] is None and args["per_page"] is None:
+        return query
+    per_page = args["per_page"] or DEFAULT_PER_PAGE
+    return query.limit(per_page).offset(((args["page"] or 1) - 1) * per_page)
+
+
+def total_count_headers(query, method) -> dict:
+    """Returns the X-Total-Count headers of a query for the requested method
+
+    Estimates come from the database planner and cost nothing to compute,
+    "auto" only pays for an exact COUNT(*) when the estimate is small.
+    """
+    if not method:
+        return {}
+    estimate = None if method == "exact" else Promotion.estimate_count(query)
+    if estimate is None or (method == "auto" and estimate <= EXACT_COUNT_THRESHOLD):
+        return {"X-Total-Count": str(query.order_by(None).count())}
+    return {"X-Total-Count": str(estimate), "X-Total-Count-Estimated": "true"}
+
+
+def etag_headers(promotion) -> dict:
+    """Returns the ETag header of a Promotion, which is its version"""
+    return {"ETag": f'"{promotion.version}"'}
+
+
+def if_match_versions():
+    """Returns the versions allowed by If-Match, or None when any will do"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return [int(tag) for tag in request.if_match.as_set() if tag.isdigit()]
+
+
+def update_or_abort(promotion_id, values, *criteria, message="", op="update"):
+    """
+    Changes a Promotion in one conditional UPDATE and returns it
+
+    Only when nothing matched is the Promotion read again, to tell a
+    missing Promotion (404) from a stale If-Match (412) or failed criteria (400).
+    """
+    versions = if_match_versions()
+    promotion = Promotion.update_where(promotion_id, values, *criteria, versions=versions, op=op)
+    if promotion is not None:
+        return promotion
+    current = Promotion.find(promotion_id)
+    if current is None:
+        abort(status.HTTP_404_NOT_FOUND, f"Promotion with id '{promotion_id}' was not found.")
+    check_if_match(current)
+    abort(status.HTTP_400_BAD_REQUEST, message)
+    return None
+
+
+def check_if_match(promotion):
+    """Aborts with 412 when If-Match does not name the current version"""
+    if request.if_match and not request.if_match.contains(str(promotion.version)):
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Promotion with id '{promotion.id}' has changed, it is now version {promotion.version}.",
+        )
+
+
 def abort(error_code: int, message: str):
     """Logs errors before aborting"""
     app.logger.error(message)
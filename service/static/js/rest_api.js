@@ -37,7 +37,8 @@ $(function () {
         $("#promotion_description").val("");
         $("#promotion_product_id").val("");
         $("#promotion_start_date").val("");
-        $("#promotion_end_date").val("")
+        $("#promotion_end_date").val("");
+        $("#promotion_query").val("")
     }
 
     // Updates the flash message area
@@ -211,115 +212,204 @@ $(function () {
     });
 
     // ****************************************
-    // Search for a Promotion
+    // Search for Promotions
     // ****************************************
 
-    $("#search-btn").click(function () {
-
-        let name = $("#promotion_name").val();
-        let category = $("#promotion_category").val();
+    // Results are read from the server one page at a time, and only the
+    // rows in view (plus a few around them) are in the DOM, so searches
+    // matching many thousands of Promotions stay responsive
+    const PAGE_SIZE = 100;
+    const ROW_HEIGHT = 37;
+    const OVERSCAN = 10;
+    const SEARCH_DELAY = 300;
+
+    // The current search: its query string, the total number of rows, the pages loaded and the requests in flight
+    let search = null;
+    let search_timer = null;
+    let render_pending = false;
+
+    // Builds the query string of the search from the form
+    function search_query() {
+        let params = {};
         let product_id = Math.floor($("#promotion_product_id").prop("valueAsNumber"));
-        let validity = $("#promotion_validity").val() == "true";
-        let start_date = $("#promotion_start_date").val();
-        let end_date = $("#promotion_end_date").val();
-
-        let queryString = ""
-
-        if (name) {
-            queryString += 'name=' + name
-        }
-        if (category) {
-            if (queryString.length > 0) {
-                queryString += '&category=' + category
-            } else {
-                queryString += 'category=' + category
+        let fields = {
+            "name": $("#promotion_name").val(),
+            "category": $("#promotion_category").val(),
+            "product_id": product_id,
+            "validity": $("#promotion_validity").val() == "true",
+            "start_date": $("#promotion_start_date").val(),
+            "end_date": $("#promotion_end_date").val(),
+            "q": $("#promotion_query").val(),
+        };
+        for (let key in fields) {
+            if (fields[key]) {
+                params[key] = fields[key];
             }
         }
-        if (product_id) {
-            if (queryString.length > 0) {
-                queryString += '&product_id=' + product_id
-            } else {
-                queryString += 'product_id=' + product_id
-            }
+        return $.param(params);
+    }
+
+    // Escapes a value for the HTML of a row
+    function escape_html(value) {
+        return $("<div>").text(value === null || value === undefined ? "" : value).html();
+    }
+
+    // Describes the discount of a Promotion
+    function promotion_type(promotion) {
+        if (promotion.category === "SPEND_X_SAVE_Y") {
+            return `Spend ${promotion.discount_x} Save ${promotion.discount_y}`
+        } else if (promotion.category === "BUY_X_GET_Y_FREE") {
+            return `Buy ${promotion.discount_x} Get ${promotion.discount_y} Free`
+        } else if (promotion.category === "PERCENTAGE_DISCOUNT_X") {
+            return `${promotion.discount_x}% off`
         }
-        if (validity) {
-            if (queryString.length > 0) {
-                queryString += '&validity=' + validity
-            } else {
-                queryString += 'validity=' + validity
+        return `Unknown`
+    }
+
+    function promotion_row(index, promotion) {
+        let cells = [
+            promotion.id, promotion.name, promotion_type(promotion), promotion.product_id,
+            promotion.validity, promotion.start_date, promotion.end_date, promotion.description
+        ];
+        return `<tr id="row_${index}"><td>${cells.map(escape_html).join("</td><td>")}</td></tr>`;
+    }
+
+    // Starts a new search, cancelling the requests of the one it replaces
+    function start_search(copy_first) {
+        clearTimeout(search_timer);
+        cancel_search();
+        search = {query: search_query(), total: 0, pages: {}, requests: {}, copy_first: copy_first};
+        $("#search_results").scrollTop(0);
+        $("#search_rows").empty();
+        $("#flash_message").empty();
+        load_page(1);
+    }
+
+    function cancel_search() {
+        if (search) {
+            for (let page in search.requests) {
+                search.requests[page].abort();
             }
         }
-        if (start_date) {
-            if (queryString.length > 0) {
-                queryString += '&start_date=' + start_date
-            } else {
-                queryString += 'start_date=' + start_date
-            }
+        search = null;
+    }
+
+    // Requests a page of the current search, unless it is loaded or on its way
+    function load_page(page) {
+        let current = search;
+        if (current.pages[page] || current.requests[page]) {
+            return;
         }
-        if (end_date) {
-            if (queryString.length > 0) {
-                queryString += '&end_date=' + end_date
-            } else {
-                queryString += 'end_date=' + end_date
-            }
+        let params = `${current.query}${current.query ? "&" : ""}page=${page}&per_page=${PAGE_SIZE}`;
+        if (page == 1) {
+            params += "&count=auto";
         }
 
-        $("#flash_message").empty();
-
         let ajax = $.ajax({
             type: "GET",
-            url: `/api/promotions?${queryString}`,
+            url: `/api/promotions?${params}`,
             contentType: "application/json",
             data: ''
         })
+        current.requests[page] = ajax;
 
-        ajax.done(function (res) {
-            //alert(res.toSource())
-            $("#search_results").empty();
-            let table = '<table class="table table-striped" cellpadding="10">'
-            table += '<thead><tr>'
-            table += '<th class="col-md-2">ID</th>'
-            table += '<th class="col-md-2">Name</th>'
-            table += '<th class="col-md-2">Type</th>'
-            table += '<th class="col-md-2">Product ID</th>'
-            table += '<th class="col-md-2">Validity</th>'
-            table += '<th class="col-md-2">Start Date</th>'
-            table += '<th class="col-md-2">End Date</th>'
-            table += '<th class="col-md-2">Description</th>'
-            table += '</tr></thead><tbody>'
-            let firstPromotion = "";
-            for (let i = 0; i < res.length; i++) {
-                let promotion = res[i];
-                let type = "";
-                if (promotion.category === "SPEND_X_SAVE_Y") {
-                    type = `Spend ${promotion.discount_x} Save ${promotion.discount_y}`
-                } else if (promotion.category === "BUY_X_GET_Y_FREE") {
-                    type = `Buy ${promotion.discount_x} Get ${promotion.discount_y} Free`
-                } else if (promotion.category === "PERCENTAGE_DISCOUNT_X") {
-                    type = `${promotion.discount_x}% off`
-                } else {
-                    type = `Unknown`
-                }
-                table += `<tr id="row_${i}"><td>${promotion.id}</td><td>${promotion.name}</td><td>${type}</td><td>${promotion.product_id}</td><td>${promotion.validity}</td><td>${promotion.start_date}</td><td>${promotion.end_date}</td><td>${promotion.description}</td></tr>`;
-                if (i == 0) {
-                    firstPromotion = promotion;
+        ajax.done(function (res, _status, xhr) {
+            delete current.requests[page];
+            if (search !== current) {
+                return;
+            }
+            current.pages[page] = res;
+            update_total(current, page, res, xhr.getResponseHeader("X-Total-Count"),
+                xhr.getResponseHeader("X-Total-Count-Estimated") === "true");
+            render_rows();
+            if (page == 1) {
+                // copy the first result to the form
+                if (current.copy_first && res.length > 0) {
+                    update_form_data(res[0])
                 }
+                flash_message("Success")
             }
-            table += '</tbody></table>';
-            $("#search_results").append(table);
+        });
 
-            // copy the first result to the form
-            if (firstPromotion != "") {
-                update_form_data(firstPromotion)
+        ajax.fail(function (res, text_status) {
+            delete current.requests[page];
+            if (text_status === "abort" || search !== current) {
+                return;
             }
-
-            flash_message("Success")
+            flash_message(res.responseJSON ? res.responseJSON.message : "Server error!")
         });
+    }
 
-        ajax.fail(function (res) {
-            flash_message(res.responseJSON.message)
-        });
+    // Works out the number of rows from X-Total-Count, correcting estimates with the pages read
+    function update_total(current, page, rows, total_count, estimated) {
+        let count = parseInt(total_count, 10);
+        if (page == 1 && !isNaN(count)) {
+            current.total = count;
+        }
+        let loaded = (page - 1) * PAGE_SIZE + rows.length;
+        if (rows.length < PAGE_SIZE) {
+            current.total = loaded;
+        } else if (current.total <= loaded && (isNaN(count) || estimated)) {
+            current.total = loaded + PAGE_SIZE;
+        } else {
+            current.total = Math.max(current.total, loaded);
+        }
+        $("#search_count").text(`${current.total} promotions`);
+    }
+
+    // Renders the rows in view between two spacers holding the place of the others
+    function render_rows() {
+        render_pending = false;
+        if (!search) {
+            return;
+        }
+        let viewport = $("#search_results");
+        let top = viewport.scrollTop();
+        let first = Math.max(0, Math.floor(top / ROW_HEIGHT) - OVERSCAN);
+        first -= first % 2;  // keeps the stripes of the rows in place
+        let last = Math.min(search.total, Math.ceil((top + viewport.height()) / ROW_HEIGHT) + OVERSCAN);
+        let wanted = {};
+        let rows = `<tr class="spacer" style="height: ${first * ROW_HEIGHT}px"></tr>`;
+        for (let i = first; i < last; i++) {
+            let page = Math.floor(i / PAGE_SIZE) + 1;
+            wanted[page] = true;
+            let loaded = search.pages[page];
+            if (!loaded) {
+                load_page(page);
+                rows += `<tr id="row_${i}"><td colspan="8">Loading...</td></tr>`;
+            } else if (i % PAGE_SIZE < loaded.length) {
+                rows += promotion_row(i, loaded[i % PAGE_SIZE]);
+            }
+        }
+        rows += `<tr class="spacer" style="height: ${(search.total - last) * ROW_HEIGHT}px"></tr>`;
+        $("#search_rows").html(rows);
+
+        // pages scrolled out of view before they arrived are not needed any more
+        for (let page in search.requests) {
+            if (!wanted[page] && page != 1) {
+                search.requests[page].abort();
+                delete search.requests[page];
+            }
+        }
+    }
+
+    $("#search_results").on("scroll", function () {
+        if (!render_pending) {
+            render_pending = true;
+            window.requestAnimationFrame(render_rows);
+        }
+    });
+
+    $("#search-btn").click(function () {
+        start_search(true);
+    });
 
+    // search as the text is typed, once the typing pauses
+    $("#promotion_query").on("input", function () {
+        clearTimeout(search_timer);
+        search_timer = setTimeout(function () {
+            start_search(false);
+        }, SEARCH_DELAY);
     });
 
     // ****************************************
@@ -0,0 +1,153 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the hashed and precompressed static assets
+"""
+
+# pylint: disable=duplicate-code
+import gzip
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+from service.common import assets
+
+STYLE = b"body { color: #333; }\n" * 40
+INDEX = """<html><head><link rel="stylesheet" href="static/css/site.css"></head>
+<body><img src="static/images/logo.png"><script src="static/js/missing.js"></script></body></html>
+""" + "<!-- padding to make it worth compressing -->\n" * 10
+
+
+######################################################################
+#  S T A T I C   A S S E T   T E S T   C A S E S
+######################################################################
+class TestAssets(TestCase):
+    """Test Cases for the static assets"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.config["DEBUG"] = False
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        self.client = app.test_client()
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.static = os.path.join(self.directory.name, "static")
+        self.output = os.path.join(self.directory.name, "assets")
+        for name, data in (("css/site.css", STYLE), ("images/logo.png", b"\x89PNG" * 100), ("index.html", INDEX.encode())):
+            os.makedirs(os.path.dirname(os.path.join(self.static, name)), exist_ok=True)
+            with open(os.path.join(self.static, name), "wb") as file:
+                file.write(data)
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.directory.cleanup()
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
+
+    def test_build_assets(self):
+        """It should copy the static files under hashed names with compressed variants"""
+        manifest = assets.build_assets(self.static, self.output)
+        style, encodings = manifest["css/site.css"]
+        self.assertEqual(style, assets.hashed_name("css/site.css", STYLE))
+        self.assertRegex(style, r"^css/site\.[0-9a-f]{12}\.css$")
+        self.assertEqual(encodings, ("br", "gzip"))
+        with gzip.open(os.path.join(self.output, style + ".gz")) as file:
+            self.assertEqual(file.read(), STYLE)
+        # images are not compressed
+        self.assertEqual(manifest["images/logo.png"][1], ())
+        self.assertFalse(os.path.exists(os.path.join(self.output, manifest["images/logo.png"][0] + ".gz")))
+
+        with open(os.path.join(self.output, manifest["index.html"][0]), encoding="utf8") as file:
+            index = file.read()
+        self.assertIn(f'href="assets/{style}"', index)
+        self.assertIn(f'src="assets/{manifest["images/logo.png"][0]}"', index)
+        self.assertIn('src="static/js/missing.js"', index)
+
+        # a second build finds everything in place
+        modified = os.path.getmtime(os.path.join(self.output, style))
+        self.assertEqual(assets.build_assets(self.static, self.output), manifest)
+        self.assertEqual(os.path.getmtime(os.path.join(self.output, style)), modified)
+        with open(os.path.join(self.static, "css/site.css"), "ab") as file:
+            file.write(b"p { margin: 0; }\n")
+        self.assertNotEqual(assets.build_assets(self.static, self.output)["css/site.css"][0], style)
+
+    def test_serve_assets(self):
+        """It should serve hashed files for good and pick the encoding the client accepts"""
+        bundle = assets.AssetBundle(self.static, self.output)
+        with patch.dict(app.extensions, {assets.EXTENSION: bundle}):
+            url = bundle.url("css/site.css")
+            response = self.client.get(url, headers={"Accept-Encoding": "gzip;q=1.0, br;q=0.5"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Content-Encoding"], "gzip")
+            self.assertEqual(response.headers["Cache-Control"], assets.IMMUTABLE)
+            self.assertEqual(response.mimetype, "text/css")
+            self.assertIn("Accept-Encoding", response.vary)
+            self.assertEqual(gzip.decompress(response.data), STYLE)
+
+            response = self.client.get(url, headers={"Accept-Encoding": "gzip, deflate, br"})
+            self.assertEqual(response.headers["Content-Encoding"], "br")
+            response = self.client.get(url)
+            self.assertNotIn("Content-Encoding", response.headers)
+            self.assertEqual(response.data, STYLE)
+            self.assertEqual(self.client.get(bundle.url("images/logo.png")).status_code, 200)
+            self.assertEqual(self.client.get("/assets/css/site.css").status_code, 404)
+
+    def test_conditional_index(self):
+        """It should revalidate index.html with its ETag"""
+        bundle = assets.AssetBundle(self.static, self.output)
+        with patch.dict(app.extensions, {assets.EXTENSION: bundle}):
+            response = self.client.get("/", headers={"Accept-Encoding": "gzip"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Cache-Control"], "no-cache")
+            self.assertIn(bundle.url("css/site.css")[1:], gzip.decompress(response.data).decode())
+            etag = response.headers["ETag"]
+            response = self.client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            # another encoding is another representation
+            response = self.client.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_without_assets(self):
+        """It should serve the static folder when ASSET_DIR is empty or cannot be written"""
+        with patch.dict(app.config, {"ASSET_DIR": ""}):
+            self.assertIsNone(assets.init_app(app))
+        with open(os.path.join(self.directory.name, "file"), "w", encoding="utf8") as file:
+            file.write("not a directory")
+        with patch.dict(app.config, {"ASSET_DIR": os.path.join(self.directory.name, "file")}):
+            self.assertIsNone(assets.init_app(app))
+        with patch.dict(app.extensions), patch.dict(app.config, {"ASSET_DIR": self.output}):
+            bundle = assets.init_app(app)
+            self.assertIs(assets.get_assets(), bundle)
+            del app.extensions[assets.EXTENSION]
+            self.assertIsNone(assets.get_assets())
+            response = self.client.get("/")
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b"static/js/rest_api.js", response.data)
+            response.close()
+            response = self.client.get("/assets/js/rest_api.js")
+            self.assertEqual(response.status_code, 200)
+            response.close()
@@ -0,0 +1,260 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the result cache
+"""
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from service.models import promotions_changed
+from service.common.cache import (
+    LocalBackend,
+    ResultCache,
+    SharedMemoryBackend,
+    SingleFlight,
+    create_backend,
+    metrics_text,
+)
+
+
+######################################################################
+#  R E S U L T   C A C H E   T E S T   C A S E S
+######################################################################
+class TestResultCache(TestCase):
+    """Test Cases for the ResultCache"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.now = 0
+        self.calls = 0
+        self.cache = ResultCache(ttl=10, clock=lambda: self.now)
+
+    def compute(self):
+        """Counts how many times the value was computed"""
+        self.calls += 1
+        return {"calls": self.calls}
+
+    def test_get_caches_values(self):
+        """It should compute a value once and return it with a stable etag"""
+        etag, value = self.cache.get("key", self.compute)
+        self.assertEqual(value, {"calls": 1})
+        self.assertEqual(self.cache.get("key", self.compute), (etag, value))
+        self.assertEqual(self.calls, 1)
+
+    def test_entries_expire(self):
+        """It should compute the value again once it expired"""
+        self.cache.get("key", self.compute)
+        self.now = 11
+        _, value = self.cache.get("key", self.compute)
+        self.assertEqual(value, {"calls": 2})
+
+    def test_writes_clear_the_cache(self):
+        """It should drop every entry when a Promotion changes"""
+        etag, _ = self.cache.get("key", self.compute)
+        promotions_changed.send(self)
+        new_etag, value = self.cache.get("key", self.compute)
+        self.assertEqual(value, {"calls": 2})
+        self.assertNotEqual(etag, new_etag)
+
+    def test_stale_values_are_not_cached(self):
+        """It should not keep a value computed while a Promotion changed"""
+
+        def compute_during_write():
+            promotions_changed.send(self)
+            return self.compute()
+
+        self.cache.get("key", compute_during_write)
+        _, value = self.cache.get("key", self.compute)
+        self.assertEqual(value, {"calls": 2})
+
+    def test_hit_ratio(self):
+        """It should count the hits and misses of a cache"""
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 0, "hit_ratio": 0.0})
+        for _ in range(4):
+            self.cache.get("key", self.compute)
+        self.assertEqual(self.cache.stats(), {"hits": 3, "misses": 1, "hit_ratio": 0.75})
+        text = metrics_text([self.cache])
+        self.assertIn('promotion_cache_requests_total{cache="results",result="hit"} 3', text)
+        self.assertIn('promotion_cache_hit_ratio{cache="results"} 0.7500', text)
+        self.assertIn("promotion_cache_entries 1", text)
+
+
+######################################################################
+#  S H A R E D   M E M O R Y   B A C K E N D   T E S T   C A S E S
+######################################################################
+class TestSharedMemoryBackend(TestCase):
+    """Test Cases for the SharedMemoryBackend"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.calls = 0
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.directory.cleanup()
+
+    def worker(self, max_entries=1024):
+        """Returns a cache as another worker process would open it"""
+        backend = SharedMemoryBackend(self.directory.name, max_entries)
+        return ResultCache(ttl=10, backend=backend, name="list")
+
+    def compute(self):
+        """Counts how many times the value was computed"""
+        self.calls += 1
+        return {"calls": self.calls}
+
+    def test_workers_share_entries(self):
+        """It should return the value a worker computed to the other workers"""
+        first, second = self.worker(), self.worker()
+        etag, value = first.get({"page": 1}, self.compute)
+        self.assertEqual(second.get({"page": 1}, self.compute), (etag, value))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(first.stats(), {"hits": 1, "misses": 1, "hit_ratio": 0.5})
+        self.assertEqual(second.backend.size(), 1)
+
+    def test_writes_in_any_worker(self):
+        """It should make the entries of every worker stale on a write"""
+        first, second = self.worker(), self.worker()
+        first.get("key", self.compute)
+        second.clear()
+        self.assertEqual(first.backend.generation(), 1)
+        _, value = first.get("key", self.compute)
+        self.assertEqual(value, {"calls": 2})
+        promotions_changed.send(self)
+        self.assertEqual(second.backend.generation(), 3)  # both backends are connected
+
+    def test_prune_entries(self):
+        """It should remove the entries of older generations and the oldest beyond the limit"""
+        cache = self.worker(max_entries=2)
+        cache.get("old", self.compute)
+        cache.clear()
+        for key in ("a", "b", "c"):
+            cache.get(key, self.compute)
+        files = [name for name in os.listdir(self.directory.name) if name.endswith(".json")]
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(name.startswith("1-") for name in files))
+        self.assertEqual(cache.backend.size(), 2)
+
+    def test_too_many_caches(self):
+        """It should only hold counters for a few caches"""
+        backend = SharedMemoryBackend(self.directory.name)
+        for index in range(16):
+            backend.register(f"cache-{index}")
+        backend.register("cache-0")
+        self.assertRaises(ValueError, backend.register, "one-more")
+
+    def test_create_backend(self):
+        """It should share the cache under RESPONSE_CACHE_DIR when it can"""
+        config = {"SQLALCHEMY_DATABASE_URI": "sqlite://", "RESPONSE_CACHE_DIR": self.directory.name}
+        self.assertIsInstance(create_backend(config), SharedMemoryBackend)
+        self.assertIsInstance(create_backend({**config, "RESPONSE_CACHE_DIR": ""}), LocalBackend)
+        unusable = os.path.join(self.directory.name, "file")
+        with open(unusable, "w", encoding="utf8"):
+            pass
+        self.assertIsInstance(create_backend({**config, "RESPONSE_CACHE_DIR": unusable}), LocalBackend)
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """Test Cases for the SingleFlight"""
+
+    def setUp(self):
+        """This runs before each test"""
+        self.flight = SingleFlight("find")
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow_read(self):
+        """Counts the reads and waits for the test to let them finish"""
+        self.calls += 1
+        self.release.wait(5)
+        return {"calls": self.calls}
+
+    def run_readers(self, count, key="key"):
+        """Starts count concurrent reads of a key and returns their results once released"""
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.flight.do(key, self.slow_read))) for _ in range(count)
+        ]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_for(self, collapsed):
+        """Waits until collapsed reads are waiting for the one in progress"""
+        deadline = time.monotonic() + 5
+        while self.flight.collapsed < collapsed and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_concurrent_reads_share_one_call(self):
+        """It should run one read for concurrent callers of a key and count the others"""
+        threads, results = self.run_readers(5)
+        self.wait_for(4)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{"calls": 1}] * 5)
+        self.assertEqual((self.flight.calls, self.flight.collapsed), (1, 4))
+        # the next read runs again
+        self.assertEqual(self.flight.do("key", self.slow_read), {"calls": 2})
+        text = metrics_text([ResultCache()], [self.flight])
+        self.assertIn('promotion_reads_collapsed_total{read="find"} 4', text)
+
+    def test_reads_after_a_write(self):
+        """It should not give the result of a read started before a write"""
+        threads, _ = self.run_readers(1)
+        while self.calls == 0:
+            time.sleep(0.001)
+        promotions_changed.send(self)
+        self.release.set()
+        self.assertEqual(self.flight.do("key", self.slow_read), {"calls": 2})
+        threads[0].join()
+        self.assertEqual(self.flight.collapsed, 0)
+
+    def test_errors_are_shared(self):
+        """It should raise the error of the read in every caller"""
+        started = threading.Event()
+
+        def failing_read():
+            started.set()
+            self.release.wait(5)
+            raise ValueError("database down")
+
+        errors = []
+
+        def leader():
+            try:
+                self.flight.do("key", failing_read)
+            except ValueError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait(5)
+        follower = threading.Thread(target=leader)
+        follower.start()
+        self.wait_for(1)
+        self.release.set()
+        thread.join()
+        follower.join()
+        self.assertEqual([str(error) for error in errors], ["database down"] * 2)
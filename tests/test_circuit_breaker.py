@@ -0,0 +1,173 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the database circuit breaker
+"""
+
+from unittest import TestCase
+from sqlalchemy.exc import OperationalError
+from wsgi import app
+from service.common.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    StaleFallback,
+    stale_headers,
+)
+
+
+def database_down():
+    """Fails like a read from a database that cannot be reached"""
+    raise OperationalError("SELECT 1", {}, ConnectionRefusedError("connection refused"))
+
+
+######################################################################
+#  C I R C U I T   B R E A K E R   T E S T   C A S E S
+######################################################################
+class TestCircuitBreaker(TestCase):
+    """Test Cases for the CircuitBreaker"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        self.now = 0
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def fail_calls(self, times=1):
+        """Makes failed calls through the breaker"""
+        for _ in range(times):
+            self.assertRaises(OperationalError, self.breaker.call, database_down)
+
+    def test_opens_after_failures(self):
+        """It should stop calls after consecutive failures, until the timeout"""
+        self.fail_calls()
+        self.assertEqual(self.breaker.call(lambda: 1), 1)
+        self.fail_calls(2)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.call(lambda: 1)
+        self.assertEqual(raised.exception.retry_after, 10)
+        self.now = 4
+        self.assertEqual(self.breaker.retry_in(), 6)
+
+    def test_half_open_trial(self):
+        """It should let a single trial call through after the timeout"""
+        self.fail_calls(2)
+        self.now = 10
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_in(), 1.0)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now = 20
+        self.assertEqual(self.breaker.retry_in(), 0)
+        self.assertEqual(self.breaker.call(lambda: "back"), "back")
+        self.assertEqual((self.breaker.state, self.breaker.failures), (CLOSED, 0))
+
+    def test_slow_calls(self):
+        """It should count calls slower than slow_call_seconds as failures"""
+        self.breaker.slow_call_seconds = 1
+
+        def slow():
+            self.now += 2
+            return "slow"
+
+        self.assertEqual(self.breaker.call(slow), "slow")
+        self.breaker.call(slow)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_guard(self):
+        """It should decorate functions to call them through the breaker"""
+        guarded = self.breaker.guard(lambda value: value * 2)
+        self.assertEqual(guarded(21), 42)
+        self.fail_calls(2)
+        self.assertRaises(CircuitOpenError, guarded, 1)
+
+
+######################################################################
+#  S T A L E   F A L L B A C K   T E S T   C A S E S
+######################################################################
+class TestStaleFallback(TestCase):
+    """Test Cases for the StaleFallback"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.app_context().push()
+
+    def setUp(self):
+        """This runs before each test"""
+        self.now = 100
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        self.fallback = StaleFallback(self.breaker, app.app_context, max_entries=2, clock=lambda: self.now)
+        self.down = False
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.down = False
+        thread = self.fallback._thread  # pylint: disable=protected-access
+        if thread is not None:
+            thread.join(5)
+
+    def read(self, value):
+        """Returns a read of value through the breaker, failing while the database is down"""
+        return self.breaker.guard(lambda: database_down() if self.down else value)
+
+    def test_serves_last_result(self):
+        """It should answer with the last good result and its age while the database is down"""
+        self.assertEqual(self.fallback.read("key", self.read(1)), (1, None))
+        self.down = True
+        self.now = 130
+        self.assertEqual(self.fallback.read("key", self.read(2)), (1, 30))
+        self.assertEqual(self.fallback.read("key", self.read(2)), (1, 30))  # circuit open
+        self.assertEqual(self.fallback.served, 2)
+        self.assertRaises(CircuitOpenError, self.fallback.read, "other", self.read(3))
+        self.assertIn("promotion_stale_reads_total 2", self.fallback.metrics_text())
+
+    def test_revalidates_in_background(self):
+        """It should read the stale values again once the database is back"""
+        self.fallback.read("key", self.read(1))
+        self.down = True
+        self.fallback.read("key", self.read(2))
+        thread = self.fallback._thread  # pylint: disable=protected-access
+        self.down = False
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertIn("promotion_database_circuit_open 0", self.fallback.metrics_text())
+        self.down = True
+        self.assertEqual(self.fallback.read("key", self.read(3)), (2, 0))
+
+    def test_keeps_recent_results(self):
+        """It should only keep the most recently read results"""
+        for key in ("a", "b", "c"):
+            self.fallback.read(key, self.read(key))
+        self.down = True
+        self.assertRaises(OperationalError, self.fallback.read, "a", self.read("a"))
+        self.assertEqual(self.fallback.read("c", self.read("c")), ("c", 0))
+
+    def test_stale_headers(self):
+        """It should mark stale responses with their age"""
+        self.assertEqual(stale_headers(None), {})
+        self.assertEqual(stale_headers(5), {"Age": "5", "Warning": '110 - "Response is Stale"'})
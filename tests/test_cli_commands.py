@@ -26,7 +26,18 @@ from click.testing import CliRunner
 
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import (  # noqa: E402
+    db_create,
+    promotions_import,
+    promotions_export,
+    promotions_expire,
+    promotions_activate,
+    promotions_partition,
+    promotions_archive,
+    shards_rebalance,
+)
+from service.common.bulk_import import ImportStats  # noqa: E402
+from service.models import Category  # noqa: E402
 
 
 class TestFlaskCLI(TestCase):
@@ -42,3 +53,158 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch("service.common.bulk_import.import_promotions")
+    def test_promotions_import(self, import_mock):
+        """It should call the promotions-import command"""
+
+        def fake_import(stream, fmt, **kwargs):
+            self.assertEqual(fmt, "csv")
+            self.assertEqual(kwargs["batch_size"], 500)
+            stats = ImportStats()
+            stats.read = stats.loaded = len(stream.read().splitlines()) - 1
+            stats.batches = 1
+            kwargs["progress"](stats)
+            return stats
+
+        import_mock.side_effect = fake_import
+        with self.runner.isolated_filesystem():
+            with open("promotions.csv", "w", encoding="utf-8") as csv_file:
+                csv_file.write("name,product_id,description\nTest,1,Test\n")
+            result = self.runner.invoke(promotions_import, ["promotions.csv", "--batch-size", "500"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("batch 1: 1 read, 1 loaded, 0 rejected", result.output)
+        self.assertIn("Imported 1 promotions", result.output)
+
+        import_mock.side_effect = ValueError("cannot import")
+        with self.runner.isolated_filesystem():
+            with open("promotions.csv", "w", encoding="utf-8") as csv_file:
+                csv_file.write("name,product_id,description\n")
+            result = self.runner.invoke(promotions_import, ["promotions.csv"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("Error: cannot import", result.output)
+
+    @patch("service.common.bulk_export.export_promotions")
+    def test_promotions_export(self, export_mock):
+        """It should call the promotions-export command with filters"""
+
+        def fake_export(output, fmt, **kwargs):
+            self.assertEqual(fmt, "parquet")
+            self.assertEqual(kwargs["category"], Category.SPEND_X_SAVE_Y)
+            self.assertEqual(kwargs["start_date"].isoformat(), "2024-01-01")
+            self.assertTrue(kwargs["validity"])
+            self.assertEqual(kwargs["active_on"].isoformat(), "2024-02-01")
+            self.assertIsNone(kwargs["active_to"])
+            output.write(b"PAR1")
+            kwargs["progress"](3)
+            return 3
+
+        export_mock.side_effect = fake_export
+        with self.runner.isolated_filesystem():
+            result = self.runner.invoke(
+                promotions_export,
+                [
+                    "out.parquet",
+                    "--category", "spend_x_save_y",
+                    "--start-date", "2024-01-01",
+                    "--validity", "true",
+                    "--active-on", "2024-02-01",
+                ],
+            )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Exported 3 promotions", result.output)
+
+    @patch("service.common.bulk_export.export_promotions")
+    def test_promotions_export_columnar(self, export_mock):
+        """It should replace a columnar snapshot file in one rename"""
+
+        def fake_export(output, fmt, **_kwargs):
+            self.assertEqual(fmt, "columnar")
+            output.write(b"PROMOCOL")
+            return 0
+
+        export_mock.side_effect = fake_export
+        with self.runner.isolated_filesystem():
+            result = self.runner.invoke(promotions_export, ["out.columnar"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open("out.columnar", "rb") as snapshot:
+                self.assertEqual(snapshot.read(), b"PROMOCOL")
+
+    @patch("service.common.scheduler.sweep_expired")
+    def test_promotions_expire(self, sweep_mock):
+        """It should call the promotions-expire command"""
+
+        def fake_sweep(batch_size, today=None, report=None):
+            self.assertEqual(batch_size, 2)
+            self.assertEqual(today.isoformat(), "2024-06-15")
+            report([4, 5])
+            return 2
+
+        sweep_mock.side_effect = fake_sweep
+        result = self.runner.invoke(promotions_expire, ["--batch-size", "2", "--today", "2024-06-15", "--verbose"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("invalidated 2 promotions\n4 5", result.output)
+        self.assertIn("Invalidated 2 expired promotions", result.output)
+
+    @patch("service.common.scheduler.activate_started", return_value=3)
+    def test_promotions_activate(self, activate_mock):
+        """It should call the promotions-activate command"""
+        result = self.runner.invoke(promotions_activate, ["--today", "2024-06-15"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(activate_mock.call_args.kwargs["today"].isoformat(), "2024-06-15")
+        self.assertIn("Activated 3 scheduled promotions", result.output)
+
+    @patch("service.common.sharding.get_router")
+    def test_shards_rebalance(self, router_mock):
+        """It should call the shards-rebalance command"""
+
+        def fake_rebalance(batch_size, report):
+            self.assertEqual(batch_size, 50)
+            report("shard-0", "shard-2", 7)
+            return 7
+
+        router_mock.return_value.rebalance.side_effect = fake_rebalance
+        result = self.runner.invoke(shards_rebalance, ["--batch-size", "50"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("moved 7 promotions from shard-0 to shard-2", result.output)
+        self.assertIn("Moved 7 promotions", result.output)
+        router_mock.return_value = None
+        result = self.runner.invoke(shards_rebalance)
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("SHARD_DATABASE_URIS", result.output)
+
+    @patch("service.common.partitioning.ensure_partitions")
+    def test_promotions_partition(self, partition_mock):
+        """It should call the promotions-partition command"""
+        partition_mock.return_value = ["promotion_y2025m01"]
+        result = self.runner.invoke(promotions_partition, ["--months-ahead", "6"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(partition_mock.call_args.kwargs["months_ahead"], 6)
+        self.assertIn("created promotion_y2025m01", result.output)
+        self.assertIn("Created 1 partitions", result.output)
+
+    @patch("service.common.partitioning.drop_partitions")
+    @patch("service.common.scheduler.archive_expired")
+    def test_promotions_archive(self, archive_mock, drop_mock):
+        """It should call the promotions-archive command"""
+
+        def fake_archive(batch_size, before, report):
+            self.assertEqual(batch_size, 10)
+            self.assertEqual(before.isoformat(), "2024-06-15")
+            report([1, 2])
+            return 2
+
+        archive_mock.side_effect = fake_archive
+        drop_mock.return_value = ["promotion_y2024m05"]
+        result = self.runner.invoke(promotions_archive, ["--before", "2024-06-15", "--batch-size", "10"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("archived 2", result.output)
+        self.assertIn("Archived 2 expired promotions", result.output)
+        self.assertIn("removed partition promotion_y2024m05", result.output)
+        self.assertEqual(drop_mock.call_args.args[0].isoformat(), "2024-06-01")
+
+        archive_mock.reset_mock()
+        result = self.runner.invoke(promotions_archive, ["--before", "2024-06-15", "--detach"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        archive_mock.assert_not_called()
+        self.assertTrue(drop_mock.call_args.kwargs["detach"])
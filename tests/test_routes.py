@@ -18,16 +18,21 @@
 TestPromotion API Service Test Suite
 """
 
-# pylint: disable=duplicate-code
-from datetime import date
+# pylint: disable=duplicate-code, too-many-lines
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 import os
 import logging
 from unittest import TestCase
+from unittest.mock import patch
 import random
 from urllib.parse import quote_plus
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 from wsgi import app
 from service.common import status
-from service.models import db, Promotion, Category
+from service.models import db, Promotion, PromotionTombstone, Category
+from service.routes import database, encode_cursor, list_cache, stale_reads, stats_cache
 from tests.factories import PromotionFactory
 
 DATABASE_URI = os.getenv(
@@ -36,6 +41,21 @@ DATABASE_URI = os.getenv(
 BASE_URL = "/api/promotions"
 
 
+@contextmanager
+def count_statements():
+    """Collects the SQL statements sent to the database"""
+    statements = []
+
+    def before_cursor_execute(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
@@ -63,6 +83,7 @@ class TestYourResourceService(TestCase):
         self.client = app.test_client()
         db.session.query(Promotion).delete()  # clean up the last tests
         db.session.commit()
+        stats_cache.clear()
 
     def tearDown(self):
         """This runs after each test"""
@@ -313,6 +334,93 @@ class TestYourResourceService(TestCase):
         updated_promotion = response.get_json()
         self.assertEqual(updated_promotion["name"], "promo1")
 
+    def test_create_promotion_starting_later(self):
+        """It should end a Promotion posted with only a future start date on that day"""
+        data = PromotionFactory().serialize()
+        del data["end_date"]
+        data["start_date"] = (date.today() + timedelta(days=30)).isoformat()
+        response = self.client.post(BASE_URL, json=data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.get_json()["end_date"], data["start_date"])
+
+        data["end_date"] = date.today().isoformat()
+        response = self.client.post(BASE_URL, json=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.get_json()["message"], "Invalid end date before start date")
+
+    def test_update_start_after_end(self):
+        """It should reject an update moving the start date past the end date"""
+        response = self.client.post(BASE_URL, json=PromotionFactory().serialize())
+        data = response.get_json()
+        data["start_date"] = (date.fromisoformat(data["end_date"]) + timedelta(days=1)).isoformat()
+        response = self.client.put(f"{BASE_URL}/{data['id']}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.get_json()["message"], "Invalid end date before start date")
+        del data["end_date"]
+        response = self.client.put(f"{BASE_URL}/{data['id']}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("range", response.get_json()["message"])
+
+    def test_writes_without_reload(self):
+        """It should create and update a promotion without reloading it"""
+        db.session.remove()
+        with count_statements() as statements:
+            response = self.client.post(BASE_URL, json=PromotionFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("INSERT INTO promotion"))
+        self.assertIn("RETURNING", statements[0])
+
+        data = response.get_json()
+        data["name"] = "promo1"
+        db.session.remove()
+        with count_statements() as statements:
+            response = self.client.put(f"{BASE_URL}/{data['id']}", json=data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["name"], "promo1")
+        self.assertEqual(response.headers["ETag"], '"2"')
+        # the lookup and the UPDATE ... RETURNING, nothing after the commit
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith("SELECT"))
+        self.assertTrue(statements[1].startswith("UPDATE promotion"))
+        self.assertIn("RETURNING", statements[1])
+
+    def test_patch_promotion(self):
+        """It should change only the patched columns in one UPDATE"""
+        data = PromotionFactory(discount_y=3, start_date=date(2025, 1, 1), end_date=date(2025, 3, 1)).serialize()
+        location = self.client.post(BASE_URL, json=data).headers["location"]
+        db.session.remove()
+        with count_statements() as statements:
+            response = self.client.patch(
+                location,
+                json={"discount_x": 42, "discount_y": None},
+                content_type="application/merge-patch+json",
+                headers={"If-Match": '"1"'},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("UPDATE promotion SET discount_x="))
+        self.assertNotIn("name=", statements[0])
+        self.assertEqual(response.headers["ETag"], '"2"')
+        patched = response.get_json()
+        self.assertEqual(patched["discount_x"], 42)
+        self.assertIsNone(patched["discount_y"])
+        self.assertEqual(patched["name"], data["name"])
+        self.assertEqual(patched["end_date"], "2025-03-01")
+
+        response = self.client.patch(location, json={"end_date": "2024-12-31"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(location, json={"start_date": "2025-03-02"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(location, json={"discount_x": "many"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(location, json={"validity": True}, headers={"If-Match": '"1"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.patch(location, data="name=x", content_type="text/plain")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        response = self.client.patch(f"{BASE_URL}/99999", json={"validity": True})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_update_promotion_invalid_header(self):
         """It should Update an existing promotion"""
         # create a promotion to update
@@ -526,6 +634,23 @@ class TestYourResourceService(TestCase):
         for promotion in data:
             self.assertEqual(promotion["product_id"], product_id)
 
+    def test_query_by_combined_filters(self):
+        """It should Query Promotions matching every filter given"""
+        for category in (Category.SPEND_X_SAVE_Y, Category.PERCENTAGE_DISCOUNT_X):
+            for validity in (True, False):
+                data = PromotionFactory(category=category, validity=validity, product_id=7).serialize()
+                self.assertEqual(self.client.post(BASE_URL, json=data).status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(BASE_URL, query_string="category=spend_x_save_y&validity=true&product_id=7")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]["category"], Category.SPEND_X_SAVE_Y.name)
+        self.assertTrue(data[0]["validity"])
+
+        response = self.client.get(BASE_URL, query_string="category=spend_x_save_y&product_id=8")
+        self.assertEqual(response.get_json(), [])
+
     def test_validate_promotion(self):
         """It should make the Promotion valid"""
         response = self.client.put(f"{BASE_URL}/123/valid")
@@ -601,6 +726,24 @@ class TestYourResourceService(TestCase):
         response = self.client.put(f"{location}/extend", json=payload)
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_actions_in_one_statement(self):
+        """It should run each action as a single conditional UPDATE"""
+        data = PromotionFactory(validity=False, start_date=date(2025, 1, 1), end_date=date(2025, 4, 1)).serialize()
+        location = self.client.post(BASE_URL, json=data).headers["location"]
+        db.session.remove()
+        with count_statements() as statements:
+            response = self.client.put(f"{location}/valid")
+            self.client.delete(f"{location}/valid")
+            self.client.put(f"{location}/extend", json={"end_date": "2025-05-01"})
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all(statement.startswith("UPDATE promotion") for statement in statements))
+        self.assertTrue(response.get_json()["validity"])
+        response = self.client.put(f"{location}/extend", json={"end_date": "2025-06-01"}, headers={"If-Match": '"2"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.put(f"{location}/extend", json={"end_date": "2025-06-01"}, headers={"If-Match": '"4"'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], '"5"')
+
     def test_extend_promotion_duration(self):
         """It should change the end_date of the promotion to the specified date"""
         data = PromotionFactory().serialize()
@@ -615,6 +758,249 @@ class TestYourResourceService(TestCase):
         response = self.client.put(f"{location}/extend", json=payload)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    # ----------------------------------------------------------
+    # TEST SEARCH AND PAGINATION
+    # ----------------------------------------------------------
+
+    def test_search_promotions(self):
+        """It should search names and descriptions, name prefixes first"""
+        for name, description in [
+            ("Summer sale", "Half price on sandals"),
+            ("Winter clearance", "Everything from the summer collection"),
+            ("Sandal madness", "Buy one get one free"),
+        ]:
+            data = PromotionFactory(name=name, description=description).serialize()
+            self.assertEqual(self.client.post(BASE_URL, json=data).status_code, status.HTTP_201_CREATED)
+
+        response = self.client.get(BASE_URL, query_string="q=summer")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        names = [promotion["name"] for promotion in response.get_json()]
+        self.assertEqual(names, ["Summer sale", "Winter clearance"])
+
+        response = self.client.get(BASE_URL, query_string="q=sand")
+        names = [promotion["name"] for promotion in response.get_json()]
+        self.assertEqual(names, ["Sandal madness", "Summer sale"])
+
+        response = self.client.get(BASE_URL, query_string="q=win")
+        self.assertEqual([promotion["name"] for promotion in response.get_json()], ["Winter clearance"])
+
+        response = self.client.get(BASE_URL, query_string=f"q={quote_plus('50%')}")
+        self.assertEqual(response.get_json(), [])
+
+        response = self.client.get(BASE_URL, query_string=f"q={quote_plus('   ')}")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.get_json()), 3)
+
+    def test_search_with_filters(self):
+        """It should combine a search with the other filters"""
+        for validity in (True, False):
+            data = PromotionFactory(name="Flash sale", validity=validity).serialize()
+            self.client.post(BASE_URL, json=data)
+        response = self.client.get(BASE_URL, query_string="q=flash&validity=true")
+        data = response.get_json()
+        self.assertEqual(len(data), 1)
+        self.assertTrue(data[0]["validity"])
+
+    def test_promotion_changes(self):
+        """It should return the changes to Promotions after a cursor"""
+        db.session.query(PromotionTombstone).delete()
+        db.session.commit()
+        app.config["CHANGE_FEED_SETTLE_SECONDS"] = 0
+        first, second, third = (int(promotion.id) for promotion in self._create_promotions(3))
+        response = self.client.get(f"{BASE_URL}/changes", query_string="limit=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        feed = response.get_json()
+        self.assertEqual([change["id"] for change in feed["changes"]], [first, second])
+        self.assertEqual(feed["changes"][0]["op"], "created")
+        self.assertEqual(feed["changes"][0]["promotion"]["id"], first)
+
+        data = self.client.get(f"{BASE_URL}/{first}").get_json()
+        data["description"] = "changed"
+        self.client.put(f"{BASE_URL}/{first}", json=data)
+        self.client.delete(f"{BASE_URL}/{second}")
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": feed["cursor"]})
+        feed = response.get_json()
+        changes = [(change["id"], change["op"]) for change in feed["changes"]]
+        self.assertEqual(changes, [(third, "created"), (first, "updated"), (second, "deleted")])
+        self.assertIsNone(feed["changes"][-1]["promotion"])
+
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": feed["cursor"]})
+        self.assertEqual(response.get_json(), {"changes": [], "cursor": feed["cursor"]})
+        response = self.client.get(f"{BASE_URL}/changes", query_string="since=bogus")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        expired = encode_cursor(datetime.now() - timedelta(days=app.config["CHANGE_FEED_RETENTION_DAYS"] + 1), first)
+        response = self.client.get(f"{BASE_URL}/changes", query_string={"since": expired})
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+
+    def test_update_promotion_if_match(self):
+        """It should only update a Promotion when If-Match names its version"""
+        response = self.client.post(BASE_URL, json=PromotionFactory(validity=False).serialize())
+        url = f"{BASE_URL}/{response.get_json()['id']}"
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        self.assertEqual(etag, '"1"')
+        data = response.get_json()
+        data["description"] = "first writer"
+        response = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["ETag"], '"2"')
+        data["description"] = "second writer"
+        response = self.client.put(url, json=data, headers={"If-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.client.get(url).get_json()["description"], "first writer")
+        response = self.client.put(f"{url}/valid", headers={"If-Match": "*"})
+        self.assertEqual(response.headers["ETag"], '"3"')
+        response = self.client.delete(url, headers={"If-Match": '"2"'})
+        self.assertEqual(response.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        response = self.client.delete(url, headers={"If-Match": '"3"'})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_promotion_events(self):
+        """It should stream the changes to Promotions as Server-Sent Events"""
+        response = self.client.get(f"{BASE_URL}/events", buffered=False)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        stream = iter(response.response)
+        self.assertTrue(next(stream).startswith(b"retry: "))
+        promotion = self._create_promotions(1)[0]
+        chunks = (chunk for chunk in stream if not chunk.startswith(b":"))  # skip keep-alives
+        self.assertEqual(next(chunks), f'event: create\ndata: {{"op": "create", "ids": [{promotion.id}]}}\n\n'.encode())
+        response.close()
+
+    def test_promotion_stats(self):
+        """It should count Promotions by category, validity and month"""
+        for day in (1, 15):
+            data = PromotionFactory(
+                category=Category.BUY_X_GET_Y_FREE,
+                validity=True,
+                start_date=date(2024, 6, day),
+                end_date=date(2024, 7, 1),
+            ).serialize()
+            self.client.post(BASE_URL, json=data)
+        response = self.client.get(f"{BASE_URL}/stats")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        stats = response.get_json()
+        self.assertEqual(stats["total"], 2)
+        self.assertEqual(stats["by_category"], {"BUY_X_GET_Y_FREE": 2})
+        self.assertEqual(stats["by_validity"], {"valid": 2})
+        self.assertEqual(stats["by_month"], {"2024-06": 2})
+        self.assertEqual(
+            stats["groups"], [{"category": "BUY_X_GET_Y_FREE", "validity": True, "month": "2024-06", "count": 2}]
+        )
+        etag = response.headers["ETag"]
+        response = self.client.get(f"{BASE_URL}/stats", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        # a write invalidates the cached stats
+        promotion_id = self.client.get(BASE_URL).get_json()[0]["id"]
+        self.client.delete(f"{BASE_URL}/{promotion_id}/valid")
+        response = self.client.get(f"{BASE_URL}/stats", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["by_validity"], {"valid": 1, "invalid": 1})
+
+    def test_list_promotions_cached(self):
+        """It should answer repeated list queries from the cache until a write"""
+        self._create_promotions(3)
+        before = list_cache.stats()
+        response = self.client.get(BASE_URL, query_string="per_page=2&count=exact&name=")
+        etag = response.headers["ETag"]
+        with count_statements() as statements:
+            again = self.client.get(BASE_URL, query_string="count=exact&per_page=2")
+        self.assertEqual(statements, [])
+        self.assertEqual(again.get_json(), response.get_json())
+        self.assertEqual(again.headers["X-Total-Count"], "3")
+        response = self.client.get(BASE_URL, query_string="per_page=2&count=exact", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        stats = list_cache.stats()
+        self.assertEqual(stats["hits"] - before["hits"], 2)
+        self.assertEqual(stats["misses"] - before["misses"], 1)
+
+        # a write makes every cached list stale
+        self.client.post(BASE_URL, json=PromotionFactory().serialize())
+        response = self.client.get(BASE_URL, query_string="per_page=2&count=exact", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["X-Total-Count"], "4")
+
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(f'promotion_cache_requests_total{{cache="list",result="hit"}} {stats["hits"]}', response.text)
+        self.assertIn('promotion_cache_hit_ratio{cache="stats"}', response.text)
+        self.assertIn('promotion_reads_collapsed_total{read="find"}', response.text)
+
+    def test_reads_while_database_down(self):
+        """It should serve the last result marked stale while the database is down"""
+        promotion = self._create_promotions(1)[0]
+        location = f"{BASE_URL}/{promotion.id}"
+        self.assertNotIn("Warning", self.client.get(location).headers)
+        down = OperationalError("SELECT", {}, ConnectionRefusedError("connection refused"))
+        with patch.object(database, "failure_threshold", 1), patch.object(database, "reset_timeout", 0.01):
+            with patch("service.routes.Promotion.find", side_effect=down):
+                response = self.client.get(location)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.get_json()["name"], promotion.name)
+                self.assertEqual(response.headers["Warning"], '110 - "Response is Stale"')
+                self.assertGreaterEqual(int(response.headers["Age"]), 0)
+                # nothing to fall back on
+                response = self.client.get(BASE_URL, query_string={"name": "never listed"})
+                self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+                self.assertEqual(response.headers["Retry-After"], "1")
+                self.assertIn("promotion_database_circuit_open 1", self.client.get("/metrics").text)
+            # the stale read is revalidated once the database is back
+            stale_reads._thread.join(5)  # pylint: disable=protected-access
+        self.assertNotIn("Warning", self.client.get(location).headers)
+
+    def test_list_promotions_total_count(self):
+        """It should return the total number of Promotions when asked"""
+        self._create_promotions(5)
+        response = self.client.get(BASE_URL, query_string="per_page=2")
+        self.assertNotIn("X-Total-Count", response.headers)
+        response = self.client.get(BASE_URL, query_string="per_page=2&count=exact")
+        self.assertEqual(len(response.get_json()), 2)
+        self.assertEqual(response.headers["X-Total-Count"], "5")
+        self.assertNotIn("X-Total-Count-Estimated", response.headers)
+        response = self.client.get(BASE_URL, query_string="count=auto&validity=true")
+        self.assertEqual(response.headers["X-Total-Count"], str(len(response.get_json())))
+        response = self.client.get(BASE_URL, query_string="count=estimated&q=promotion")
+        self.assertEqual(response.headers["X-Total-Count-Estimated"], "true")
+        self.assertGreaterEqual(int(response.headers["X-Total-Count"]), 0)
+        response = self.client.get(BASE_URL, query_string="count=maybe")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_promotion_date_ranges(self):
+        """It should query Promotions by date ranges"""
+        for start_date, end_date in ((date(2024, 3, 1), date(2024, 5, 31)), (date(2024, 6, 1), date(2024, 8, 31))):
+            data = PromotionFactory(start_date=start_date, end_date=end_date).serialize()
+            self.client.post(BASE_URL, json=data)
+        response = self.client.get(BASE_URL, query_string="active_on=2024-07-04")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promotion["start_date"] for promotion in response.get_json()], ["2024-06-01"])
+        response = self.client.get(BASE_URL, query_string="active_from=2024-05-01&active_to=2024-06-30")
+        self.assertEqual(len(response.get_json()), 2)
+        response = self.client.get(BASE_URL, query_string="ends_before=2024-06-01&starts_after=2024-01-01")
+        self.assertEqual([promotion["end_date"] for promotion in response.get_json()], ["2024-05-31"])
+        response = self.client.get(BASE_URL, query_string="start_date=2024-06-01")
+        self.assertEqual(len(response.get_json()), 1)
+
+    def test_query_promotion_bad_dates(self):
+        """It should not query Promotions with bad dates"""
+        response = self.client.get(BASE_URL, query_string="active_on=July")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(BASE_URL, query_string="active_from=2024-07-01&active_to=2024-06-01")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_promotions_paginated(self):
+        """It should return one page of Promotions ordered by id"""
+        promotions = self._create_promotions(5)
+        ids = sorted(promotion.id for promotion in promotions)
+        response = self.client.get(BASE_URL, query_string="page=2&per_page=2")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([promotion["id"] for promotion in response.get_json()], [str(id) for id in ids[2:4]])
+        response = self.client.get(BASE_URL, query_string="per_page=3")
+        self.assertEqual(len(response.get_json()), 3)
+        response = self.client.get(BASE_URL, query_string="page=3")
+        self.assertEqual(response.get_json(), [])
+        response = self.client.get(BASE_URL, query_string="page=0")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     # ----------------------------------------------------------
     # TEST HEALTH CHECK
     # ----------------------------------------------------------